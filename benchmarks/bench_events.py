@@ -0,0 +1,60 @@
+# coding=utf-8
+"""
+Events per second on_event handles on the event thread: events the plugin does not subscribe to, events it only keeps
+track of, and events which queue a notification.
+
+    python benchmarks/bench_events.py --events 100000
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import time
+
+import harness
+from fake_gotify import FakeGotify
+
+PAYLOAD = dict(name="benchmark.gcode", path="benchmark.gcode", origin="local")
+
+# events OctoPrint fires often which the plugin does not look at
+IGNORED = ["PositionUpdate", "ClientOpened", "Dwelling", "CaptureStart", "CaptureDone", "SettingsUpdated"]
+# events the plugin keeps track of without a notification, with the default priorities
+TRACKED = ["PrintResumed", "ZChange"]
+# events which queue a notification
+NOTIFYING = ["PrintPaused", "Waiting"]
+
+
+def events_per_second(on_event, events, count):
+    start = time.perf_counter()
+    for index in range(count):
+        on_event(events[index % len(events)], dict(PAYLOAD, old=0.2, new=0.4))
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    with FakeGotify() as server:
+        plugin = harness.create_plugin(server.url, {("events", "PrintPaused", "priority"): 4,
+                                                    ("events", "Waiting", "priority"): 4})
+        plugin.on_event("PrintStarted", PAYLOAD)
+
+        results = dict(events=args.events)
+        results["ignored_per_second"] = events_per_second(plugin.on_event, IGNORED, args.events)
+        results["tracked_per_second"] = events_per_second(plugin.on_event, TRACKED, args.events)
+        # every notification is journaled and queued, a tenth is enough to see the cost
+        results["notifying_per_second"] = events_per_second(plugin.on_event, NOTIFYING, max(1, args.events // 10))
+        results["on_event_ms"] = dict((key, value * 1000 if isinstance(value, float) else value)
+                                      for key, value in plugin.metrics.on_event.to_dict().items())
+        results["queue"] = plugin.get_queue_stats()
+        harness.shutdown(plugin)
+
+    harness.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
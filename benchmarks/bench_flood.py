@@ -0,0 +1,104 @@
+# coding=utf-8
+"""
+Floods the plugin with low priority notifications while the gotify server is slow, fires critical and normal
+notifications in between and checks the time from the event to the delivery of the critical ones against the express
+SLO. Exits with 1 when the critical notifications missed it.
+
+    python benchmarks/bench_flood.py --latency 0.2 --rate 200 --duration 10
+    python benchmarks/bench_flood.py --no-express --no-shed    # the same flood without express lane and shedding
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import sys
+import time
+
+import harness
+from fake_gotify import FakeGotify
+
+CRITICAL_EVENTS = ("EStop", "Error")
+
+
+def run(latency, rate, duration, critical_every, low_priority, express=True, shed=True):
+    overrides = {
+        ("events", "PrintPaused", "priority"): 4,
+        ("express", "enabled"): express,
+    }
+    if not shed:
+        overrides[("queue", "shed_priority")] = 0
+
+    with FakeGotify(latency=latency) as server:
+        plugin = harness.create_plugin(server.url, overrides)
+        deliveries = harness.track_deliveries(plugin)
+        plugin._printer.printing = True
+        plugin.on_event("PrintStarted", dict(name="flood.gcode", path="flood.gcode", origin="local"))
+
+        sent = dict(low=0, normal=0, critical=0)
+        start = time.monotonic()
+        next_critical = start + critical_every
+        while time.monotonic() - start < duration:
+            plugin.event_message(dict(message="Progress %d" % sent["low"], priority=low_priority), "Progress")
+            sent["low"] += 1
+            if time.monotonic() >= next_critical:
+                next_critical += critical_every
+                plugin.on_event(CRITICAL_EVENTS[sent["critical"] % len(CRITICAL_EVENTS)], dict(error="Flood"))
+                sent["critical"] += 1
+                plugin.on_event("PrintPaused", dict(name="flood.gcode", path="flood.gcode", origin="local"))
+                sent["normal"] += 1
+            delay = start + sent["low"] / float(rate) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        # let the backlog go, only the notifications of the flood count
+        server.latency = 0
+        queue = plugin.get_queue_stats()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline and (plugin.get_queue_stats()["depth"]
+                                               or any(target.express_pending for target in plugin.targets.values())):
+            time.sleep(0.05)
+        harness.shutdown(plugin)
+
+    def latencies(events):
+        return [seconds for event, seconds, _ in deliveries if event in events]
+
+    critical = latencies(CRITICAL_EVENTS)
+    return dict(
+        sent=sent,
+        critical_ms=harness.percentiles(critical, 1000),
+        critical_delivered=len(critical),
+        normal_ms=harness.percentiles(latencies(("PrintPaused",)), 1000),
+        low_ms=harness.percentiles(latencies(("Progress",)), 1000),
+        low_delivered=len(latencies(("Progress",))),
+        queue=queue,
+        slo=plugin.express_slo,
+        express=express,
+        shed=shed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the fake server takes per message")
+    parser.add_argument("--rate", type=float, default=200, help="low priority notifications per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of flooding")
+    parser.add_argument("--critical-every", type=float, default=1.0, help="seconds between critical notifications")
+    parser.add_argument("--low-priority", type=int, default=0)
+    parser.add_argument("--no-express", action="store_true")
+    parser.add_argument("--no-shed", action="store_true")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = run(args.latency, args.rate, args.duration, args.critical_every, args.low_priority,
+                  express=not args.no_express, shed=not args.no_shed)
+    harness.write_results(results, args.output)
+
+    critical = results["critical_ms"]
+    if results["critical_delivered"] < results["sent"]["critical"] \
+            or critical.get("p99") is None or critical["p99"] > results["slo"] * 1000:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
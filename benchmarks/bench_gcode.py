@@ -0,0 +1,106 @@
+# coding=utf-8
+"""
+Nanoseconds the gcode sent hook costs per line, for the gcode lines of a generated print. The loop calls the hook
+directly and times whole passes. The hook as it was before it was optimised is the before case, a call of an empty
+function with the same signature is the floor.
+
+    python benchmarks/bench_gcode.py --lines 100000 --repeat 5
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import datetime
+import logging
+import time
+
+import harness
+from fake_gotify import FakeGotify
+
+
+def empty_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+    pass
+
+
+class OldHook(object):
+    """
+    The gcode sent hook before it was optimised: it worked out the minutes since the start of the print for every line
+    but G1 and compared every gcode on its own. The notifications are left out, the schedule check only counts.
+    """
+
+    def __init__(self):
+        self.start_time = datetime.datetime.now()
+        self.last_minute = 0
+        self.m70_cmd = ""
+        self.schedule_checks = 0
+
+    def get_mins_since_started(self):
+        if self.start_time:
+            return int(round((datetime.datetime.now() - self.start_time).total_seconds() / 60, 0))
+
+    def check_schedule(self):
+        self.schedule_checks += 1
+
+    def on_event(self, event, payload):
+        pass
+
+    def sent_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        if gcode and gcode != "G1":
+            mss = self.get_mins_since_started()
+
+            if self.last_minute != mss:
+                self.last_minute = mss
+                self.check_schedule()
+
+        if gcode and gcode == "M600":
+            self.on_event("FilamentChange", None)
+
+        if gcode and gcode == "M70":
+            self.m70_cmd = cmd[3:]
+
+        if gcode and gcode == "M117" and cmd[4:].strip() != "":
+            self.m70_cmd = cmd[4:]
+
+
+def time_per_line(hook, lines, repeat):
+    """
+    :return: the fastest of repeat passes over the lines, in nanoseconds per line
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for cmd, gcode in lines:
+            hook(None, "sent", cmd, None, gcode)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / float(len(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    trace = harness.make_trace(args.lines, pauses=0, errors=0)
+    # the M600 of the trace would send a filament change notification on every pass
+    lines = [(step[1], step[2]) for step in trace if step[0] == "gcode" and step[2] != "M600"]
+
+    with FakeGotify() as server:
+        plugin = harness.create_plugin(server.url, {("events", "Throughput", "stall"): 0})
+        results = dict(lines=len(lines), baseline_ns=time_per_line(empty_hook, lines, args.repeat),
+                       idle_ns=time_per_line(plugin.sent_gcode, lines, args.repeat))
+
+        plugin.on_event("PrintStarted", dict(name="benchmark.gcode", path="benchmark.gcode", origin="local"))
+        results["printing_ns"] = time_per_line(plugin.sent_gcode, lines, args.repeat)
+        results["printing_per_second"] = 1e9 / results["printing_ns"]
+        results["before_ns"] = time_per_line(OldHook().sent_gcode, lines, args.repeat)
+        results["speedup"] = results["before_ns"] / results["printing_ns"]
+        harness.shutdown(plugin)
+
+    harness.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
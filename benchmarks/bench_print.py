@@ -0,0 +1,98 @@
+# coding=utf-8
+"""
+Replays a print against the fake gotify server and measures what the plugin costs OctoPrint and how fast the
+notifications arrive: time per gcode hook call, lines per second the hook can take, time per event, time from the event
+to the delivery, and memory.
+
+    python benchmarks/bench_print.py --lines 50000 --latency 0.2 --error-rate 0.05 --output print.json
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import tracemalloc
+
+import harness
+from fake_gotify import FakeGotify
+
+
+def run(trace, latency=0.0, error_rate=0.0, reset_rate=0.0, pace=0, overrides=None):
+    with FakeGotify(latency=latency, error_rate=error_rate, reset_rate=reset_rate) as server:
+        harness.settle()
+        rss_before = harness.rss_bytes()
+        plugin = harness.create_plugin(server.url, overrides)
+        deliveries = harness.track_deliveries(plugin)
+
+        result = harness.replay(plugin, trace, pace=pace)
+        rss_after = harness.rss_bytes()
+        shutdown = harness.shutdown(plugin)
+
+        hook_seconds = sum(result["hook_ns"]) / 1e9
+        return dict(
+            lines=result["lines"],
+            wall=result["wall"],
+            hook_ns=harness.percentiles(result["hook_ns"]),
+            hook_lines_per_second=result["lines"] / hook_seconds if hook_seconds else None,
+            event_ms=harness.percentiles(result["event_seconds"], 1000),
+            end_to_end_ms=harness.percentiles([seconds for _, seconds, _ in deliveries], 1000),
+            delivered=len(deliveries),
+            received=len(server.messages),
+            server_errors=server.errors,
+            server_resets=server.resets,
+            shutdown_seconds=shutdown,
+            queue=plugin.get_queue_stats(),
+            rss_growth=rss_after - rss_before if rss_before is not None else None,
+        )
+
+
+def measure_memory(trace, overrides=None):
+    """
+    Python allocations of the plugin during a replay, a separate run because tracing slows every allocation down
+    """
+    with FakeGotify() as server:
+        plugin = harness.create_plugin(server.url, overrides)
+        harness.settle()
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot()
+        harness.replay(plugin, trace)
+        harness.settle()
+        _, peak = tracemalloc.get_traced_memory()
+        retained = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, "filename"))
+        tracemalloc.stop()
+        harness.shutdown(plugin)
+    return dict(peak_bytes=peak, retained_bytes=retained)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=20000, help="gcode lines of the generated print")
+    parser.add_argument("--pauses", type=int, default=2)
+    parser.add_argument("--errors", type=int, default=1)
+    parser.add_argument("--trace", help="replay this trace instead of generating one")
+    parser.add_argument("--save-trace", help="write the generated trace to this file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake server takes per message")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0)
+    parser.add_argument("--pace", type=int, default=0, help="gcode lines per second, 0 for as fast as possible")
+    parser.add_argument("--quiet", action="store_true", help="only the notifications enabled by default")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.trace:
+        trace = harness.load_trace(args.trace)
+    else:
+        trace = harness.make_trace(args.lines, pauses=args.pauses, errors=args.errors)
+        if args.save_trace:
+            harness.save_trace(trace, args.save_trace)
+
+    overrides = None if args.quiet else harness.BUSY_EVENTS
+    results = dict(run=run(trace, args.latency, args.error_rate, args.reset_rate, args.pace, overrides))
+    if not args.no_memory:
+        results["memory"] = measure_memory(trace, overrides)
+    harness.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""
+Checks that event messages are validated when they are compiled, then compares rendering a compiled message with
+what the plugin did before: reading the message from the settings and formatting it with the locals of the handler.
+
+    python benchmarks/bench_render.py --iterations 100000
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import sys
+import timeit
+
+import harness
+from fake_gotify import FakeGotify
+from octoprint_gotify.messages import MessageTemplate, TemplateError, compile_templates, parse_fields
+
+PRINT_DONE = dict(file="benchmark.gcode", elapsed_time="1:02:03", elapsed_time_in_seconds=3723,
+                  throughput="", summary="20000 lines, 80 layers",
+                  payload=dict(name="benchmark.gcode", path="benchmark.gcode", origin="local", time=3723))
+
+
+def check_templates():
+    """
+    :return: list of the failed checks
+    """
+    failures = []
+
+    def rejects(event, source, reason):
+        try:
+            parse_fields(event, source)
+        except TemplateError as e:
+            if reason not in str(e):
+                failures.append("%r: expected %r in %r" % (source, reason, str(e)))
+        else:
+            failures.append("%r: was accepted for %s" % (source, event))
+
+    def accepts(event, source, fields):
+        try:
+            parsed = parse_fields(event, source)
+        except TemplateError as e:
+            failures.append("%r: was rejected for %s (%s)" % (source, event, e))
+            return
+        if parsed != frozenset(fields):
+            failures.append("%r: fields %r instead of %r" % (source, sorted(parsed), sorted(fields)))
+
+    accepts("PrintDone", "Done: {file} in {elapsed_time}", ("file", "elapsed_time"))
+    accepts("PrintDone", "{payload[name]} {payload.path} {{literal}}", ("payload",))
+    accepts("Progress", "{percentage:>3}%", ("percentage",))
+    rejects("PrintDone", "Done: {}", "positional")
+    rejects("PrintDone", "Done: {0}", "positional")
+    rejects("PrintDone", "Done: {0[name]}", "positional")
+    rejects("PrintDone", "Done: {percentage}", "unknown placeholder {percentage}")
+    rejects("Startup", "Hello {file}", "unknown placeholder {file}")
+    rejects("PrintDone", "Done: {file:{width}}", "nested")
+    rejects("PrintDone", "Done: {file", "")
+
+    templates = compile_templates(dict(PrintDone=dict(message="Done: {nope}")),
+                                  dict(PrintDone=dict(message="Done: {file}")))
+    if templates["PrintDone"].source != "Done: {file}":
+        failures.append("an invalid message did not fall back to the default")
+    if MessageTemplate("PrintDone", "{file}/{summary}").render(file="a") != "a/":
+        failures.append("a placeholder without a value did not render empty")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    failures = check_templates()
+    for failure in failures:
+        print("FAILED: %s" % failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.ERROR)
+    with FakeGotify() as server:
+        plugin = harness.create_plugin(server.url, start=False)
+        settings = plugin._settings
+
+        def settings_format():
+            # the message was looked up in the settings and formatted with the locals of the handler every time
+            return settings.get(["events", "PrintDone", "message"]).format(**PRINT_DONE)
+
+        def render_message():
+            return plugin.render_message("PrintDone", **PRINT_DONE)
+
+        if settings_format() != render_message():
+            print("FAILED: the compiled message renders differently", file=sys.stderr)
+            sys.exit(1)
+
+        results = dict(checks="passed", iterations=args.iterations)
+        for name, fn in (("settings_format_us", settings_format), ("render_message_us", render_message)):
+            results[name] = min(timeit.repeat(fn, number=args.iterations, repeat=3)) * 1e6 / args.iterations
+        results["speedup"] = results["settings_format_us"] / results["render_message_us"]
+        harness.shutdown(plugin)
+
+    harness.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
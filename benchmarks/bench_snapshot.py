@@ -0,0 +1,126 @@
+# coding=utf-8
+"""
+How much processing webcam snapshots delays OctoPrint's comm thread, with the Pillow work in the snapshot worker
+process and in the plugin. A thread stands in for the comm thread: it calls the gcode hook at a fixed pace and
+records the time per call and how late it wakes up for the next line, which is where waiting for the GIL shows. In
+the meantime snapshots of a large frame are processed back to back. Needs Pillow.
+
+The worker process runs the imports of the main script again, which is why this script imports everything in main().
+
+    python benchmarks/bench_snapshot.py --duration 5 --pace 1000
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import threading
+import time
+
+
+def make_frame(width, height):
+    """
+    :return: a JPEG frame with enough detail that decoding and encoding it is real work
+    """
+    import io
+    import random
+
+    from PIL import Image
+
+    rng = random.Random(0)
+    noise = bytes(rng.getrandbits(8) for _ in range((width // 8) * (height // 8) * 3))
+    image = Image.frombytes("RGB", (width // 8, height // 8), noise)
+    image = image.resize((width, height), Image.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def comm_thread(plugin, lines, pace, stop):
+    """
+    :return: (ns per hook call, seconds late for every line)
+    """
+    hook_ns = []
+    late = []
+    interval = 1.0 / pace
+    index = 0
+    next_line = time.monotonic()
+    while not stop.is_set():
+        now = time.monotonic()
+        if now < next_line:
+            time.sleep(next_line - now)
+            late.append(time.monotonic() - next_line)
+        cmd, gcode = lines[index % len(lines)]
+        start = time.perf_counter_ns()
+        plugin.sent_gcode(None, "sent", cmd, None, gcode)
+        hook_ns.append(time.perf_counter_ns() - start)
+        index += 1
+        next_line += interval
+    return hook_ns, late
+
+
+def run(harness, server, frame, lines, duration, pace, snapshots, pool):
+    plugin = harness.create_plugin(server.url, {("image",): snapshots, ("snapshot", "process_pool"): pool,
+                                                ("snapshot", "ttl"): 0, ("events", "Throughput", "stall"): 0})
+    # every snapshot is the same large frame, the webcam is not part of the measurement
+    plugin.get_frame_grabber = lambda: None
+    plugin.request_snapshot = lambda: frame
+    plugin.on_event("PrintStarted", dict(name="benchmark.gcode", path="benchmark.gcode", origin="local"))
+    if plugin.snapshot_pool is not None:
+        plugin.snapshot_pool.process(plugin.get_snapshot_processor(), frame)
+
+    stop = threading.Event()
+    processed = [0]
+
+    def process_snapshots():
+        while snapshots and not stop.is_set():
+            if plugin.fetch_snapshot() is not None:
+                processed[0] += 1
+
+    snapshot_thread = threading.Thread(target=process_snapshots)
+    snapshot_thread.start()
+    timer = threading.Timer(duration, stop.set)
+    timer.start()
+    hook_ns, late = comm_thread(plugin, lines, pace, stop)
+    snapshot_thread.join()
+
+    result = dict(
+        hook_ns=harness.percentiles(hook_ns),
+        late_ms=harness.percentiles(late, 1000),
+        lines=len(hook_ns),
+        snapshots_per_second=processed[0] / duration,
+    )
+    if plugin.snapshot_pool is not None:
+        result["pool"] = plugin.snapshot_pool.get_stats()
+    harness.shutdown(plugin)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5, help="seconds of every run")
+    parser.add_argument("--pace", type=int, default=1000, help="gcode lines per second on the comm thread")
+    parser.add_argument("--width", type=int, default=2592)
+    parser.add_argument("--height", type=int, default=1944)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    import harness
+    from fake_gotify import FakeGotify
+
+    logging.basicConfig(level=logging.ERROR)
+    frame = make_frame(args.width, args.height)
+    trace = harness.make_trace(20000, pauses=0, errors=0)
+    lines = [(step[1], step[2]) for step in trace if step[0] == "gcode" and step[2] != "M600"]
+
+    results = dict(frame_bytes=len(frame), pace=args.pace)
+    with FakeGotify() as server:
+        results["idle"] = run(harness, server, frame, lines, args.duration, args.pace, snapshots=False, pool=False)
+        results["in_plugin"] = run(harness, server, frame, lines, args.duration, args.pace, snapshots=True,
+                                   pool=False)
+        results["worker"] = run(harness, server, frame, lines, args.duration, args.pace, snapshots=True, pool=True)
+
+    harness.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+What the gcode throughput watchdog costs per line: the gcode hook while printing with the watchdog off and on, with
+its thread looking at the counter every --tick seconds meanwhile, plus the cost of one look spread over the lines
+sent in between at --rate lines per second. Exits with 1 when the watchdog costs more than --budget-ns per line.
+
+    python benchmarks/bench_watchdog.py --lines 100000 --rate 200 --budget-ns 500
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import sys
+import time
+
+import harness
+from bench_gcode import time_per_line
+from fake_gotify import FakeGotify
+
+PAYLOAD = dict(name="benchmark.gcode", path="benchmark.gcode", origin="local")
+
+
+def measure(server, lines, repeat, watchdog, tick):
+    overrides = {("events", "Throughput", "priority"): 1 if watchdog else 0,
+                 ("events", "Throughput", "stall"): 30,
+                 ("events", "PrintDone", "message"): "Done: {file}" if not watchdog else "Done: {file} {throughput}"}
+    plugin = harness.create_plugin(server.url, overrides)
+    plugin.watchdog.interval = tick
+    plugin.on_event("PrintStarted", PAYLOAD)
+    if plugin.watchdog.running != watchdog:
+        raise RuntimeError("the watchdog is %s" % ("off" if watchdog else "on"))
+
+    ns = time_per_line(plugin.sent_gcode, lines, repeat)
+
+    tick_ns = None
+    if watchdog:
+        # a look at the counter as the watchdog thread does it, every call sees new lines
+        plugin.watchdog.stop()
+        ticks = 10000
+        start = time.perf_counter_ns()
+        now = time.monotonic()
+        for index in range(ticks):
+            plugin.gcode_lines += 100
+            plugin.watchdog.tick(now + (index + 1) * tick)
+        tick_ns = (time.perf_counter_ns() - start) / float(ticks)
+
+    harness.shutdown(plugin)
+    return ns, tick_ns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tick", type=float, default=0.01,
+                        help="seconds between two looks of the watchdog thread, the plugin uses 2")
+    parser.add_argument("--rate", type=float, default=200, help="gcode lines per second of the print")
+    parser.add_argument("--budget-ns", type=float, default=500)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    trace = harness.make_trace(args.lines, pauses=0, errors=0)
+    # the M600 of the trace would send a filament change notification on every pass
+    lines = [(step[1], step[2]) for step in trace if step[0] == "gcode" and step[2] != "M600"]
+
+    with FakeGotify() as server:
+        off_ns, _ = measure(server, lines, args.repeat, False, args.tick)
+        on_ns, tick_ns = measure(server, lines, args.repeat, True, args.tick)
+
+    # the plugin looks every 2 seconds, the tick of this run is only shorter to make the thread show up in the hook
+    amortized_ns = tick_ns / (2.0 * args.rate)
+    results = dict(
+        lines=len(lines),
+        off_ns=off_ns,
+        on_ns=on_ns,
+        hook_ns=on_ns - off_ns,
+        tick_us=tick_ns / 1000,
+        tick_per_line_ns=amortized_ns,
+        per_line_ns=max(0.0, on_ns - off_ns) + amortized_ns,
+        budget_ns=args.budget_ns,
+    )
+    harness.write_results(results, args.output)
+
+    if results["per_line_ns"] > args.budget_ns:
+        print("FAILED: the watchdog costs %.0f ns per line, the budget is %.0f ns"
+              % (results["per_line_ns"], args.budget_ns), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Checks what loading the plugin costs OctoPrint's startup: the cumulative import time of the package from
+`python -X importtime`, the modules it pulls in on top of OctoPrint's own, the RSS that adds, and the threads initialize
+starts before on_after_startup. Heavy modules must only be imported where they are used, and the background threads
+only start after startup. Exits with 1 on a violation.
+
+    python benchmarks/check_import.py --max-import-ms 40
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import harness
+
+PACKAGE = "octoprint_gotify"
+# modules the plugin only needs once it sends, journals, processes snapshots or listens on the stream
+FORBIDDEN = ("requests", "urllib3", "sqlite3", "_sqlite3", "multiprocessing", "concurrent.futures.process", "asyncio",
+             "ssl", "PIL")
+
+
+def module_level_imports(path):
+    """
+    :return: names of the modules a source file imports when it is loaded, imports inside functions do not count
+    """
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), path)
+    names = []
+    statements = list(tree.body)
+    while statements:
+        node = statements.pop(0)
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            names.append(node.module)
+            names.extend("%s.%s" % (node.module, alias.name) for alias in node.names)
+        elif isinstance(node, (ast.If, ast.Try)):
+            # try/except ImportError and version checks still run on import
+            for field in ("body", "orelse", "finalbody", "handlers"):
+                for child in getattr(node, field, None) or ():
+                    statements.extend(child.body if isinstance(child, ast.ExceptHandler) else [child])
+    return names
+
+
+def is_forbidden(name):
+    return any(name == forbidden or name.startswith(forbidden + ".") for forbidden in FORBIDDEN)
+
+
+def check_sources():
+    """
+    OctoPrint imports some of the forbidden modules itself, the sources show whether the plugin would as well
+    :return: list of (file, module)
+    """
+    folder = os.path.join(harness.ROOT, PACKAGE)
+    found = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".py"):
+            found.extend((filename, name) for name in module_level_imports(os.path.join(folder, filename))
+                         if is_forbidden(name))
+    return found
+
+
+def child():
+    """
+    Runs under -X importtime, OctoPrint is imported first so only what the plugin adds is measured
+    """
+    import octoprint.plugin  # noqa: F401
+    import octoprint.settings  # noqa: F401
+    import octoprint.util  # noqa: F401
+
+    before = set(sys.modules)
+    rss_before = harness.rss_bytes()
+    __import__(PACKAGE)
+    rss_after = harness.rss_bytes()
+    added = sorted(set(sys.modules) - before)
+
+    threads = set(threading.enumerate())
+    plugin = harness.create_plugin("http://127.0.0.1:9", start=False)
+    started = sorted(thread.name for thread in set(threading.enumerate()) - threads)
+    harness.shutdown(plugin)
+
+    print(json.dumps(dict(
+        modules=len(added),
+        forbidden_modules=[name for name in added if is_forbidden(name)],
+        rss_bytes=rss_after - rss_before if rss_before is not None else None,
+        threads_after_initialize=started,
+    )))
+
+
+def import_ms(stderr):
+    """
+    :return: cumulative milliseconds of the import of the package, from the output of -X importtime
+    """
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) == 3 and fields[2].strip() == PACKAGE:
+            return int(fields[1]) / 1000.0
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-import-ms", type=float, default=40,
+                        help="budget for the cumulative import time of the package")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters, the fastest import counts")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    results = None
+    timings = []
+    for _ in range(max(1, args.runs)):
+        process = subprocess.run([sys.executable, "-X", "importtime", os.path.abspath(__file__), "--child"],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                 check=True)
+        results = json.loads(process.stdout.strip().splitlines()[-1])
+        timings.append(import_ms(process.stderr))
+
+    results["import_ms"] = min(timing for timing in timings if timing is not None) if any(timings) else None
+    results["source_imports"] = ["%s: %s" % found for found in check_sources()]
+    harness.write_results(results, args.output)
+
+    violations = []
+    if results["import_ms"] is None or results["import_ms"] > args.max_import_ms:
+        violations.append("import took %s ms, the budget is %s ms" % (results["import_ms"], args.max_import_ms))
+    if results["forbidden_modules"] or results["source_imports"]:
+        violations.append("heavy modules are imported with the plugin")
+    if results["threads_after_initialize"]:
+        violations.append("initialize started threads before on_after_startup")
+    for violation in violations:
+        print("FAILED: %s" % violation, file=sys.stderr)
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
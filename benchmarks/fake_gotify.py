@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+In-process stand-in for a gotify server. It takes messages the way gotify does and can be told to answer slowly, to
+answer with errors or to reset connections, so the benchmarks see what a struggling server does to the plugin.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGotify(object):
+    """
+    Serves POST /message and GET /version on localhost. Every received message is kept with the monotonic time it
+    arrived.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, reset_rate=0.0, seed=0):
+        """
+        :param latency: seconds before a message is answered, or a callable receiving the payload and returning them
+        :param error_rate: share of the messages answered with a 500
+        :param reset_rate: share of the messages whose connection is reset without an answer
+        :param seed: of the random errors and resets, the same seed fails the same messages
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._received = threading.Condition(self._lock)
+        self._server = None
+        self._thread = None
+
+        # (monotonic time, payload) of every accepted message
+        self.messages = []
+        self.errors = 0
+        self.resets = 0
+        self.versions = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def start(self):
+        gotify = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/version":
+                    return self._answer(404, dict(error="Not Found"))
+                with gotify._lock:
+                    gotify.versions += 1
+                self._answer(200, dict(version="2.4.0", commit="fake", buildDate=""))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self.path.split("?")[0] != "/message":
+                    return self._answer(404, dict(error="Not Found"))
+                payload = json.loads(body.decode("utf-8")) if body else {}
+
+                with gotify._lock:
+                    roll = gotify._random.random()
+                    if roll < gotify.reset_rate:
+                        gotify.resets += 1
+                        outcome = "reset"
+                    elif roll < gotify.reset_rate + gotify.error_rate:
+                        gotify.errors += 1
+                        outcome = "error"
+                    else:
+                        outcome = "ok"
+
+                if outcome == "reset":
+                    # close with a RST instead of a FIN
+                    self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                    self.close_connection = True
+                    return
+
+                latency = gotify.latency(payload) if callable(gotify.latency) else gotify.latency
+                if latency:
+                    time.sleep(latency)
+                if outcome == "error":
+                    return self._answer(500, dict(error="Internal Server Error"))
+
+                with gotify._received:
+                    gotify.messages.append((time.monotonic(), payload))
+                    message_id = len(gotify.messages)
+                    gotify._received.notify_all()
+                self._answer(200, dict(id=message_id, appid=1, message=payload.get("message"),
+                                       title=payload.get("title"), priority=payload.get("priority")))
+
+            def _answer(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeGotify")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def wait_for(self, count, timeout=30):
+        """
+        :param count: number of accepted messages to wait for
+        :param timeout:
+        :return: True when that many arrived in time
+        """
+        with self._received:
+            return self._received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
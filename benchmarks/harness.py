@@ -0,0 +1,307 @@
+# coding=utf-8
+"""
+Runs the plugin in-process, without OctoPrint around it, against the fake gotify server. The settings are real
+OctoPrint settings in a temporary folder, the printer, file manager and plugin manager are stand-ins. A print is a
+trace of steps which can be generated, saved and replayed, so two runs of a benchmark see the same print.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gc
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+# settings which turn on a notification for most of what happens during a print, every percent of progress included
+BUSY_EVENTS = {
+    ("events", "Progress", "mod"): 1,
+    ("events", "Scheduled", "priority"): "1",
+    ("events", "PrintStarted", "priority"): "4",
+    ("events", "PrintDone", "priority"): "4",
+    ("events", "PrintPaused", "priority"): 4,
+    ("events", "FilamentChange", "priority"): 8,
+    ("events", "ZChange", "priority"): "4",
+    ("events", "TempReached", "priority"): "1",
+}
+
+
+class FakePrinter(object):
+    def __init__(self):
+        self.paused = False
+        self.printing = False
+        self.filepos = 0
+        self.completion = 0
+
+    def is_printing(self):
+        return self.printing and not self.paused
+
+    def is_paused(self):
+        return self.paused
+
+    def is_pausing(self):
+        return False
+
+    def pause_print(self):
+        self.paused = True
+
+    def resume_print(self):
+        self.paused = False
+
+    def cancel_print(self):
+        self.printing = False
+
+    def get_current_data(self):
+        return dict(progress=dict(filepos=self.filepos, completion=self.completion))
+
+
+class FakeFileManager(object):
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path_on_disk(self, storage, path):
+        return os.path.join(self.folder, path)
+
+
+class FakePluginManager(object):
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+def get_settings(basedir=None):
+    """
+    :return: the OctoPrint settings, created in a temporary folder on the first call
+    """
+    import octoprint.settings
+
+    try:
+        return octoprint.settings.settings()
+    except ValueError:
+        return octoprint.settings.settings(init=True, basedir=basedir or tempfile.mkdtemp(prefix="gotify-bench-"))
+
+
+def create_plugin(url, overrides=None, start=True):
+    """
+    :param url: base url of the gotify server
+    :param overrides: dict of settings path (tuple) -> value, e.g. {("queue", "size"): 8}
+    :param start: run on_after_startup as well
+    :return: an initialized GotifyPlugin
+    """
+    import octoprint.plugin
+    import octoprint_gotify
+
+    settings = get_settings()
+    plugin = octoprint_gotify.GotifyPlugin()
+    plugin._identifier = "gotify"
+    plugin._plugin_name = "Gotify"
+    plugin._plugin_version = "benchmark"
+    plugin._basefolder = os.path.dirname(os.path.abspath(octoprint_gotify.__file__))
+    plugin._logger = logging.getLogger("octoprint.plugins.gotify")
+    plugin._data_folder = tempfile.mkdtemp(prefix="gotify-data-")
+    plugin._printer = FakePrinter()
+    plugin._printer_profile_manager = None
+    plugin._file_manager = FakeFileManager(plugin._data_folder)
+    plugin._plugin_manager = FakePluginManager()
+    plugin._settings = octoprint.plugin.PluginSettings(settings, "gotify", defaults=plugin.get_settings_defaults())
+
+    values = {("gotify_server_base_url",): url, ("token",): "benchmark", ("image",): False}
+    values.update(overrides or {})
+    for path, value in values.items():
+        plugin._settings.set(list(path), value)
+
+    plugin.initialize()
+    if start:
+        plugin.on_after_startup()
+    return plugin
+
+
+def shutdown(plugin):
+    """
+    Stop the plugin the way OctoPrint does
+    :return: seconds the Shutdown event took
+    """
+    start = time.monotonic()
+    plugin.on_event("Shutdown", {})
+    return time.monotonic() - start
+
+
+def track_deliveries(plugin):
+    """
+    Record the time from the event to the answer of the gotify server for every delivered notification
+    :return: list which receives (event, seconds, express) tuples
+    """
+    deliveries = []
+    send_message = plugin.send_message
+
+    def tracked(target, notification, payload, express=False):
+        delivered = send_message(target, notification, payload, express)
+        if delivered:
+            deliveries.append((notification.event, time.monotonic() - notification.created, express))
+        return delivered
+
+    plugin.send_message = tracked
+    return deliveries
+
+
+def make_trace(lines=20000, pauses=2, errors=1, layer_lines=250, name="benchmark.gcode", seed=0):
+    """
+    A print from PrintStarted to PrintDone: gcode lines with layer changes, temperature reports, progress 1 to 100,
+    pauses, errors and a filament change
+    :param lines: number of gcode lines sent
+    :param pauses: number of pauses, spread evenly
+    :param errors: number of Error events, at random lines
+    :param layer_lines: gcode lines per layer
+    :param name:
+    :param seed:
+    :return: list of steps, each a list starting with the kind of step
+    """
+    rnd = random.Random(seed)
+    pause_at = set(lines * (index + 1) // (pauses + 1) for index in range(pauses))
+    error_at = set(rnd.randrange(1, lines) for _ in range(errors))
+    filament_at = lines // 2
+
+    trace = [["event", "PrintStarted", dict(name=name, path=name, origin="local", size=lines * 30)]]
+    progress = 0
+    layer = 1
+    for line in range(1, lines + 1):
+        if line % layer_lines == 0:
+            layer += 1
+            trace.append(["gcode", "G1 Z%.2f F600" % (layer * 0.2), "G1"])
+            trace.append(["event", "ZChange", dict(old=(layer - 1) * 0.2, new=layer * 0.2)])
+        elif line == filament_at:
+            trace.append(["gcode", "M600", "M600"])
+        elif line % 1000 == 0:
+            trace.append(["gcode", "M117 Layer %d" % layer, "M117"])
+        else:
+            trace.append(["gcode", "G1 X%.3f Y%.3f E%.5f" % (rnd.uniform(0, 220), rnd.uniform(0, 220),
+                                                             rnd.uniform(0, 0.1)), "G1"])
+
+        if line % 100 == 0:
+            trace.append(["temps", {"T0": [rnd.uniform(209, 211), 210.0], "B": [rnd.uniform(59.5, 60.5), 60.0]}])
+        if line * 100 // lines > progress:
+            progress = line * 100 // lines
+            trace.append(["progress", progress, line * 30])
+        if line in pause_at:
+            trace.append(["event", "PrintPaused", dict(name=name, path=name, origin="local")])
+            trace.append(["event", "PrintResumed", dict(name=name, path=name, origin="local")])
+        if line in error_at:
+            trace.append(["event", "Error", dict(error="Printer reported an error")])
+
+    trace.append(["event", "PrintDone", dict(name=name, path=name, origin="local", time=lines / 50.0)])
+    return trace
+
+
+def save_trace(trace, path):
+    with io.open(path, "w", encoding="utf-8") as f:
+        for step in trace:
+            f.write(json.dumps(step) + "\n")
+
+
+def load_trace(path):
+    with io.open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(plugin, trace, pace=0):
+    """
+    Feed a trace to the plugin the way OctoPrint would, in the calling thread
+    :param plugin:
+    :param trace:
+    :param pace: gcode lines per second, 0 for as fast as possible
+    :return: dict with the nanoseconds of every gcode hook call, the seconds of every event and the wall time
+    """
+    printer = plugin._printer
+    sent_gcode = plugin.sent_gcode
+    on_event = plugin.on_event
+    perf_counter_ns = time.perf_counter_ns
+    hook_ns = []
+    event_seconds = []
+    lines = 0
+
+    start = time.monotonic()
+    for step in trace:
+        kind = step[0]
+        if kind == "gcode":
+            begin = perf_counter_ns()
+            sent_gcode(None, "sent", step[1], None, step[2])
+            hook_ns.append(perf_counter_ns() - begin)
+            lines += 1
+            if pace and lines % 100 == 0:
+                delay = start + lines / float(pace) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        elif kind == "event":
+            event = step[1]
+            if event == "PrintStarted":
+                printer.printing = True
+            elif event == "PrintPaused":
+                printer.paused = True
+            elif event == "PrintResumed":
+                printer.paused = False
+            elif event in ("PrintDone", "PrintFailed"):
+                printer.printing = False
+            begin = time.perf_counter()
+            on_event(event, dict(step[2]))
+            event_seconds.append(time.perf_counter() - begin)
+        elif kind == "progress":
+            printer.completion = step[1]
+            printer.filepos = step[2]
+            plugin.on_print_progress("local", "benchmark.gcode", step[1])
+        elif kind == "temps":
+            plugin.temperatures_received(None, dict((key, tuple(value)) for key, value in step[1].items()))
+
+    return dict(hook_ns=hook_ns, event_seconds=event_seconds, lines=lines, wall=time.monotonic() - start)
+
+
+def percentiles(values, scale=1):
+    """
+    :param values: samples
+    :param scale: factor applied to every result
+    :return: dict with count, mean, p50, p95, p99 and max
+    """
+    if not values:
+        return dict(count=0)
+    ordered = sorted(values)
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * scale
+
+    return dict(count=len(ordered), mean=sum(ordered) * scale / len(ordered), p50=at(0.5), p95=at(0.95),
+                p99=at(0.99), max=ordered[-1] * scale)
+
+
+def rss_bytes():
+    """
+    :return: the resident set size of this process, None where /proc is missing
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def settle(seconds=0.2):
+    gc.collect()
+    time.sleep(seconds)
+
+
+def write_results(results, path=None):
+    """
+    :param results: JSON serializable
+    :param path: file to write the results to, stdout when None
+    """
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path is None:
+        print(text)
+        return
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
@@ -1,20 +1,34 @@
 # coding=utf-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
 import os
+from types import MappingProxyType
 from typing import Optional
-import flask
-import json
+import logging
 import octoprint.plugin
-import octoprint.plugin
-import requests
-from requests.exceptions import HTTPError
 import datetime
+import threading
+import time
+import uuid
 import octoprint.util
-from io import StringIO, BytesIO
-from PIL import Image
-from flask_login import current_user
-from octoprint.util import RepeatedTimer
+
+from .control import ControlStream
+from .diagnostics import diagnose
+from . import history
+from .job import PrintJob, save_job
+from .layers import LayerIndexer
+from .metrics import Metrics
+from .messages import TemplateError, compile_templates, parse_fields
+from .outbox import Outbox
+from .sender import OVERFLOW_DROP_OLDEST, Notification
+from .session import create_session
+from .throttle import Throttle
+from .targets import DEFAULT_TARGET, Target
+from .thumbnails import ThumbnailCache
+from .watchdog import STALL, ThroughputMonitor
+from .snapshot import SnapshotCache, SnapshotPool, SnapshotProcessor, to_data_uri
+from .stream import MjpegGrabber
 
 __author__ = "Alwin Lohrie <alwin@cloudserver.click>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
@@ -22,6 +36,36 @@ __copyright__ = "Released under terms of the AGPLv3 License"
 __plugin_name__ = "Gotify"
 __plugin_pythoncompat__ = ">=2.7,<4"
 
+# gcodes the gcode.sent hook acts on, everything else returns right away. The hook reads the module constants, they are
+# cheaper to look up than class attributes
+INTERESTING_GCODES = frozenset(["M600", "M70", "M117", "M0", "M1", "M109", "M190", "M191", "M226", "M400", "G4"])
+# gcodes the printer does not take further lines during, a gap after them is no stall
+BLOCKING_GCODES = frozenset(["M600", "M0", "M1", "M109", "M190", "M191", "M226", "M400", "G4"])
+# one line in GCODE_SAMPLE_MASK + 1 is timed by the gcode hook
+GCODE_SAMPLE_MASK = 0x3f
+
+
+def freeze(value):
+    """
+    Return a read only copy of a nested settings structure
+    """
+    if isinstance(value, dict):
+        return MappingProxyType(dict((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    Return a mutable copy of a structure created by freeze
+    """
+    if isinstance(value, MappingProxyType):
+        return dict((k, thaw(v)) for k, v in value.items())
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
 
 class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
                    octoprint.plugin.SettingsPlugin,
@@ -32,15 +76,87 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
                    octoprint.plugin.ProgressPlugin,
                    octoprint.plugin.OctoPrintPlugin):
     m70_cmd = ""
-    printing = False
-    start_time = None
-    last_minute = 0
-    last_progress = 0
-    first_layer = False
-    timer = None
-    bed_sent = False
-    e1_sent = False
-    progress = 0
+    # the print in progress, None while not printing
+    job = None
+    # the print which ended last, its PrintDone or PrintFailed notification still belongs to it
+    last_job = None
+    # monotonic clock value of the next scheduled notification, the gcode hook only compares against it
+    next_minute_at = None
+    layer_mod = 0
+    layer_indexer = None
+    # heater -> target temperature a notification was already sent for
+    temp_notified = None
+    # heater -> (actual, target), only kept up to date while TempReached is enabled
+    temperatures = None
+    # settings used on the comm thread, cached by refresh_settings_cache
+    # built once by the first call of get_settings_defaults, shared by all instances
+    settings_defaults = None
+    default_events = None
+    message_templates = {}
+    # events on_event acts on, their handlers (None for plain messages) and their priorities
+    dispatch_events = frozenset()
+    event_handlers = {}
+    event_priorities = {}
+    schedule_mod = 0
+    schedule_priority = None
+    image_enabled = False
+    prefetch_lead = None
+    temp_enabled = False
+    temp_hysteresis = 0
+    # size, overflow policy and shed priority of the queue of every target
+    queue_config = (32, OVERFLOW_DROP_OLDEST, 0)
+    throttle = None
+    outbox = None
+    # every notification attempt in a SQLite database, None when disabled
+    history = None
+    metrics = None
+    # notifications of at least this priority skip the queue, None when there is no express lane
+    express_priority = None
+    # events which always skip the queue, whatever their priority
+    express_events = frozenset()
+    # seconds from the event to the delivery the express lane aims for
+    express_slo = None
+    # keeps the express connections of the targets open
+    express_timer = None
+    # lines seen by the gcode hook
+    gcode_lines = 0
+    # number of the last line the printer blocks on, e.g. while heating
+    gcode_hold_at = None
+    # watches the lines per second while printing, only started when an alert or the PrintDone message needs it
+    watchdog = None
+    watchdog_enabled = False
+    session = None
+    snapshot_processor = None
+    snapshot_cache = None
+    # worker process for the snapshot processing, None to process in the target worker threads
+    snapshot_pool = None
+    # keeps the latest frame of the webcam stream, None when disabled
+    frame_grabber = None
+    thumbnail_cache = None
+    prefetch_timer = None
+    # name -> Target, the gotify servers notifications are delivered to
+    targets = {}
+    targets_config = None
+    # replaced targets still delivering their backlog
+    retired_targets = ()
+    # listens for commands posted to the control application
+    control = None
+    control_config = None
+    timeout = None
+    # job id -> result of the test notifications and connection diagnostics, the most recent ones only
+    jobs = None
+    max_jobs = 20
+    # events whose handlers keep track of the print, they run even when no notification is sent
+    state_events = frozenset(["PrintStarted", "PrintDone", "PrintFailed", "PrintPaused", "PrintResumed", "ZChange",
+                              "Shutdown"])
+    # events which end a print job, their notifications still belong to it
+    job_end_events = frozenset(["PrintDone", "PrintFailed"])
+    # events which keep the layer indexes of the uploaded files up to date
+    file_events = frozenset(["FileAdded", "UpdatedFiles"])
+    # events which fall back to the thumbnail of the printed file when there is no webcam snapshot
+    thumbnail_events = frozenset(["PrintStarted", "PrintDone"])
+    # temperature keys as parsed by the comm layer -> heater names as used in the rest of OctoPrint
+    heater_names = {"B": "bed", "C": "chamber", "T": "tool0"}
     emoji = {
         'rocket': u'\U0001F680',
         'clock': u'\U000023F0',
@@ -54,6 +170,316 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         'waving_hand_sign': u'\U0001f44b',
     }
 
+    def initialize(self):
+        self.metrics = Metrics()
+        self.jobs = collections.OrderedDict()
+        self.layer_indexer = LayerIndexer(os.path.join(self.get_plugin_data_folder(), "layers"), logger=self._logger)
+        self.thumbnail_cache = ThumbnailCache(logger=self._logger)
+        self.watchdog = ThroughputMonitor(lambda: self.gcode_lines, self.gcode_holding, self.throughput_alert,
+                                          logger=self._logger)
+        self.temp_notified = {}
+        self.temperatures = {}
+        self.snapshot_cache = SnapshotCache(self.fetch_snapshot, logger=self._logger)
+        self.throttle = Throttle(self.queue_notification, on_suppress=self.notification_suppressed,
+                                 logger=self._logger)
+        self.refresh_settings_cache()
+        self.rebuild_session()
+        self.rebuild_targets()
+
+        if self._settings.get_boolean(["outbox", "enabled"]):
+            self.outbox = Outbox(self.get_plugin_data_folder(),
+                                 max_bytes=self._settings.get_int(["outbox", "max_bytes"]),
+                                 max_age=self._settings.get_int(["outbox", "max_age"]),
+                                 retry_interval=self._settings.get_int(["outbox", "retry_interval"]),
+                                 on_tick=self.metrics.timer_tick.observe,
+                                 logger=self._logger)
+
+        if self._settings.get_boolean(["history", "enabled"]):
+            # the writer starts after startup, attempts before that wait in memory
+            self.history = history.History(self.get_plugin_data_folder(),
+                                           retention_days=self._settings.get_int(["history", "retention_days"]),
+                                           max_rows=self._settings.get_int(["history", "max_rows"]),
+                                           logger=self._logger)
+
+    def refresh_settings_cache(self):
+        """
+        Read the settings needed by the gcode hook once, instead of on every line, and compile the event messages
+        :return:
+        """
+        events = self._settings.get(["events"], merged=True) or {}
+        self.message_templates = compile_templates(events, self.get_default_events(), self._logger)
+        try:
+            self.layer_mod = int(self._settings.get(["events", "Layer", "mod"]) or 0)
+        except ValueError:
+            self.layer_mod = 0
+        self.refresh_dispatch_table(events)
+        self.queue_config = (self._settings.get_int(["queue", "size"]) or 32, self._settings.get(["queue", "overflow"]),
+                             self._settings.get_int(["queue", "shed_priority"]))
+        for target in self.targets.values():
+            target.configure(*self.queue_config)
+        self.express_priority = self._settings.get_int(["express", "min_priority"]) \
+            if self._settings.get_boolean(["express", "enabled"]) else None
+        self.express_events = frozenset(self._settings.get(["express", "events"]) or ()) \
+            if self.express_priority is not None else frozenset()
+        self.express_slo = self._settings.get_float(["express", "slo"])
+        self.throttle.configure(self.get_event_limits(events))
+        try:
+            self.schedule_mod = int(self._settings.get(["events", "Scheduled", "mod"]) or 0)
+        except ValueError:
+            self.schedule_mod = 0
+        self.schedule_priority = self._settings.get(["events", "Scheduled", "priority"])
+        self.image_enabled = self._settings.get_boolean(["image"])
+        self.prefetch_lead = self._settings.get_float(["snapshot", "prefetch_lead"]) \
+            if self._settings.get_boolean(["snapshot", "prefetch"]) else None
+        self.snapshot_cache.ttl = self._settings.get_float(["snapshot", "ttl"]) or 0
+        self.thumbnail_cache.max_width = self._settings.get_int(["snapshot", "max_width"])
+        self.thumbnail_cache.max_height = self._settings.get_int(["snapshot", "max_height"])
+        self.snapshot_cache.invalidate()
+        self.configure_snapshot_pool()
+        self.watchdog.min_rate = self._settings.get_float(["events", "Throughput", "min_rate"]) or 0
+        self.watchdog.stall = self._settings.get_float(["events", "Throughput", "stall"]) or 0
+        self.watchdog_enabled = bool(self.event_priorities.get("Throughput")
+                                     and (self.watchdog.min_rate or self.watchdog.stall)) \
+            or "throughput" in self.message_templates["PrintDone"].fields
+        self.temp_enabled = bool(self._settings.get(["events", "TempReached", "priority"]))
+        self.temp_hysteresis = self._settings.get_float(["events", "TempReached", "hysteresis"]) or 0
+        if not self.temp_enabled:
+            self.temperatures = {}
+        self.arm_schedule()
+
+    def refresh_dispatch_table(self, events):
+        """
+        Decide once which events on_event has to look at, and how to handle them
+        :param events: the events settings
+        :return:
+        """
+        priorities = {}
+        for event, default in self.get_default_events().items():
+            if default.get("custom"):
+                # not an OctoPrint event, sent by the plugin itself
+                continue
+            priority = (events.get(event) or {}).get("priority", default.get("priority"))
+            if priority:
+                priorities[event] = priority
+
+        dispatch_events = frozenset(priorities) | self.state_events | self.file_events
+        self.event_handlers = dict((event, getattr(self, event, None)) for event in dispatch_events)
+        self.event_priorities = priorities
+        self.dispatch_events = dispatch_events
+
+    def get_event_limits(self, events):
+        """
+        :param events: the events settings
+        :return: dict of event -> (rate limit per minute, coalescing window in seconds)
+        """
+        limits = {}
+        for event, default in self.get_default_events().items():
+            values = events.get(event) or {}
+            try:
+                limits[event] = (float(values.get("rate_limit", default.get("rate_limit")) or 0),
+                                 float(values.get("coalesce", default.get("coalesce")) or 0))
+            except ValueError:
+                self._logger.warning("Invalid rate limit or coalescing window for event %s, ignoring it" % event)
+        return limits
+
+    def arm_schedule(self):
+        """
+        Compute the next minute boundary the gcode hook has to wake up for, or None when there is nothing to schedule
+        :return:
+        """
+        job = self.job
+        if job is None or not self.schedule_mod:
+            self.next_minute_at = None
+            return
+
+        now = time.monotonic()
+        job.last_minute = int((now - job.start_monotonic) // 60)
+        self.next_minute_at = job.start_monotonic + (job.last_minute + 1) * 60
+
+        if (job.last_minute + 1) % self.schedule_mod == 0:
+            self.schedule_prefetch(self.next_minute_at - now)
+
+    def schedule_prefetch(self, delay):
+        """
+        Warm the snapshot cache shortly before a notification which is known in advance
+        :param delay: seconds until the notification is expected
+        :return:
+        """
+        if self.prefetch_lead is None or not self.image_enabled:
+            return
+
+        if self.prefetch_timer is not None:
+            self.prefetch_timer.cancel()
+        self.prefetch_timer = threading.Timer(max(0, delay - self.prefetch_lead), self.snapshot_cache.prefetch)
+        self.prefetch_timer.daemon = True
+        self.prefetch_timer.start()
+
+    def rebuild_session(self):
+        """
+        (Re)create the pooled http session used for the webcam snapshots
+        :return:
+        """
+        old_session = self.session
+
+        self.session = self.create_session()
+        self.timeout = (self._settings.get_float(["http", "connect_timeout"]),
+                        self._settings.get_float(["http", "read_timeout"]))
+
+        if old_session is not None:
+            old_session.close()
+
+    def create_session(self):
+        return create_session(pool_size=self._settings.get_int(["http", "pool_size"]) or 1,
+                              retries=self._settings.get_int(["http", "retries"]) or 0,
+                              backoff_factor=self._settings.get_float(["http", "backoff_factor"]) or 0)
+
+    def create_express_session(self):
+        """
+        :return: session for the express lane of a target, None when there is no express lane
+        """
+        if not self._settings.get_boolean(["express", "enabled"]):
+            return None
+        # one connection, and retries right away instead of backing off, the notification is due now
+        return create_session(pool_size=1, retries=self._settings.get_int(["http", "retries"]) or 0, backoff_factor=0)
+
+    def get_targets_config(self):
+        return (self.get_base_url(), self.get_token(), self._settings.get(["targets"]),
+                self._settings.get(["http"], merged=True), self._settings.get(["express"], merged=True))
+
+    def rebuild_targets(self):
+        """
+        (Re)create the delivery targets: the gotify server of the general settings plus the additional targets, each
+        with its own pooled session
+        :return:
+        """
+        old_targets = self.targets
+        queue_size, overflow, shed_priority = self.queue_config
+
+        targets = collections.OrderedDict()
+        if self.get_base_url():
+            targets[DEFAULT_TARGET] = Target(DEFAULT_TARGET, self.get_base_url(), self.get_token(),
+                                             self.create_session(), self.deliver_notification, queue_size=queue_size,
+                                             overflow=overflow, shed_priority=shed_priority,
+                                             on_drop=self.notification_dropped,
+                                             express_session=self.create_express_session(), logger=self._logger)
+
+        for index, config in enumerate(self._settings.get(["targets"]) or []):
+            if not isinstance(config, dict) or not config.get("url") or not config.get("token"):
+                self._logger.warning("Gotify target %d needs an url and a token, ignoring it" % (index + 1))
+                continue
+            if not config.get("enabled", True):
+                continue
+            name = config.get("name") or "target%d" % (index + 1)
+            if name in targets:
+                self._logger.warning("There is more than one gotify target named %s, ignoring the others" % name)
+                continue
+            targets[name] = Target(name, config["url"], config["token"], self.create_session(),
+                                   self.deliver_notification, events=config.get("events"),
+                                   priorities=config.get("priorities"), queue_size=queue_size, overflow=overflow,
+                                   shed_priority=shed_priority, on_drop=self.notification_dropped,
+                                   express_session=self.create_express_session(), logger=self._logger)
+
+        for target in targets.values():
+            target.start()
+        self.targets = targets
+        self.targets_config = self.get_targets_config()
+
+        for target in old_targets.values():
+            # what is still queued for the old targets is delivered in the background, their sessions are closed then
+            target.close()
+        self.retired_targets = [target for target in self.retired_targets if not target.closed] + \
+            [target for target in old_targets.values() if not target.closed]
+
+    def arm_express_timer(self):
+        """
+        Warm up the express connections now and keep them open, servers and proxies close idle connections after a
+        while
+        :return:
+        """
+        if self.express_timer is not None:
+            self.express_timer.cancel()
+            self.express_timer = None
+        keepalive = self._settings.get_float(["express", "keepalive"])
+        if not any(target.express_session is not None for target in self.targets.values()) or not keepalive:
+            return
+        self.express_timer = octoprint.util.RepeatedTimer(keepalive, self.warm_targets, args=(keepalive,),
+                                                          run_first=True, daemon=True)
+        self.express_timer.start()
+
+    def warm_targets(self, idle):
+        for target in list(self.targets.values()):
+            target.warm(self.timeout, idle)
+
+    def get_control_config(self):
+        return (self.get_base_url(), self._settings.get(["control"], merged=True))
+
+    def rebuild_control(self):
+        """
+        (Re)connect to the gotify stream when remote control is enabled
+        :return:
+        """
+        if self.control is not None:
+            self.control.stop(timeout=1)
+            self.control = None
+        self.control_config = self.get_control_config()
+
+        base_url, config = self.control_config
+        if not config.get("enabled"):
+            return
+        if not base_url or not config.get("client_token") or not config.get("app_id"):
+            self._logger.warning("Remote control needs the gotify server, a client token and the id of the control "
+                                 "application")
+            return
+
+        try:
+            self.control = ControlStream(base_url, config["client_token"], config["app_id"], self.run_command,
+                                         commands=config.get("commands") or (), logger=self._logger)
+        except ValueError as e:
+            self._logger.warning("Could not set up remote control: %s" % str(e))
+            return
+        self.control.start()
+
+    def run_command(self, command, message):
+        """
+        Run a command received from the control application, called on the worker thread of the control stream
+        :param command: one of the allowed commands
+        :param message: the gotify message
+        :return:
+        """
+        self._logger.info("Received the command %s from gotify" % command)
+
+        if command == "pause":
+            if not self._printer.is_printing():
+                return self.reply("Not pausing, the printer is not printing")
+            self._printer.pause_print()
+            return self.reply("Pausing the print")
+
+        if command == "resume":
+            if not self._printer.is_paused():
+                return self.reply("Not resuming, the print is not paused")
+            self._printer.resume_print()
+            return self.reply("Resuming the print")
+
+        if command == "cancel":
+            if not self._printer.is_printing() and not self._printer.is_paused():
+                return self.reply("Not cancelling, the printer is not printing")
+            self._printer.cancel_print()
+            return self.reply("Cancelling the print")
+
+        if command == "snapshot":
+            progress = (self._printer.get_current_data().get("progress") or {}).get("completion")
+            return self.reply("Snapshot" if progress is None else "Snapshot at %d%%" % progress, image=True)
+
+        self.reply("Unknown command %s" % command)
+
+    def reply(self, message, image=False):
+        self.event_message(dict(message=message, priority=self._settings.get(["control", "priority"])), "Control",
+                           image=image)
+
+    def get_base_url(self):
+        base_url = self._settings.get(["gotify_server_base_url"])
+        return base_url.rstrip("/") if base_url else base_url
+
     def get_emoji(self, key):
         if key in self.emoji:
             return self.emoji[key]
@@ -66,108 +492,404 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
 
     def get_api_commands(self):
         return dict(
-            test=["app_token"]
+            test=[],
+            diagnose=[]
         )
 
     def on_api_command(self, command, data):
+        """
+        The test notification and the connection diagnostics run in the background, the response only carries the job
+        id. The result is sent as a plugin message and can be polled with GET ?job=<id>.
+        """
+        import flask
+
         if command == "test":
             self._logger.debug("sending gotify test message")
-            if not data["app_token"]:
-                data["app_token"] = self.get_token()
+            return flask.jsonify(self.start_job(self.run_test, bool(data.get("image"))))
+        if command == "diagnose":
+            target = self.targets.get(data.get("target") or DEFAULT_TARGET)
+            if target is None:
+                return flask.make_response("Unknown gotify target", 400)
+            return flask.jsonify(self.start_job(self.run_diagnostics, target.url))
+        return flask.make_response("Unknown command", 400)
+
+    def start_job(self, run, *args):
+        job = dict(job=uuid.uuid4().hex, state="running")
+        self.jobs[job["job"]] = job
+        while len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+
+        thread = threading.Thread(target=self.run_job, args=(job, run) + args, name="GotifyJob")
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def run_job(self, job, run, *args):
+        try:
+            job.update(run(*args))
+        except Exception as e:
+            self._logger.exception("Error in gotify job")
+            job.update(success=False, error=str(e))
+        job["state"] = "done"
+        self._plugin_manager.send_plugin_message(self._identifier, dict(job, type="job"))
 
-            # When we are testing the token, create a test notification
-            payload = {
-                "title": "OctoPrint push test",
-                "message": u''.join([u"pewpewpew!! OctoPrint works. ", self.get_emoji("rocket")]),
-            }
+    def run_test(self, image):
+        """
+        Send a test notification to every target right away, bypassing the throttle, queue and outbox
+        :param image:
+        :return: the outcome per target
+        """
+        if not self.targets:
+            return dict(kind="test", success=False, error="No gotify server configured")
 
-            # Validate the user key and send a message
+        payload = {
+            "title": self.get_title("OctoPrint push test"),
+            "message": u''.join([u"pewpewpew!! OctoPrint works. ", self.get_emoji("rocket")]),
+        }
+        notification = Notification(None, payload, 0, image)
+        payload = self.prepare_payload(notification)
+
+        results = collections.OrderedDict()
+        for name, target in list(self.targets.items()):
+            start = time.monotonic()
+            delivered, status, error = self.post_message(target, notification, payload)
+            self.metrics.count(None, "sent" if delivered else "failed")
+            results[name] = dict(success=delivered, status=status, error=error,
+                                 latency=time.monotonic() - start)
+        return dict(kind="test", success=all(result["success"] for result in results.values()), targets=results)
+
+    def run_diagnostics(self, url):
+        result = diagnose(url, timeout=self.timeout[0] + self.timeout[1])
+        return dict(kind="diagnose", success=result.pop("ok"), **result)
+
+    def get_stats(self):
+        return dict(queue=self.get_queue_stats(),
+                    throttle=self.throttle.get_stats(),
+                    outbox=self.outbox.get_stats() if self.outbox is not None else None,
+                    targets=dict((name, target.get_stats()) for name, target in self.targets.items()),
+                    snapshot=self.snapshot_cache.get_stats(),
+                    snapshot_pool=self.snapshot_pool.get_stats() if self.snapshot_pool is not None else None,
+                    stream=self.frame_grabber.get_stats() if self.frame_grabber is not None else None,
+                    thumbnails=self.thumbnail_cache.get_stats(),
+                    watchdog=self.watchdog.get_stats(),
+                    control=self.control.get_stats() if self.control is not None else None,
+                    history=self.history.get_stats() if self.history is not None else None,
+                    express=dict(min_priority=self.express_priority, events=sorted(self.express_events),
+                                 slo=self.express_slo, latency=self.metrics.express.to_dict()),
+                    metrics=self.metrics.to_dict())
+
+    def on_api_get(self, request):
+        """
+        Delivery statistics as JSON, or in the prometheus text format with ?format=prometheus. With ?job=<id> the
+        result of a test notification or connection diagnostics. With ?history=<page> a page of the notification
+        history, filtered by the optional event, job, outcome, since and until parameters.
+        :param request:
+        :return:
+        """
+        import flask
+
+        if request.values.get("history"):
+            if self.history is None:
+                return flask.make_response("The notification history is disabled", 404)
             try:
-                self.event_message(payload)
-                return flask.jsonify(dict(success=True))
+                return flask.jsonify(self.history.query(page=request.values.get("history", type=int) or 1,
+                                                        per_page=request.values.get("per_page", 50, type=int),
+                                                        event=request.values.get("event"),
+                                                        job=request.values.get("job"),
+                                                        outcome=request.values.get("outcome"),
+                                                        since=request.values.get("since", type=float),
+                                                        until=request.values.get("until", type=float)))
             except Exception as e:
-                return flask.jsonify(dict(success=False, msg=str(e.message)))
-        return flask.make_response("Unknown command", 400)
+                self._logger.info("Could not query the notification history: %s" % str(e))
+                return flask.make_response("Could not query the notification history", 500)
+        if request.values.get("job"):
+            job = self.jobs.get(request.values.get("job"))
+            if job is None:
+                return flask.make_response("Unknown job", 404)
+            return flask.jsonify(job)
+        if request.values.get("format") == "prometheus":
+            return flask.Response(self.metrics.to_prometheus(self.get_gauges()),
+                                  mimetype="text/plain; version=0.0.4")
+        return flask.jsonify(self.get_stats())
+
+    def get_queue_stats(self):
+        """
+        :return: the queue statistics of all targets added up
+        """
+        stats = dict(depth=0, enqueued=0, sent=0, failed=0, dropped=0, shed=0, coalesced=0)
+        for target in list(self.targets.values()):
+            queue = target.queue.get_stats()
+            for key in stats:
+                stats[key] += queue[key]
+        stats["drop_rate"] = float(stats["dropped"]) / stats["enqueued"] if stats["enqueued"] else 0.0
+        return stats
+
+    def get_gauges(self):
+        queue = self.get_queue_stats()
+        throttle = self.throttle.get_stats()
+        snapshot = self.snapshot_cache.get_stats()
+        gauges = dict(
+            gotify_queue_depth=("Notifications waiting in the queues of the targets", queue["depth"]),
+            gotify_queue_dropped=("Notifications dropped by the queue overflow policy", queue["dropped"]),
+            gotify_queue_shed=("Low priority notifications shed while the queue was half full", queue["shed"]),
+            gotify_express_slo_seconds=("Time from the event to the delivery the critical notifications aim for",
+                                        self.express_slo if self.express_priority is not None else None),
+            gotify_queue_drop_rate=("Share of the queued notifications which were dropped", queue["drop_rate"]),
+            gotify_throttle_limited=("Notifications suppressed by the rate limits", throttle["limited"]),
+            gotify_throttle_coalesced=("Notifications merged into others", throttle["coalesced"]),
+            gotify_snapshot_cache_hits=("Snapshots served from the cache", snapshot["hits"]),
+            gotify_snapshot_cache_misses=("Snapshots fetched for a request", snapshot["misses"]),
+        )
+        if self.outbox is not None:
+            outbox = self.outbox.get_stats()
+            gauges["gotify_outbox_pending"] = ("Undelivered notifications in the outbox", outbox["pending"])
+            gauges["gotify_outbox_pending_bytes"] = ("Size of the undelivered notifications", outbox["pending_bytes"])
+        return gauges
+
+    def get_snapshot_processor(self):
+        """
+        Return the snapshot processor for the current webcam and snapshot settings, it is only rebuilt when they change
+        :return:
+        """
+        key = (bool(self._settings.global_get(["webcam", "flipH"])),
+               bool(self._settings.global_get(["webcam", "flipV"])),
+               bool(self._settings.global_get(["webcam", "rotate90"])),
+               self._settings.get_int(["snapshot", "max_width"]),
+               self._settings.get_int(["snapshot", "max_height"]),
+               self._settings.get_int(["snapshot", "max_bytes"]),
+               self._settings.get_int(["snapshot", "quality"]))
+
+        if self.snapshot_processor is None or self.snapshot_processor.key != key:
+            self.snapshot_processor = SnapshotProcessor(*key)
+        return self.snapshot_processor
+
+    def configure_snapshot_pool(self):
+        if not self._settings.get_boolean(["snapshot", "process_pool"]):
+            if self.snapshot_pool is not None:
+                self.snapshot_pool.close()
+                self.snapshot_pool = None
+            return
+
+        if self.snapshot_pool is None:
+            self.snapshot_pool = SnapshotPool(logger=self._logger)
+        self.snapshot_pool.timeout = self._settings.get_float(["snapshot", "job_timeout"]) or None
+        self.snapshot_pool.max_frame_bytes = self._settings.get_int(["snapshot", "max_frame_bytes"])
 
     def image(self) -> Optional[bytes]:
         """
-        Create an image by getting an image form the setting webcam-snapshot. 
-        Transpose this image according the settings and returns it 
+        Return a recent snapshot, notifications sent within the snapshot ttl share the same image
+        :return:
+        """
+        return self.snapshot_cache.get()
+
+    def get_stream_url(self):
+        """
+        :return: url of the MJPEG stream of the webcam, None when it is not known
+        """
+        stream_url = self._settings.get(["snapshot", "stream_url"]) or self._settings.global_get(["webcam", "stream"])
+        if stream_url and stream_url.startswith(("http://", "https://")):
+            return stream_url
+
+        # the stream url is usually relative to OctoPrint, guess it from the snapshot url of mjpg-streamer
+        snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+        if snapshot_url and "action=snapshot" in snapshot_url:
+            return snapshot_url.replace("action=snapshot", "action=stream")
+        return None
+
+    def get_frame_grabber(self):
+        """
+        Return the grabber for the webcam stream, it is only rebuilt when the stream url or the session change
+        :return: None when grabbing from the stream is disabled
+        """
+        url = self.get_stream_url() if self._settings.get_boolean(["snapshot", "stream"]) else None
+        grabber = self.frame_grabber
+        if grabber is not None and (grabber.url != url or grabber.session is not self.session):
+            grabber.stop()
+            grabber = self.frame_grabber = None
+
+        if grabber is None and url:
+            grabber = self.frame_grabber = MjpegGrabber(url, self.session, timeout=self.timeout,
+                                                        logger=self._logger)
+        if grabber is not None:
+            grabber.idle_timeout = self._settings.get_float(["snapshot", "stream_idle"]) or 0
+        return grabber
+
+    def fetch_snapshot(self) -> Optional[bytes]:
+        """
+        Take the latest frame of the webcam stream, or get an image from the setting webcam-snapshot.
+        Transpose this image according the settings, scale it down to the configured size and returns it as JPEG
         :return: 
         """
+        grabber = self.get_frame_grabber()
+        image = grabber.get() if grabber is not None else None
+        if image is None:
+            image = self.request_snapshot()
+            if image is None:
+                return None
+
+        start = time.monotonic()
+        try:
+            if self.snapshot_pool is not None:
+                return self.snapshot_pool.process(self.get_snapshot_processor(), image)
+            return self.get_snapshot_processor().process(image)
+        except Exception as err:
+            self._logger.info("Could not process image: %s " % str(err))
+            return None
+        finally:
+            self.metrics.snapshot_encode.observe(time.monotonic() - start)
+
+    def request_snapshot(self) -> Optional[bytes]:
+        """
+        Get a frame from the snapshot url of the webcam
+        :return: the frame as received, None on errors
+        """
         snapshot_url = self._settings.global_get(["webcam", "snapshot"])
         if not snapshot_url:
             return None
 
-        self._logger.debug("Snapshot URL: %s " % str(snapshot_url))
+        from requests.exceptions import HTTPError
+
+        self._logger.debug("Snapshot URL: %s ", snapshot_url)
+        start = time.monotonic()
         try:
-            image = requests.get(snapshot_url, stream=True).content
+            r = self.session.get(snapshot_url, timeout=self.timeout)
+            r.raise_for_status()
+            self.metrics.snapshot_fetch.observe(time.monotonic() - start)
+            return r.content
         except HTTPError as http_err:
             self._logger.info(
                 "HTTP error occured while trying to get image: %s " % str(http_err))
+            return None
         except Exception as err:
             self._logger.info(
                 "Other error occurred while trying to get image: %s " % str(err))
+            return None
 
-        hflip = self._settings.global_get(["webcam", "flipH"])
-        vflip = self._settings.global_get(["webcam", "flipV"])
-        rotate = self._settings.global_get(["webcam", "rotate90"])
-        if hflip or vflip or rotate:
-            # https://www.blog.pythonlibrary.org/2017/10/05/how-to-rotate-mirror-photos-with-python/
-            image_obj = Image.open(BytesIO(image))
-            if hflip:
-                image_obj = image_obj.transpose(Image.FLIP_LEFT_RIGHT)
-            if vflip:
-                image_obj = image_obj.transpose(Image.FLIP_TOP_BOTTOM)
-            if rotate:
-                image_obj = image_obj.rotate(90)
-            # https://stackoverflow.com/questions/646286/python-pil-how-to-write-png-image-to-string/5504072
-            output = BytesIO()
-            image_obj.save(output, format="JPEG")
-            image = output.getvalue()
-            output.close()
+    def attach_image(self, payload, thumbnail=None):
+        """
+        Add a webcam snapshot to the payload, either inline as markdown image or as url gotify clients can load.
+        Without a webcam the thumbnail the slicer embedded in the gcode file is attached instead.
+        :param payload:
+        :param thumbnail: path of the gcode file on disk
+        :return:
+        """
+        if self._settings.get(["snapshot", "mode"]) == "url":
+            snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+            if snapshot_url:
+                extras = payload.setdefault("extras", {})
+                extras["client::notification"] = dict(bigImageUrl=snapshot_url)
+                return
+            image = None
+        else:
+            image = self.image()
+
+        mime_type = "image/jpeg"
+        if image is None and thumbnail is not None:
+            mime_type, image = self.thumbnail_cache.get(thumbnail) or (None, None)
+        if image is None:
+            return
 
-        return image
+        payload["message"] = u"%s\n\n![snapshot](%s)" % (payload.get("message") or "",
+                                                         to_data_uri(image, mime_type))
+        extras = payload.setdefault("extras", {})
+        extras["client::display"] = dict(contentType="text/markdown")
 
-    def restart_timer(self):
-        if self.timer:
-            self.timer.cancel()
-            self.timer = None
+    def get_print_file(self, payload):
+        """
+        :param payload: payload of a print event
+        :return: path of the printed file on disk, None for files on the SD card
+        """
+        if payload.get("origin") != "local" or not payload.get("path"):
+            return None
+        try:
+            return self._file_manager.path_on_disk("local", payload["path"])
+        except Exception:
+            return None
 
-        self.timer = RepeatedTimer(5, self.temp_check, None, None, True)
-        self.timer.start()
+    def render_message(self, event, **context):
+        """
+        Render the compiled message of an event
+        :param event:
+        :param context: values of the placeholders
+        :return: the message or None when the event has no message
+        """
+        template = self.message_templates.get(event)
+        if template is None:
+            return None
+        try:
+            return template.render(**context)
+        except (AttributeError, LookupError, TypeError, ValueError) as e:
+            self._logger.error("Could not render the message of event %s: %s" % (event, str(e)))
+            return template.source
 
-    def temp_check(self):
+    def get_heater_name(self, key):
         """
-        called repeadly by Timer. Sends temperature push
+        Translate a parsed temperature key (T0, T1, B, C, ...) into a heater name (tool0, tool1, bed, chamber)
+        :param key:
+        :return: None for sensors which are not heaters
         """
+        try:
+            return self.heater_names[key]
+        except KeyError:
+            pass
 
-        if not self._printer.is_operational():
-            return
+        heater = None
+        if key[:1] == "T" and key[1:].isdigit():
+            heater = "tool" + key[1:]
+        self.heater_names[key] = heater
+        return heater
 
-        if self._settings.get(["events", "TempReached", "priority"]):
+    def temperatures_received(self, comm_instance, parsed_temperatures, *args, **kwargs):
+        """
+        Called by the comm layer for every temperature report, sends a push when a heater reached its target.
+        A heater is armed again when its target changes or its temperature drops more than the hysteresis below it.
+        :param comm_instance:
+        :param parsed_temperatures: dict of key -> (actual, target)
+        :return: the unmodified temperatures
+        """
+        job = self.job
+        if not self.temp_enabled and job is None:
+            return parsed_temperatures
 
-            temps = self._printer.get_current_temperatures()
+        for key, (actual, target) in parsed_temperatures.items():
+            heater = self.get_heater_name(key)
+            if heater is None or actual is None:
+                continue
 
-            bed_temp = round(temps['bed']['actual']) if 'bed' in temps else 0
-            bed_target = temps['bed']['target'] if 'bed' in temps else 0
-            e1_temp = round(temps['tool0']['actual']
-                            ) if 'tool0' in temps else 0
-            e1_target = temps['tool0']['target'] if 'tool0' in temps else 0
+            if job is not None:
+                job.record_temperature(heater, actual, target)
+            if not self.temp_enabled:
+                continue
 
-            if bed_target > 0 and bed_temp >= bed_target and self.bed_sent is False:
-                self.bed_sent = True
+            self.temperatures[heater] = (actual, target)
+            if not target:
+                self.temp_notified.pop(heater, None)
+                continue
 
-                self.event_message({
-                    "message": self._settings.get(["events", "TempReached", "message"]).format(**locals())
-                })
+            if self.temp_notified.get(heater) == target:
+                if actual < target - self.temp_hysteresis:
+                    del self.temp_notified[heater]
+                continue
 
-            if e1_target > 0 and e1_temp >= e1_target and self.e1_sent is False:
-                self.e1_sent = True
+            if round(actual) >= target:
+                self.temp_notified[heater] = target
+                self.temp_reached(heater, actual, target)
+
+        return parsed_temperatures
+
+    def temp_reached(self, heater, actual, target):
+        """
+        Sends temperature push
+        """
+        bed_temp, bed_target = self.temperatures.get("bed", (0, 0))
+        e1_temp, e1_target = self.temperatures.get("tool0", (0, 0))
 
-                self.event_message({
-                    "message": self._settings.get(["events", "TempReached", "message"]).format(**locals())
-                })
+        self.event_message({
+            "message": self.render_message("TempReached",
+                                           heater=heater, temp=round(actual), target=round(target),
+                                           bed_temp=round(bed_temp), bed_target=round(bed_target or 0),
+                                           e1_temp=round(e1_temp), e1_target=round(e1_target or 0))
+        }, "TempReached")
 
     def on_print_progress(self, storage: str, path: str, progress: int):
         """
@@ -177,33 +899,88 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param string path: Path of the file
         :param int progress: Current progress as a value between 0 and 100
         """
+        job = self.job
+        if job is None:
+            return
+
         progressMod = self._settings.get(["events", "Progress", "mod"])
 
-        if self.printing and progressMod and progress > 0 and progress % int(progressMod) == 0 and self.last_progress != progress:
-            self.last_progress = progress
+        if progressMod and progress > 0 and progress % int(progressMod) == 0 and job.last_progress != progress:
+            job.last_progress = progress
             self.event_message({
-                "message": self._settings.get(["events", "Progress", "message"]).format(percentage=progress),
+                "message": self.render_message("Progress", percentage=progress),
                 "priority": self._settings.get(["events", "Scheduled", "priority"])
-            })
+            }, "Progress")
 
-    def get_mins_since_started(self) -> int:
-        if self.start_time:
-            return int(round((datetime.datetime.now() - self.start_time).total_seconds() / 60, 0))
+        elif progressMod and progress > 0 and (progress + 1) % int(progressMod) == 0:
+            # the next percent is a milestone, expect it after about as long as the average percent took so far
+            self.schedule_prefetch((time.monotonic() - job.start_monotonic) / progress)
+
+        if job.layer_index is not None:
+            # there are no ZChange events for prints from the SD card
+            self.check_layer()
+
+    def check_layer(self):
+        """
+        Look up the layer being printed from the position in the file and send the first layer and every N layers
+        notifications
+        :return:
+        """
+        job = self.job
+        if job is None or job.layer_index is None:
+            return
+        filepos = (self._printer.get_current_data().get("progress") or {}).get("filepos")
+        if filepos is None:
+            return
+
+        layer = job.layer_index.layer_at(filepos)
+        if layer <= job.last_layer:
+            return
+        job.layer_changed(layer, time.monotonic())
+        last_layer, job.last_layer = job.last_layer, layer
+        context = dict(layer=layer, layers=job.layer_index.count, z=job.layer_index.height(layer))
+
+        if job.first_layer and layer > 1:
+            job.first_layer = False
+            if self.event_priorities.get("ZChange"):
+                self.event_message(dict(message=self.render_message("ZChange", **context),
+                                        priority=self.event_priorities["ZChange"]), "ZChange")
+
+        if self.layer_mod and layer // self.layer_mod > last_layer // self.layer_mod:
+            self.event_message(dict(message=self.render_message("Layer", **context),
+                                    priority=self.schedule_priority), "Layer")
+
+    def get_layer_index(self, payload):
+        """
+        :param payload: payload of the PrintStarted event
+        :return: the LayerIndex of the file being printed, None when it is not indexed (yet)
+        """
+        try:
+            path = self.get_print_file(payload)
+            if path is not None:
+                return self.layer_indexer.get(path)
+            return self.layer_indexer.find(payload.get("name"), payload.get("size"))
+        except Exception as e:
+            self._logger.info("Could not look up the layer index of %s: %s" % (payload.get("path"), str(e)))
+            return None
 
     def check_schedule(self):
         """
-        Check the scheduler
+        Called once per elapsed print minute by the gcode hook
         Send a notification
         """
 
-        scheduleMod = self._settings.get(["events", "Scheduled", "mod"])
+        self.arm_schedule()
+        job = self.job
+        if job is None:
+            return
 
-        if self.printing and scheduleMod and self.last_minute > 0 and self.last_minute % int(scheduleMod) == 0:
+        if job.last_minute > 0 and job.last_minute % self.schedule_mod == 0:
 
             self.event_message({
-                "message": self._settings.get(["events", "Scheduled", "message"]).format(elapsed_time=self.last_minute),
-                "priority": self._settings.get(["events", "Scheduled", "priority"])
-            })
+                "message": self.render_message("Scheduled", elapsed_time=job.last_minute),
+                "priority": self.schedule_priority
+            }, "Scheduled")
 
     def sent_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
         """
@@ -217,23 +994,111 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param kwargs: 
         :return: 
         """
+        # This runs for every line sent to the printer, keep the common path down to a counter, a bit test and a set
+        # lookup
+        lines = self.gcode_lines + 1
+        self.gcode_lines = lines
+        if not lines & GCODE_SAMPLE_MASK:
+            self.timed_gcode(cmd, gcode)
+        elif gcode in INTERESTING_GCODES:
+            self.process_gcode(cmd, gcode)
+
+    def timed_gcode(self, cmd, gcode):
+        """
+        The gcode hook for one line in GCODE_SAMPLE_MASK + 1, timed for the metrics. The scheduled notification is
+        checked here as well, a few dozen lines late is well within its minute
+        :param cmd:
+        :param gcode:
+        :return:
+        """
+        start = time.perf_counter()
+        if self.next_minute_at is not None and time.monotonic() >= self.next_minute_at:
+            self.check_schedule()
 
-        if gcode and gcode != "G1":
-            mss = self.get_mins_since_started()
+        if gcode in INTERESTING_GCODES:
+            self.process_gcode(cmd, gcode)
+        self.metrics.gcode_hook.observe(time.perf_counter() - start)
 
-            if self.last_minute != mss:
-                self.last_minute = mss
-                self.check_schedule()
+    def process_gcode(self, cmd, gcode):
+        """
+        Called by the gcode hook for the lines with one of the INTERESTING_GCODES
+        :param cmd:
+        :param gcode:
+        :return:
+        """
+        if gcode in BLOCKING_GCODES:
+            self.gcode_hold_at = self.gcode_lines
 
-        if gcode and gcode == "M600":
+        if gcode == "M600":
+            job = self.job
+            if job is not None:
+                job.filament_changes += 1
             self.on_event("FilamentChange", None)
 
-        if gcode and gcode == "M70":
+        elif gcode == "M70":
             self.m70_cmd = cmd[3:]
 
-        if gcode and gcode == "M117" and cmd[4:].strip() != "":
+        elif gcode == "M117" and cmd[4:].strip() != "":
             self.m70_cmd = cmd[4:]
 
+    def gcode_holding(self):
+        """
+        :return: True while the printer does not take lines on purpose: paused, changing filament or waiting for a
+        heater, called by the watchdog
+        """
+        return self.gcode_hold_at == self.gcode_lines or self._printer.is_paused() or self._printer.is_pausing()
+
+    def throughput_alert(self, kind, rate, gap):
+        priority = self.event_priorities.get("Throughput")
+        if not priority:
+            return
+        if kind == STALL:
+            reason = "no line was sent to the printer for %d seconds" % gap
+        else:
+            reason = "%.1f lines per second, below %g" % (rate, self.watchdog.min_rate)
+        self._logger.info("Gcode streaming degraded: %s" % reason)
+        self.event_message(dict(message=self.render_message("Throughput", reason=reason, rate=round(rate, 1),
+                                                            gap=int(gap)),
+                                priority=priority), "Throughput")
+
+    def get_throughput(self):
+        """
+        :return: sparkline and average lines per second of the print which just ended, empty when it was not watched
+        """
+        if not self.watchdog.running:
+            return ""
+        self.watchdog.stop()
+        summary = self.watchdog.summary()
+        if summary["rate"] is None:
+            return ""
+        return u"(%s %.0f lines/s)" % (summary["sparkline"], summary["rate"])
+
+    @property
+    def printing(self):
+        return self.job is not None
+
+    def end_job(self, result):
+        """
+        Finish the statistics of the print in progress and save them when enabled
+        :param result: done or failed
+        :return: the PrintJob, None when no print was in progress
+        """
+        job = self.job
+        self.job = None
+        self.next_minute_at = None
+        if job is None:
+            return None
+
+        job.finish(result, time.monotonic(), self.gcode_lines)
+        self.last_job = job
+        if self._settings.get_boolean(["jobs", "persist"]):
+            try:
+                save_job(os.path.join(self.get_plugin_data_folder(), "jobs"), job,
+                         max_files=self._settings.get_int(["jobs", "max_files"]))
+            except (IOError, OSError) as e:
+                self._logger.warning("Could not save the statistics of the print: %s" % str(e))
+        return job
+
     # Start with event handling: http://docs.octoprint.org/en/master/events/index.html
 
     def PrintDone(self, payload):
@@ -242,10 +1107,8 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param payload: 
         :return: 
         """
-        self.printing = False
-        self.last_minute = 0
-        self.last_progress = 0
-        self.start_time = None
+        job = self.end_job("done")
+        throughput = self.get_throughput()
         file = os.path.basename(payload["name"])
         elapsed_time_in_seconds = payload["time"]
 
@@ -253,7 +1116,9 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
             datetime.timedelta(seconds=elapsed_time_in_seconds))
 
         # Create the message
-        return self._settings.get(["events", "PrintDone", "message"]).format(**locals())
+        return self.render_message("PrintDone", file=file, elapsed_time=elapsed_time,
+                                   elapsed_time_in_seconds=elapsed_time_in_seconds, throughput=throughput,
+                                   summary=job.format_summary() if job is not None else "", payload=payload)
 
     def PrintFailed(self, payload):
         """
@@ -261,10 +1126,11 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param payload: 
         :return: 
         """
-        self.printing = False
-        if "name" in payload:
-            file = os.path.basename(payload["name"])
-        return self._settings.get(["events", "PrintFailed", "message"]).format(**locals())
+        job = self.end_job("failed")
+        self.watchdog.stop()
+        file = os.path.basename(payload["name"]) if "name" in payload else ""
+        return self.render_message("PrintFailed", file=file,
+                                   summary=job.format_summary() if job is not None else "", payload=payload)
 
     def FilamentChange(self, payload):
         """
@@ -276,7 +1142,7 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         if (self.m70_cmd != ""):
             m70_cmd = "(" + self.m70_cmd.strip() + ")"
 
-        return self._settings.get(["events", "FilamentChange", "message"]).format(**locals())
+        return self.render_message("FilamentChange", m70_cmd=m70_cmd, payload=payload)
 
     def PrintPaused(self, payload):
         """
@@ -284,56 +1150,111 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param payload: 
         :return: 
         """
+        job = self.job
+        if job is not None:
+            job.pause(time.monotonic())
+
         m70_cmd = ""
         if (self.m70_cmd != ""):
             m70_cmd = self.m70_cmd
 
-        return self._settings.get(["events", "PrintPaused", "message"]).format(**locals())
+        return self.render_message("PrintPaused", m70_cmd=m70_cmd, payload=payload)
+
+    def PrintResumed(self, payload):
+        """
+        Only keeps track of the time the print was paused
+        :param payload:
+        :return:
+        """
+        job = self.job
+        if job is not None:
+            job.resume(time.monotonic())
+        return self.render_message("PrintResumed", payload=payload)
 
     def Waiting(self, payload):
         """
-        Alias for PrintPaused
+        Same as PrintPaused, with its own message
         :param payload: 
         :return: 
         """
-        return self.PrintPaused(payload)
+        m70_cmd = ""
+        if (self.m70_cmd != ""):
+            m70_cmd = self.m70_cmd
+
+        return self.render_message("Waiting", m70_cmd=m70_cmd, payload=payload)
 
     def PrintStarted(self, payload):
         """
-        Reset value's
+        Start keeping track of a new print
         :param payload:
         :return:
         """
 
-        self.printing = True
-        self.start_time = datetime.datetime.now()
+        job = PrintJob(uuid.uuid4().hex, payload.get("name"), payload.get("origin"), datetime.datetime.now(),
+                       self.gcode_lines)
+        job.layer_index = self.get_layer_index(payload)
+        self.job = job
+        self.arm_schedule()
         self.m70_cmd = ""
-        self.bed_sent = False
-        self.e1_sent = False
-        self.first_layer = True
-        self.restart_timer()
-
-        return self._settings.get(["events", "PrintStarted", "message"])
+        self.temp_notified = {}
+        self.gcode_hold_at = None
+        if self.watchdog_enabled and payload.get("origin") == "local":
+            # prints from the SD card are not streamed
+            self.watchdog.start()
+        if self.image_enabled:
+            grabber = self.get_frame_grabber()
+            if grabber is not None:
+                # connect now, so the first notifications of the print find a frame
+                grabber.start()
+
+        return self.render_message("PrintStarted", payload=payload)
 
     def ZChange(self, payload):
         """
-        ZChange event which send a notification, this does not work when printing from sd
+        With a layer index of the file the layer notifications are sent by check_layer. Otherwise, e.g. while the file
+        is still being indexed, guess when the first couple of layers are done.
         :param payload: 
         :return: 
         """
 
-        if not self.printing:
+        job = self.job
+        if job is None:
+            return
+
+        if job.layer_index is not None:
+            self.check_layer()
             return
 
-        if not self.first_layer:
+        if not job.first_layer:
             return
 
         # It is not actually the first layer, it was not my plan too create a lot of code for this feature
         if payload["new"] < 2 or payload["old"] is None:
             return
 
-        self.first_layer = False
-        return self._settings.get(["events", "ZChange", "message"]).format(**locals())
+        job.first_layer = False
+        return self.render_message("ZChange", payload=payload)
+
+    def FileAdded(self, payload):
+        """
+        Index the layers of uploaded gcode files in the background, so they are known before the print starts
+        :param payload:
+        :return:
+        """
+        if payload.get("storage") == "local" and "gcode" in (payload.get("type") or ()):
+            path = self._file_manager.path_on_disk("local", payload["path"])
+            self.layer_indexer.submit(path)
+            if self.image_enabled:
+                self.thumbnail_cache.extract(path)
+
+    def UpdatedFiles(self, payload):
+        """
+        Pick up files which were added without an upload, e.g. copied into the uploads folder
+        :param payload:
+        :return:
+        """
+        if payload.get("type") == "printables":
+            self.layer_indexer.submit_folder(self._settings.global_get_basefolder("uploads"))
 
     def Startup(self, payload):
         """
@@ -342,7 +1263,7 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :return: 
         """
 
-        return self._settings.get(["events", "Startup", "message"])
+        return self.render_message("Startup", payload=payload)
 
     def Shutdown(self, payload):
         """
@@ -350,7 +1271,7 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param payload: 
         :return: 
         """
-        return self._settings.get(["events", "Shutdown", "message"])
+        return self.render_message("Shutdown", payload=payload)
 
     def Error(self, payload):
         """
@@ -359,77 +1280,294 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :return: 
         """
         if(self.printing):
-            error = payload["error"]
-            return self._settings.get(["events", "Error", "message"]).format(**locals())
+            return self.render_message("Error", error=payload.get("error", ""), payload=payload)
         return
 
     def on_event(self, event, payload):
+        if event not in self.dispatch_events:
+            return
+
+        start = time.perf_counter()
+        self.handle_event(event, payload)
+        self.metrics.on_event.observe(time.perf_counter() - start)
+
+        if event == "Shutdown":
+            # deliver what is still queued, OctoPrint waits up to 15 seconds for the event handlers
+            deadline = time.monotonic() + 12
+            self.throttle.flush_all()
+            for target in list(self.targets.values()) + list(self.retired_targets):
+                # the outbox has to see the results of the deliveries still running on the target workers
+                target.close(wait=True, timeout=max(0, deadline - time.monotonic()))
+            if self.outbox is not None:
+                # whatever could not be delivered is replayed after the next start
+                self.outbox.stop(timeout=2)
+            self.layer_indexer.stop()
+            self.watchdog.stop()
+            self.thumbnail_cache.close()
+            if self.control is not None:
+                self.control.stop(timeout=1)
+            if self.snapshot_pool is not None:
+                self.snapshot_pool.close()
+            if self.frame_grabber is not None:
+                self.frame_grabber.stop()
+            if self.express_timer is not None:
+                self.express_timer.cancel()
+            if self.history is not None:
+                # writes what the targets recorded while draining
+                self.history.stop(timeout=2)
+
+    def handle_event(self, event, payload):
 
         if payload is None:
             payload = {}
 
-        # StatusNotPrinting
-        self._logger.debug("Got an event: %s, payload: %s" %
-                           (event, str(payload)))
-        # It's easier to ask forgiveness than to ask permission.
-        try:
-            # Method exists, and was used.
-            payload["message"] = getattr(self, event)(payload)
-
-            self._logger.debug("Event triggered: %s " % str(event))
-        except AttributeError:
-            self._logger.debug(
-                "event: %s has an AttributeError %s" % (event, str(payload)))
-            # By default the message is simple and does not need any formatting
-            payload["message"] = self._settings.get(
-                ["events", event, "message"])
-
-        if payload["message"] is None:
-            self._logger.debug("no message in payload")
-            return
-
-        # Does the event exists in the settings ? if not we don't want it
-        if not event in self.get_settings_defaults()["events"]:
-            self._logger.debug("we don't like that event")
+        # payloads can be large, only turn them into a string when somebody reads it
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self._logger.debug("Got an event: %s, payload: %s", event, payload)
+        handler = self.event_handlers.get(event)
+        if handler is not None:
+            message = handler(payload)
+            if debug:
+                self._logger.debug("Event triggered: %s ", event)
+        else:
+            # By default the message is simple and only needs the payload
+            message = self.render_message(event, payload=payload)
+
+        if message is None:
+            if debug:
+                self._logger.debug("no message for event %s", event)
             return
 
         # Only continue when there is a priority
-        priority = self._settings.get(["events", event, "priority"])
+        priority = self.event_priorities.get(event)
 
         # By default, messages have normal priority (a priority of 0).
         # We do not support the Emergency Priority (2) because there is no way of canceling it here,
         if priority:
-            payload["priority"] = priority
-            self.event_message(payload)
+            thumbnail = self.get_print_file(payload) if event in self.thumbnail_events else None
+            self.event_message(dict(message=message, priority=priority), event, thumbnail=thumbnail)
 
-    def event_message(self, payload):
+    def event_message(self, payload, event=None, image=None, thumbnail=None):
         """
-        Do send the notification to the gotify server :)
+        Queue the notification for the gotify server, this never waits for the network so it is safe to call from
+        the comm thread
         :param payload: 
+        :param event: name of the event, used to coalesce notifications of the same kind
+        :param image: attach a webcam snapshot, defaults to the image setting
+        :param thumbnail: gcode file whose thumbnail is attached when there is no webcam snapshot
         :return: 
         """
 
         if payload.get("priority") and isinstance(payload.get("priority"), str):
             payload['priority'] = int(payload.get('priority'))
 
-        if self._printer_profile_manager is not None and "name" in self._printer_profile_manager.get_current_or_default():
-            payload["title"] = "Octoprint: %s" % self._printer_profile_manager.get_current_or_default()[
-                "name"]
+        title = self.get_title()
+        if title is not None:
+            payload["title"] = title
+
+        if image is None:
+            image = self.image_enabled
+
+        notification = Notification(event, payload, payload.get("priority") or 0, image, thumbnail)
+        job = self.job or (self.last_job if event in self.job_end_events else None)
+        if job is not None:
+            notification.job = job.id
+        self.throttle.submit(notification)
+
+    def get_title(self, default=None):
+        if self._printer_profile_manager is not None:
+            profile = self._printer_profile_manager.get_current_or_default()
+            if "name" in profile:
+                return "Octoprint: %s" % profile["name"]
+        return default
+
+    def queue_notification(self, notification):
+        """
+        Hand a notification which passed the throttle to its targets, it is journaled first so it survives gotify
+        outages and restarts
+        :param notification:
+        :return:
+        """
+        if notification.targets is None:
+            notification.targets = self.get_target_names(notification.event)
+        if not notification.targets:
+            self._logger.debug("No gotify target for %s notification", notification.event)
+            self.record_attempt(notification, history.SUPPRESSED, error="No target for the event")
+            return
+
+        if self.outbox is not None and notification.event is not None:
+            notification.outbox_id = self.outbox.add(notification)
+        if self.express_priority is not None and (notification.priority >= self.express_priority
+                                                  or notification.event in self.express_events):
+            self.dispatch_express(notification)
+            return
+        self.enqueue_notification(notification)
+
+    def enqueue_notification(self, notification):
+        """
+        Put the notification into the queue of every target, never blocks on the network
+        :param notification:
+        :return:
+        """
+        # replays of journals written before the targets were recorded go to the current targets
+        names = notification.targets or self.get_target_names(notification.event)
+        for name in names:
+            target = self.targets.get(name)
+            if target is None:
+                # the target was removed from the settings in the meantime
+                if self.outbox is not None:
+                    self.outbox.settle(notification.outbox_id, name, True)
+                continue
+            target.submit(notification if len(names) == 1 else notification.copy())
+
+    def get_target_names(self, event):
+        """
+        :param event:
+        :return: names of the targets which take notifications of the event
+        """
+        return tuple(name for name, target in self.targets.items() if target.accepts(event))
+
+    def notification_dropped(self, target, notification):
+        self.metrics.count(notification.event, "dropped")
+        self.record_attempt(notification, history.DROPPED, target=target.name, error="Queue overflow")
+        if self.outbox is not None:
+            self.outbox.discard(notification.outbox_id, target.name)
+
+    def notification_suppressed(self, notification, coalesced):
+        if coalesced:
+            self.record_attempt(notification, history.COALESCED)
+        else:
+            self.record_attempt(notification, history.SUPPRESSED, error="Rate limit")
+
+    def record_attempt(self, notification, outcome, target=None, priority=None, status=None, latency=None,
+                       error=None):
+        if self.history is None or notification.event is None:
+            return
+        self.history.record(notification.event, outcome, job=notification.job, target=target,
+                            priority=notification.priority if priority is None else priority,
+                            title=notification.payload.get("title"), message=notification.payload.get("message"),
+                            status=status, latency=latency, attempt=notification.attempt, error=error)
+
+    def prepare_payload(self, notification):
+        # the journaled payload stays without the image
+        payload = dict(notification.payload)
+        if notification.image:
+            self.attach_image(payload, notification.thumbnail)
+        return payload
+
+    def deliver_notification(self, target, notification):
+        """
+        Called from the worker of the target
+        :param target:
+        :param notification:
+        :return: True when the notification was delivered
+        """
+        return self.send_message(target, notification, self.prepare_payload(notification))
+
+    def dispatch_express(self, notification):
+        """
+        Hand a critical notification straight to the express worker of every target, past the queue and whatever the
+        targets are still busy with. It goes without the image, fetching a snapshot takes longer than the notification
+        may.
+        :param notification:
+        :return:
+        """
+        payload = dict(notification.payload)
+        for name in notification.targets:
+            target = self.targets.get(name)
+            if target is not None:
+                if not target.submit_express(self.send_message, target, notification, payload, True):
+                    target.submit(notification.copy())
+            elif self.outbox is not None:
+                self.outbox.settle(notification.outbox_id, name, True)
+
+    def deliver_now(self, notification):
+        """
+        Deliver the notification to its targets one after another in the calling thread
+        :param notification:
+        :return: True when all targets got it
+        """
+        payload = self.prepare_payload(notification)
+        names = notification.targets or self.get_target_names(notification.event)
+        results = [self.send_message(self.targets[name], notification, payload)
+                   for name in names if name in self.targets]
+        return bool(results) and all(results)
+
+    def send_message(self, target, notification, payload, express=False):
+        """
+        Do send the notification to the gotify server of the target :)
+        :param target:
+        :param notification:
+        :param payload: the prepared payload
+        :param express: send over the express connection of the target
+        :return: True when the message was delivered
+        """
+        start = time.monotonic()
+        delivered, status, error = self.post_message(target, notification, payload, express)
+        self.record_attempt(notification, history.SENT if delivered else history.FAILED, target=target.name,
+                            priority=target.get_priority(notification.event, notification.priority), status=status,
+                            latency=time.monotonic() - start, error=error)
+        self.metrics.count(notification.event, "sent" if delivered else "failed")
+        if delivered:
+            latency = time.monotonic() - notification.created
+            self.metrics.event_to_send.observe(latency)
+            if express:
+                self.metrics.express.observe(latency)
+                if self.express_slo and latency > self.express_slo:
+                    self.metrics.count(notification.event, "slo_missed")
+                    self._logger.info("Critical %s notification took %.0f ms to %s"
+                                      % (notification.event, latency * 1000, target.name))
+        if self.outbox is not None:
+            self.outbox.settle(notification.outbox_id, target.name, delivered)
+        return delivered
+
+    def post_message(self, target, notification, payload, express=False):
+        """
+        :param target:
+        :param notification:
+        :param payload: the prepared payload
+        :param express: send over the express connection of the target
+        :return: (delivered, http status or None, error or None)
+        """
+        payload = dict(payload, priority=target.get_priority(notification.event, notification.priority))
 
+        start = time.monotonic()
         try:
-            r = requests.post(
-                f"{self._settings.get(['gotify_server_base_url'])}/message?token={self.get_token()}", json=payload)
-            self._logger.debug("Response: %s" % str(r.content))
+            r = target.post(payload, self.timeout, express)
         except Exception as e:
-            self._logger.info("Could not send message: %s" % str(e))
+            self._logger.info("Could not send message to %s: %s" % (target.name, str(e)))
+            target.record(False)
+            return False, None, str(e)
+
+        self.metrics.http_rtt.observe(time.monotonic() - start)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("Response from %s: %s", target.name, r.content)
+        target.record(r.ok)
+        if not r.ok:
+            self._logger.info("Could not send message to %s: %s %s" % (target.name, r.status_code, r.reason))
+            return False, r.status_code, "%s %s" % (r.status_code, r.reason)
+        return True, r.status_code, None
 
     def on_after_startup(self):
         """
-        Valide settings on startup
+        Start the background work the first notifications do not depend on: index the layers of the files uploaded
+        while the plugin was not running, journal and replay the outbox, write the notification history, start the
+        snapshot worker, warm up the express connections and connect to the gotify stream
         :return: 
         """
-
-        self.restart_timer()
+        self.layer_indexer.start()
+        if self.outbox is not None:
+            # notifications of the startup are kept in memory until now and written to the new journal
+            self.outbox.start(self.deliver_now, self.enqueue_notification)
+        if self.history is not None:
+            self.history.start()
+        self.layer_indexer.submit_folder(self._settings.global_get_basefolder("uploads"))
+        if self.snapshot_pool is not None and self.image_enabled:
+            # spawning the worker takes longer than a snapshot, do it before the first one
+            self.snapshot_pool.start()
+        self.arm_express_timer()
+        self.rebuild_control()
 
     def get_settings_version(self):
         return 1
@@ -440,11 +1578,44 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
         :param data: 
         :return: 
         """
+        self.validate_messages(data)
+
+        old_http = self._settings.get(["http"], merged=True)
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.refresh_settings_cache()
+
+        if self._settings.get(["http"], merged=True) != old_http:
+            self.rebuild_session()
+        if self.get_targets_config() != self.targets_config:
+            self.rebuild_targets()
+            self.arm_express_timer()
+        if self.get_control_config() != self.control_config:
+            self.rebuild_control()
+
+    def validate_messages(self, data):
+        """
+        Reject event messages with invalid placeholders before they are saved, instead of failing while printing
+        :param data: the settings about to be saved
+        :return:
+        """
+        events = data.get("events") if isinstance(data, dict) else None
+        if not isinstance(events, dict):
+            return
 
-        self.restart_timer()
+        for event, values in events.items():
+            if not isinstance(values, dict) or "message" not in values:
+                continue
+            try:
+                parse_fields(event, values["message"] or "")
+            except TemplateError as e:
+                self._logger.error("Not saving the message of event %s: %s" % (event, str(e)))
+                del values["message"]
+                self._plugin_manager.send_plugin_message(self._identifier,
+                                                         dict(type="message_error", event=event, error=str(e)))
 
     def on_settings_load(self):
+        from flask_login import current_user
+
         data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
 
         # only return our restricted settings to admin users - this is only needed for OctoPrint <= 1.2.16
@@ -457,16 +1628,116 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
 
     def get_settings_restricted_paths(self):
         # only used in OctoPrint versions > 1.2.16
-        return dict(admin=[["token"]])
+        return dict(admin=[["token"], ["targets"], ["control", "client_token"]])
 
     def get_token(self):
         return self._settings.get(["token"])
 
     def get_settings_defaults(self):
-        return dict(
+        if GotifyPlugin.settings_defaults is None:
+            GotifyPlugin.settings_defaults = freeze(self.build_settings_defaults())
+            GotifyPlugin.default_events = GotifyPlugin.settings_defaults["events"]
+        # OctoPrint gets its own mutable copy
+        return thaw(GotifyPlugin.settings_defaults)
+
+    def get_default_events(self):
+        """
+        :return: the read only default settings of all events
+        """
+        if GotifyPlugin.default_events is None:
+            self.get_settings_defaults()
+        return GotifyPlugin.default_events
+
+    def build_settings_defaults(self):
+        defaults = dict(
             token=None,
             gotify_server_base_url=None,
+            # additional gotify servers, a list of dict(name=..., url=..., token=..., events=[...], priorities={...})
+            targets=[],
             image=True,
+            http=dict(
+                # seconds to wait for the connection and for the response
+                connect_timeout=5,
+                read_timeout=10,
+                # retries on connection errors and 5xx responses, with jittered exponential backoff
+                retries=3,
+                backoff_factor=0.5,
+                pool_size=4
+            ),
+            snapshot=dict(
+                # inline: attach the snapshot to the message, url: let the gotify client load the webcam snapshot url
+                mode="inline",
+                # the snapshot is scaled down and re-encoded until it fits these limits
+                max_width=1280,
+                max_height=720,
+                max_bytes=256 * 1024,
+                quality=80,
+                # seconds a snapshot is reused for other notifications
+                ttl=5,
+                # fetch a snapshot shortly before scheduled and progress notifications
+                prefetch=False,
+                prefetch_lead=2,
+                # keep the connection to the MJPEG stream of the webcam open and take its latest frame, the stream url
+                # is guessed from the webcam settings unless set here, closed after stream_idle seconds without use
+                stream=False,
+                stream_url="",
+                stream_idle=300,
+                # process snapshots in a separate process, keeps the Pillow work away from the comm thread
+                process_pool=False,
+                # seconds a snapshot may take in the separate process, and the largest frame it accepts
+                job_timeout=10,
+                max_frame_bytes=8 * 1024 * 1024
+            ),
+            outbox=dict(
+                # keep undelivered notifications on disk and send them once the server is reachable again
+                enabled=True,
+                max_bytes=1024 * 1024,
+                # seconds after which an undelivered notification is given up
+                max_age=12 * 60 * 60,
+                retry_interval=60
+            ),
+            jobs=dict(
+                # save the statistics of every print as JSON file in the plugin data folder, the newest max_files
+                persist=False,
+                max_files=100
+            ),
+            history=dict(
+                # record every notification attempt in a database in the plugin data folder (applies after a restart)
+                enabled=True,
+                # days after which attempts are deleted, and the most attempts kept
+                retention_days=30,
+                max_rows=100000
+            ),
+            control=dict(
+                # listen on the gotify stream for commands posted to the control application
+                enabled=False,
+                # a client token, application tokens can only send messages
+                client_token=None,
+                # id of the control application, messages of other applications are ignored
+                app_id=None,
+                commands=["pause", "resume", "cancel", "snapshot"],
+                # priority of the replies
+                priority=4
+            ),
+            queue=dict(
+                # maximum number of notifications waiting for each gotify server
+                size=32,
+                # drop_oldest, drop_lowest_priority or coalesce
+                overflow="drop_oldest",
+                # notifications below this priority are dropped once the queue is half full, 0 drops nothing early
+                shed_priority=1
+            ),
+            express=dict(
+                # notifications of at least min_priority, and those of the events, skip the queue and go over a
+                # connection kept open for them
+                enabled=True,
+                min_priority=8,
+                events=["EStop", "Error"],
+                # seconds from the event to the delivery they aim for, slower deliveries are counted and logged
+                slo=0.5,
+                # seconds after which an unused express connection is refreshed
+                keepalive=60
+            ),
             events=dict(
                 Scheduled=dict(
                     message=u''.join(
@@ -481,11 +1752,20 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
                     custom=True,
                     mod=0
                 ),
+                Layer=dict(
+                    message="Printing layer {layer} of {layers}",
+                    priority="0",
+                    custom=True,
+                    mod=0
+                ),
                 TempReached=dict(
                     name="Temperature Reached",
+                    help="Send a notification when a heater (bed, chamber or any tool) reaches its target temperature.",
                     message=u''.join([self.get_emoji("temp"),
-                                      u"Temperature Reached! Bed: {bed_temp}/{bed_target} | Extruder: {e1_temp}/{e1_target}"]),
+                                      u"Temperature Reached! {heater}: {temp}/{target}"]),
                     priority="0",
+                    # degrees the temperature has to drop below the target before it is reported again
+                    hysteresis=5,
                 ),
                 Shutdown=dict(
                     name="Printer Shutdown",
@@ -505,12 +1785,12 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
                 ),
                 PrintDone=dict(
                     name="Print Done",
-                    message="Print Job Finished: {file}, Finished Printing in {elapsed_time}",
+                    message="Print Job Finished: {file}, Finished Printing in {elapsed_time} {throughput}\n{summary}",
                     priority="0"
                 ),
                 PrintFailed=dict(
                     name="Print Failed",
-                    message="Print Job Failed: {file}",
+                    message="Print Job Failed: {file}\n{summary}",
                     priority=0
                 ),
                 PrintPaused=dict(
@@ -527,6 +1807,17 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
                     message="Printer is Waiting {m70_cmd}",
                     priority=0
                 ),
+                Throughput=dict(
+                    name="Slow Gcode Streaming",
+                    help="Send a notification when no line was sent to the printer for a while or the lines per "
+                    "second stay below a floor during a print. Pauses, filament changes and heating do not count.",
+                    message=u''.join([self.get_emoji("warning"), u"Gcode streaming degraded: {reason}"]),
+                    priority=1,
+                    # lines per second below which the streaming counts as slow, 0 is off
+                    min_rate=0,
+                    # seconds without a line which count as a stall, 0 is off
+                    stall=30,
+                ),
                 FilamentChange=dict(
                     name="Filament Change",
                     help="Send a notification when a M600 (Filament Change) command is received. When a <code>m70</code> was sent "
@@ -535,8 +1826,9 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
                     priority=0
                 ),
                 ZChange=dict(
-                    name="After first couple of layer",
-                    help="Send a notification when the 'first' couple of layers is done.",
+                    name="After the first layer",
+                    help="Send a notification when the first layer is done. The layers of uploaded files are "
+                    "indexed in the background, until then it is a guess.",
                     message=u''.join(
                         [u"First couple of layers are done ", self.get_emoji("four_leaf_clover")]),
                     priority=0,
@@ -564,9 +1856,17 @@ class GotifyPlugin(octoprint.plugin.EventHandlerPlugin,
             )
         )
 
+        for event in defaults["events"].values():
+            # maximum notifications per minute, 0 is unlimited
+            event.setdefault("rate_limit", 0)
+            # seconds during which notifications of the event are merged into one, 0 is off
+            event.setdefault("coalesce", 0)
+
+        return defaults
+
     def get_template_vars(self):
         return dict(
-            events=self.get_settings_defaults()["events"]
+            events=self.get_default_events()
         )
 
     def get_template_configs(self):
@@ -602,5 +1902,6 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.sent_gcode
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.sent_gcode,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.temperatures_received
     }
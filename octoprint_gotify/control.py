@@ -0,0 +1,198 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# commands which can be sent from the control application
+COMMANDS = ("pause", "resume", "cancel", "snapshot")
+
+# seconds to wait before reconnecting, doubled after every failed attempt
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+# the connection counts as stable after this many seconds, the backoff starts over
+STABLE_AFTER = 60.0
+
+
+def get_stream_url(base_url):
+    if base_url.startswith("https://"):
+        return "wss://" + base_url[len("https://"):].rstrip("/") + "/stream"
+    if base_url.startswith("http://"):
+        return "ws://" + base_url[len("http://"):].rstrip("/") + "/stream"
+    raise ValueError("Not a http(s) url: %s" % base_url)
+
+
+def parse_command(message):
+    """
+    :param message: text of the gotify message, e.g. "pause" or "/cancel please"
+    :return: the command in lower case, or None
+    """
+    words = (message or "").strip().split(None, 1)
+    if not words:
+        return None
+    return words[0].lstrip("/").lower()
+
+
+class ControlStream(object):
+    """
+    Listens on the gotify websocket stream for messages posted to the control application and hands the allowed
+    commands to a worker thread. It is one long lived connection on its own event loop, which sleeps in the selector
+    while nothing happens, with pings to notice dead connections and a jittered exponential backoff between reconnects.
+    """
+
+    def __init__(self, base_url, client_token, app_id, dispatch, commands=COMMANDS, ping_interval=60,
+                 ping_timeout=30, logger=None):
+        """
+        :param base_url: base url of the gotify server
+        :param client_token: gotify client token, application tokens can not read messages
+        :param app_id: id of the control application, messages of other applications are ignored
+        :param dispatch: callable receiving the command and the message, called on the worker thread
+        :param commands: the allowed commands
+        :param ping_interval:
+        :param ping_timeout:
+        :param logger:
+        """
+        self.url = get_stream_url(base_url)
+        self.client_token = client_token
+        self.app_id = int(app_id)
+        self.commands = frozenset(command.lower() for command in commands)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self._dispatch = dispatch
+        self._logger = logger or logging.getLogger(__name__)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="GotifyControl")
+        self._loop = None
+        self._stopping = False
+        self._stopped = None
+        self._connection = None
+        self._thread = None
+
+        self.connected = False
+        self.connects = 0
+        self.received = 0
+        self.dispatched = 0
+        self.rejected = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="GotifyStream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._shutdown)
+            except RuntimeError:
+                # the loop is closed already
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    def _shutdown(self):
+        self._stopped.set()
+        if self._connection is not None:
+            self._connection.close()
+
+    def _run(self):
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._stopped = asyncio.Event()
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        except Exception:
+            self._logger.exception("Error in the gotify control stream")
+        finally:
+            self._loop = None
+            loop.close()
+
+    async def _main(self):
+        import asyncio
+        from tornado.httpclient import HTTPRequest
+        from tornado.websocket import websocket_connect
+
+        backoff = MIN_BACKOFF
+        while not self._stopping:
+            request = HTTPRequest(self.url, headers={"X-Gotify-Key": self.client_token}, connect_timeout=30)
+            try:
+                self._connection = await websocket_connect(request, ping_interval=self.ping_interval,
+                                                           ping_timeout=self.ping_timeout)
+            except Exception as e:
+                self._logger.info("Could not connect to the gotify stream: %s" % str(e))
+            else:
+                if self._stopping:
+                    # stopped while connecting, _shutdown did not see this connection
+                    self._connection.close()
+                    self._connection = None
+                    break
+                self.connected = True
+                self.connects += 1
+                self._logger.info("Listening for commands on the gotify stream")
+                connected_at = asyncio.get_event_loop().time()
+                try:
+                    while not self._stopping:
+                        message = await self._connection.read_message()
+                        if message is None:
+                            break
+                        self._on_message(message)
+                finally:
+                    self.connected = False
+                    self._connection = None
+                if asyncio.get_event_loop().time() - connected_at > STABLE_AFTER:
+                    backoff = MIN_BACKOFF
+                if not self._stopping:
+                    self._logger.info("Lost the connection to the gotify stream")
+
+            delay = random.uniform(backoff / 2, backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_message(self, raw):
+        if self._stopping:
+            # a new stream may be listening already, a command must not run twice
+            return
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            return
+        if message.get("appid") != self.app_id:
+            # notifications of the plugin itself and everything else the client can see
+            return
+
+        self.received += 1
+        command = parse_command(message.get("message"))
+        if command not in self.commands:
+            self.rejected += 1
+            self._logger.info("Ignoring the gotify control message %r, allowed commands are: %s"
+                              % (message.get("message"), ", ".join(sorted(self.commands))))
+            return
+
+        self.dispatched += 1
+        self._executor.submit(self._run_command, command, message)
+
+    def _run_command(self, command, message):
+        try:
+            self._dispatch(command, message)
+        except Exception:
+            self._logger.exception("Error while running the gotify control command %s" % command)
+
+    def get_stats(self):
+        return dict(
+            url=self.url,
+            connected=self.connected,
+            connects=self.connects,
+            received=self.received,
+            dispatched=self.dispatched,
+            rejected=self.rejected,
+        )
@@ -0,0 +1,89 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+def _step(steps, name, start, error=None, **extra):
+    step = dict(step=name, duration=time.monotonic() - start, ok=error is None, error=error)
+    step.update(extra)
+    steps.append(step)
+    return error is None
+
+
+def diagnose(base_url, timeout=10.0):
+    """
+    Connect to the gotify server step by step and time each step separately: name resolution, TCP connect, TLS
+    handshake and a GET /version request on the same connection. Stops at the first step which fails.
+    :param base_url: base url of the gotify server
+    :param timeout: timeout of every step in seconds
+    :return: dict with the list of steps and whether all of them succeeded
+    """
+    steps = []
+    url = urlparse(base_url or "")
+    if url.scheme not in ("http", "https") or not url.hostname:
+        _step(steps, "url", time.monotonic(), "Not a valid http(s) url: %s" % base_url)
+        return dict(url=base_url, ok=False, steps=steps)
+
+    port = url.port or (443 if url.scheme == "https" else 80)
+
+    start = time.monotonic()
+    try:
+        addresses = socket.getaddrinfo(url.hostname, port, 0, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        _step(steps, "dns", start, str(e))
+        return dict(url=base_url, ok=False, steps=steps)
+    family, socktype, proto, _, address = addresses[0]
+    _step(steps, "dns", start, address=address[0])
+
+    start = time.monotonic()
+    sock = socket.socket(family, socktype, proto)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(address)
+        except (socket.error, socket.timeout) as e:
+            _step(steps, "connect", start, str(e))
+            return dict(url=base_url, ok=False, steps=steps)
+        _step(steps, "connect", start)
+
+        if url.scheme == "https":
+            import ssl
+
+            start = time.monotonic()
+            try:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=url.hostname)
+            except (ssl.SSLError, ssl.CertificateError, socket.error, socket.timeout) as e:
+                _step(steps, "tls", start, str(e))
+                return dict(url=base_url, ok=False, steps=steps)
+            _step(steps, "tls", start, version=sock.version())
+
+        start = time.monotonic()
+        path = url.path.rstrip("/") + "/version"
+        request = "GET %s HTTP/1.1\r\nHost: %s\r\nAccept: application/json\r\nConnection: close\r\n\r\n" % (path,
+                                                                                                         url.netloc)
+        try:
+            sock.sendall(request.encode("ascii"))
+            # the status line is enough, the time to the first byte is what matters here
+            status_line = sock.makefile("rb").readline().decode("latin-1").strip()
+        except (socket.error, socket.timeout) as e:
+            _step(steps, "request", start, str(e))
+            return dict(url=base_url, ok=False, steps=steps)
+
+        parts = status_line.split(" ", 2)
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+        error = None
+        if status is None:
+            error = "Not an http response: %s" % status_line[:80]
+        elif status >= 400:
+            error = status_line
+        _step(steps, "request", start, error, status=status)
+        return dict(url=base_url, ok=error is None, steps=steps)
+    finally:
+        sock.close()
@@ -0,0 +1,206 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import logging
+import os
+import threading
+import time
+
+DATABASE = "history.db"
+# rows waiting for the writer, the oldest are thrown away when it falls this far behind
+MAX_PENDING = 10000
+MAX_PER_PAGE = 500
+# seconds between two retention runs
+PRUNE_INTERVAL = 60 * 60
+
+# outcomes of a notification attempt
+SENT = "sent"
+FAILED = "failed"
+DROPPED = "dropped"
+SUPPRESSED = "suppressed"
+COALESCED = "coalesced"
+
+COLUMNS = ("time", "event", "job", "target", "outcome", "priority", "title", "message", "status", "latency",
+           "attempt", "error")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    event TEXT,
+    job TEXT,
+    target TEXT,
+    outcome TEXT NOT NULL,
+    priority INTEGER,
+    title TEXT,
+    message TEXT,
+    status INTEGER,
+    latency REAL,
+    attempt INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS notifications_time ON notifications (time);
+CREATE INDEX IF NOT EXISTS notifications_event ON notifications (event, time);
+CREATE INDEX IF NOT EXISTS notifications_job ON notifications (job, time);
+"""
+
+
+class History(object):
+    """
+    Every notification attempt, whether it was sent, failed, dropped or suppressed, in a SQLite database.
+
+    Recording only appends to a list, a background thread writes the rows in batches, one transaction per batch, with
+    the database in WAL mode so queries from the API do not block the writer. Rows older than the retention are
+    deleted once an hour.
+    """
+
+    def __init__(self, folder, retention_days=30, max_rows=100000, interval=2.0, logger=None):
+        self._path = os.path.join(folder, DATABASE)
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._pending = collections.deque(maxlen=MAX_PENDING)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.interval = interval
+
+        self.recorded = 0
+        self.written = 0
+        self.lost = 0
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="GotifyHistory")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def record(self, event, outcome, job=None, target=None, priority=None, title=None, message=None, status=None,
+               latency=None, attempt=None, error=None):
+        """
+        Remember a notification attempt, cheap enough for the comm thread
+        """
+        row = (time.time(), event, job, target, outcome, priority, title, message, status, latency, attempt, error)
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.lost += 1
+            self._pending.append(row)
+            self.recorded += 1
+
+    def _connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self._path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # a power loss may lose the last batch, but never corrupts the database
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _run(self):
+        # only imported once the history is written or read
+        import sqlite3
+
+        try:
+            connection = self._connect()
+            connection.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            self._logger.warning("Could not open the notification history %s: %s" % (self._path, str(e)))
+            return
+
+        next_prune = time.monotonic()
+        try:
+            while True:
+                stopping = self._stop.wait(self.interval)
+                try:
+                    self._write(connection)
+                    if time.monotonic() >= next_prune:
+                        next_prune = time.monotonic() + PRUNE_INTERVAL
+                        self._prune(connection)
+                except sqlite3.Error as e:
+                    self._logger.warning("Could not write the notification history: %s" % str(e))
+                if stopping:
+                    return
+        finally:
+            connection.close()
+
+    def _write(self, connection):
+        with self._lock:
+            if not self._pending:
+                return
+            rows = list(self._pending)
+            self._pending.clear()
+
+        with connection:
+            connection.executemany("INSERT INTO notifications (%s) VALUES (%s)"
+                                   % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), rows)
+        self.written += len(rows)
+
+    def _prune(self, connection):
+        with connection:
+            if self.retention_days:
+                connection.execute("DELETE FROM notifications WHERE time < ?",
+                                   (time.time() - self.retention_days * 24 * 60 * 60,))
+            if self.max_rows:
+                connection.execute("DELETE FROM notifications WHERE id <= "
+                                   "(SELECT id FROM notifications ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                                   (self.max_rows,))
+
+    def query(self, page=1, per_page=50, event=None, job=None, outcome=None, since=None, until=None):
+        """
+        One page of the history, newest first. Rows still waiting for the writer are not included.
+        :param page: starting with 1
+        :param per_page:
+        :param event: only attempts of this event
+        :param job: only attempts during this print job
+        :param outcome: only attempts with this outcome
+        :param since: unix time
+        :param until: unix time
+        :return: dict with the total number of matching rows and the rows of the page
+        """
+        page = max(1, int(page))
+        per_page = min(MAX_PER_PAGE, max(1, int(per_page)))
+
+        conditions = []
+        params = []
+        for column, value in (("event", event), ("job", job), ("outcome", outcome)):
+            if value:
+                conditions.append("%s = ?" % column)
+                params.append(value)
+        if since is not None:
+            conditions.append("time >= ?")
+            params.append(float(since))
+        if until is not None:
+            conditions.append("time < ?")
+            params.append(float(until))
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+        if not os.path.exists(self._path):
+            return dict(page=page, per_page=per_page, total=0, rows=[])
+
+        import sqlite3
+
+        connection = sqlite3.connect(self._path, timeout=10)
+        try:
+            total = connection.execute("SELECT COUNT(*) FROM notifications" + where, params).fetchone()[0]
+            cursor = connection.execute("SELECT id, %s FROM notifications%s ORDER BY time DESC, id DESC "
+                                        "LIMIT ? OFFSET ?" % (", ".join(COLUMNS), where),
+                                        params + [per_page, (page - 1) * per_page])
+            rows = [dict(zip(("id",) + COLUMNS, row)) for row in cursor]
+        except sqlite3.OperationalError:
+            # the writer has not created the table yet
+            total, rows = 0, []
+        finally:
+            connection.close()
+        return dict(page=page, per_page=per_page, total=total, rows=rows)
+
+    def get_stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return dict(pending=pending, recorded=self.recorded, written=self.written, lost=self.lost)
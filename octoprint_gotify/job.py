@@ -0,0 +1,222 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import json
+import math
+import os
+import time
+
+# degrees within the target after which a heater counts as settled, the heat up is no deviation
+SETTLED_WITHIN = 1.0
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds or 0))
+    if seconds >= 3600:
+        return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class Welford(object):
+    """
+    Running count, mean, standard deviation and maximum of a series in constant memory
+    """
+    __slots__ = ("count", "mean", "m2", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_dict(self):
+        return dict(count=self.count, mean=self.mean, std=self.std, max=self.max)
+
+
+class PrintJob(object):
+    """
+    State of the print in progress, created on PrintStarted and dropped when the print ends. Besides what the
+    notifications need to keep track of, it keeps statistics for the summary of the print, every one of them updated
+    in constant time and memory.
+    """
+    __slots__ = ("id", "name", "origin", "start_time", "start_monotonic", "end_monotonic", "first_line", "lines",
+                 "last_minute", "last_progress", "first_layer", "layer_index", "last_layer", "layer_started",
+                 "layer_times", "slowest_layer", "temp_targets", "temp_deviation", "pauses", "paused_time",
+                 "paused_since", "filament_changes", "result")
+
+    def __init__(self, job_id, name, origin, start_time, first_line):
+        """
+        :param job_id:
+        :param name: name of the printed file
+        :param origin: local or sdcard
+        :param start_time: datetime the print started
+        :param first_line: value of the gcode line counter when the print started
+        """
+        self.id = job_id
+        self.name = name
+        self.origin = origin
+        self.start_time = start_time
+        self.start_monotonic = time.monotonic()
+        self.end_monotonic = None
+        self.first_line = first_line
+        self.lines = 0
+        # elapsed minutes and percent already notified
+        self.last_minute = 0
+        self.last_progress = 0
+        # the first layer notification is still to be sent
+        self.first_layer = True
+        # layer index of the file being printed, None when it is not indexed
+        self.layer_index = None
+        self.last_layer = 0
+        self.layer_started = None
+        self.layer_times = Welford()
+        # (layer, seconds) of the layer which took longest
+        self.slowest_layer = None
+        # heater -> (target, settled) and heater -> Welford of the distance to the target once settled
+        self.temp_targets = {}
+        self.temp_deviation = {}
+        self.pauses = 0
+        self.paused_time = 0.0
+        self.paused_since = None
+        self.filament_changes = 0
+        # done or failed once the print ended
+        self.result = None
+
+    def record_temperature(self, heater, actual, target):
+        if not target:
+            self.temp_targets.pop(heater, None)
+            return
+
+        current = self.temp_targets.get(heater)
+        if current is None or current[0] != target or not current[1]:
+            settled = abs(actual - target) <= SETTLED_WITHIN
+            self.temp_targets[heater] = (target, settled)
+            if not settled:
+                return
+
+        deviation = self.temp_deviation.get(heater)
+        if deviation is None:
+            deviation = self.temp_deviation[heater] = Welford()
+        deviation.add(abs(actual - target))
+
+    def layer_changed(self, layer, now):
+        """
+        :param layer: the layer which is being printed now
+        :param now: monotonic time
+        """
+        if self.layer_started is not None and self.paused_since is None:
+            duration = now - self.layer_started
+            self.layer_times.add(duration)
+            if self.slowest_layer is None or duration > self.slowest_layer[1]:
+                self.slowest_layer = (self.last_layer, duration)
+        self.layer_started = now
+
+    def pause(self, now):
+        if self.paused_since is None:
+            self.pauses += 1
+            self.paused_since = now
+
+    def resume(self, now):
+        if self.paused_since is not None:
+            paused = now - self.paused_since
+            self.paused_time += paused
+            if self.layer_started is not None:
+                # the pause does not count into the time of the layer
+                self.layer_started += paused
+            self.paused_since = None
+
+    def finish(self, result, now, lines):
+        """
+        :param result: done or failed
+        :param now: monotonic time
+        :param lines: value of the gcode line counter when the print ended
+        """
+        self.resume(now)
+        self.result = result
+        self.end_monotonic = now
+        self.lines = lines - self.first_line
+
+    def to_dict(self):
+        end = self.end_monotonic if self.end_monotonic is not None else time.monotonic()
+        return dict(
+            id=self.id,
+            name=self.name,
+            origin=self.origin,
+            result=self.result,
+            start_time=self.start_time.isoformat() if self.start_time is not None else None,
+            duration=end - self.start_monotonic,
+            lines=self.lines,
+            layers=self.last_layer,
+            layer_times=self.layer_times.to_dict(),
+            slowest_layer=self.slowest_layer,
+            pauses=self.pauses,
+            paused_time=self.paused_time,
+            filament_changes=self.filament_changes,
+            temperature_deviation=dict((heater, deviation.to_dict())
+                                       for heater, deviation in self.temp_deviation.items()),
+        )
+
+    def format_summary(self):
+        """
+        :return: a few short lines for the notification
+        """
+        parts = ["%d lines" % self.lines]
+        if self.last_layer:
+            layers = "%d layers" % self.last_layer
+            if self.layer_times.count:
+                layers += " (avg %s" % format_duration(self.layer_times.mean)
+                if self.slowest_layer is not None:
+                    layers += ", slowest #%d %s" % (self.slowest_layer[0], format_duration(self.slowest_layer[1]))
+                layers += ")"
+            parts.append(layers)
+        lines = [", ".join(parts)]
+
+        parts = []
+        if self.pauses:
+            parts.append("paused %dx for %s" % (self.pauses, format_duration(self.paused_time)))
+        if self.filament_changes:
+            parts.append("%d filament change(s)" % self.filament_changes)
+        if parts:
+            lines.append(", ".join(parts).capitalize())
+
+        temperatures = ["%s %.1f°C (max %.1f°C)" % (heater, deviation.mean, deviation.max)
+                        for heater, deviation in sorted(self.temp_deviation.items()) if deviation.count]
+        if temperatures:
+            lines.append("Off target: " + ", ".join(temperatures))
+        return "\n".join(lines)
+
+
+def save_job(folder, job, max_files=100):
+    """
+    Write the statistics of a print as JSON file and keep only the newest max_files of them
+    :param folder:
+    :param job: PrintJob
+    :param max_files:
+    :return:
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    name = "%s-%s.json" % (job.start_time.strftime("%Y%m%d-%H%M%S"), job.id)
+    tmp_path = os.path.join(folder, name + ".tmp")
+    with io.open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(job.to_dict(), separators=(",", ":")))
+    os.replace(tmp_path, os.path.join(folder, name))
+
+    files = sorted(name for name in os.listdir(folder) if name.endswith(".json"))
+    for old in files[:-max_files] if max_files else ():
+        os.remove(os.path.join(folder, old))
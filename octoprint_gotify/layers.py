@@ -0,0 +1,311 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+LOOKUP = "lookup.json"
+# loaded indexes kept in memory
+MAX_LOADED = 4
+# a layer starts when the nozzle extrudes at least this much higher than the previous layer
+MIN_LAYER_HEIGHT = 0.01
+GCODE_EXTENSIONS = (".gcode", ".gco", ".g")
+
+# moves which set the height, the regexes skip everything else in C
+_z_move = re.compile(br"^[ \t]*G0?[01](?![0-9])[^;\n]*?Z[ \t]*(-?\d+\.?\d*|-?\.\d+)", re.M)
+# moves in X/Y which extrude, a negative E is a retraction while wiping
+_extrusion = re.compile(br"^[ \t]*G0?1(?![0-9])[^;\n]*?[XY][^;\n]*?E[ \t]*\.?\d", re.M)
+
+
+class LayerIndex(object):
+    """
+    Z height and byte offset of every layer of a gcode file, the layer printed at a file position is a bisect
+    """
+    __slots__ = ("heights", "offsets", "size")
+
+    def __init__(self, heights, offsets, size):
+        self.heights = heights
+        self.offsets = offsets
+        self.size = size
+
+    @property
+    def count(self):
+        return len(self.offsets)
+
+    def layer_at(self, filepos):
+        """
+        :param filepos: byte offset in the file
+        :return: the number of the layer at that position, starting with 1, 0 before the first layer
+        """
+        return bisect.bisect_right(self.offsets, filepos)
+
+    def height(self, layer):
+        if 0 < layer <= len(self.heights):
+            return self.heights[layer - 1]
+        return None
+
+    def to_dict(self):
+        return dict(heights=self.heights, offsets=self.offsets, size=self.size)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["heights"], data["offsets"], data["size"])
+
+
+def scan(f, chunk_size=CHUNK_SIZE):
+    """
+    Build the layer index of a gcode file, reading it in chunks so the size of the file does not matter.
+
+    Every move to a new height is a candidate for the next layer. It becomes a layer when the nozzle extrudes before
+    the next move in Z, so z-hops, travel moves and the final lift are not counted.
+    :param f: file opened in binary mode
+    :param chunk_size:
+    :return: LayerIndex
+    """
+    heights = []
+    offsets = []
+    layer_z = None
+    # height of the candidate and where to look for its first extrusion in the current chunk, or None
+    candidate = None
+    search_from = 0
+
+    base = 0
+    tail = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if chunk:
+            data = tail + chunk
+            end = data.rfind(b"\n") + 1
+            tail = data[end:]
+        else:
+            # the last line may not end with a newline
+            data = tail
+            end = len(data)
+
+        for match in _z_move.finditer(data, 0, end):
+            if candidate is not None:
+                extrusion = _extrusion.search(data, search_from, match.start())
+                if extrusion is not None:
+                    layer_z = candidate
+                    heights.append(candidate)
+                    offsets.append(base + extrusion.start())
+
+            z = float(match.group(1))
+            if layer_z is None or z >= layer_z + MIN_LAYER_HEIGHT:
+                candidate = z
+                # the move itself may extrude, e.g. in vase mode
+                search_from = match.start()
+            else:
+                candidate = None
+
+        if candidate is not None:
+            extrusion = _extrusion.search(data, search_from, end)
+            if extrusion is not None:
+                layer_z = candidate
+                heights.append(candidate)
+                offsets.append(base + extrusion.start())
+                candidate = None
+            search_from = 0
+
+        if not chunk:
+            return LayerIndex(heights, offsets, base + end)
+        base += end
+
+
+def digest(f, chunk_size=CHUNK_SIZE):
+    h = hashlib.sha1()
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+class LayerIndexer(object):
+    """
+    Builds the layer indexes of uploaded gcode files in the background and caches them on disk by the hash of the
+    file, so a file which was uploaded again under another name is not scanned again. Files are looked up by path,
+    size and modification time, or by name and size for files on the SD card.
+    """
+
+    def __init__(self, folder, logger=None):
+        self._folder = folder
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # path -> (size, mtime, digest)
+        self._files = {}
+        # digest -> LayerIndex, most recently used last
+        self._loaded = collections.OrderedDict()
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._thread = None
+
+        self.scanned = 0
+        self.reused = 0
+
+    def start(self):
+        if not os.path.isdir(self._folder):
+            os.makedirs(self._folder)
+        try:
+            with io.open(os.path.join(self._folder, LOOKUP), "r", encoding="utf-8") as f:
+                self._files = dict((path, tuple(entry)) for path, entry in json.load(f).items())
+        except (IOError, OSError, ValueError):
+            self._files = {}
+
+        self._thread = threading.Thread(target=self._run, name="GotifyLayerIndexer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+
+    def submit(self, path):
+        """
+        Index a file in the background, unless it is indexed already
+        :param path: path of the file on disk
+        :return:
+        """
+        if not path.lower().endswith(GCODE_EXTENSIONS):
+            return
+        with self._lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+        self._queue.put((self._index, path))
+
+    def submit_folder(self, folder):
+        """
+        Index every gcode file below a folder which is not indexed yet and forget the files which are gone, in the
+        background as well
+        :param folder:
+        :return:
+        """
+        self._queue.put((self._walk, folder))
+
+    def _walk(self, folder):
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                if path.lower().endswith(GCODE_EXTENSIONS) and not self._is_current(path):
+                    self.submit(path)
+
+        with self._lock:
+            gone = [path for path in self._files if not os.path.exists(path)]
+            for path in gone:
+                del self._files[path]
+        if gone:
+            self._save_lookup()
+
+    def get(self, path):
+        """
+        :param path: path of the file on disk
+        :return: the LayerIndex of the file, or None when it is not indexed (yet)
+        """
+        with self._lock:
+            entry = self._files.get(path)
+        if entry is None or not self._is_current(path):
+            self.submit(path)
+            return None
+        return self._load(entry[2])
+
+    def find(self, name, size):
+        """
+        Find the index of a file which is not on disk, e.g. printed from the SD card
+        :param name: file name, compared case insensitive
+        :param size: size of the file in bytes
+        :return: LayerIndex or None
+        """
+        name = os.path.basename(name or "").lower()
+        with self._lock:
+            digests = [entry[2] for path, entry in self._files.items()
+                       if entry[0] == size and os.path.basename(path).lower() == name]
+        return self._load(digests[0]) if digests else None
+
+    def _is_current(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        with self._lock:
+            entry = self._files.get(path)
+        return entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime
+
+    def _load(self, file_digest):
+        with self._lock:
+            index = self._loaded.get(file_digest)
+            if index is not None:
+                self._loaded.move_to_end(file_digest)
+                return index
+        try:
+            with io.open(os.path.join(self._folder, file_digest + ".json"), "r", encoding="utf-8") as f:
+                index = LayerIndex.from_dict(json.load(f))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        self._remember(file_digest, index)
+        return index
+
+    def _remember(self, file_digest, index):
+        with self._lock:
+            self._loaded[file_digest] = index
+            while len(self._loaded) > MAX_LOADED:
+                self._loaded.popitem(last=False)
+
+    def _save_lookup(self):
+        with self._lock:
+            files = dict(self._files)
+        tmp_path = os.path.join(self._folder, LOOKUP + ".tmp")
+        with io.open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(files))
+        os.replace(tmp_path, os.path.join(self._folder, LOOKUP))
+
+    def _index(self, path):
+        if self._is_current(path):
+            return
+        stat = os.stat(path)
+        with io.open(path, "rb") as f:
+            file_digest = digest(f)
+            index_path = os.path.join(self._folder, file_digest + ".json")
+            if os.path.exists(index_path):
+                self.reused += 1
+            else:
+                f.seek(0)
+                index = scan(f)
+                tmp_path = index_path + ".tmp"
+                with io.open(tmp_path, "w", encoding="utf-8") as out:
+                    out.write(json.dumps(index.to_dict(), separators=(",", ":")))
+                os.replace(tmp_path, index_path)
+                self._remember(file_digest, index)
+                self.scanned += 1
+                self._logger.debug("Indexed %d layers of %s", index.count, path)
+
+        with self._lock:
+            self._files[path] = (stat.st_size, stat.st_mtime, file_digest)
+        self._save_lookup()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            run, path = job
+            try:
+                run(path)
+            except (IOError, OSError) as e:
+                self._logger.info("Could not index the layers of %s: %s" % (path, str(e)))
+            except Exception:
+                self._logger.exception("Error while indexing the layers of %s" % path)
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(files=len(self._files), loaded=len(self._loaded), queued=len(self._queued),
+                        scanned=self.scanned, reused=self.reused)
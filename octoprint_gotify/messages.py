@@ -0,0 +1,109 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+import string
+
+# placeholders every event message may use
+COMMON_FIELDS = ("payload",)
+
+# additional placeholders per event
+EVENT_FIELDS = {
+    "Scheduled": ("elapsed_time",),
+    "Progress": ("percentage",),
+    "TempReached": ("heater", "temp", "target", "bed_temp", "bed_target", "e1_temp", "e1_target"),
+    "PrintDone": ("file", "elapsed_time", "elapsed_time_in_seconds", "throughput", "summary"),
+    "PrintFailed": ("file", "summary"),
+    "PrintPaused": ("m70_cmd",),
+    "Waiting": ("m70_cmd",),
+    "FilamentChange": ("m70_cmd",),
+    "Error": ("error",),
+    "ZChange": ("layer", "layers", "z"),
+    "Layer": ("layer", "layers", "z"),
+    "Throughput": ("reason", "rate", "gap"),
+}
+
+_formatter = string.Formatter()
+_field_root = re.compile(r"^[^.\[]*")
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class _Context(dict):
+    """
+    Placeholders without a value render as empty string instead of raising a KeyError in the middle of a print
+    """
+
+    def __missing__(self, key):
+        return ""
+
+
+class MessageTemplate(object):
+    """
+    An event message parsed and validated once, rendering only needs the values of its placeholders
+    """
+    __slots__ = ("event", "source", "fields")
+
+    def __init__(self, event, source):
+        self.event = event
+        self.source = source or ""
+        self.fields = parse_fields(event, self.source)
+
+    def render(self, **context):
+        return self.source.format_map(_Context(context))
+
+
+def get_allowed_fields(event):
+    return COMMON_FIELDS + EVENT_FIELDS.get(event, ())
+
+
+def parse_fields(event, source):
+    """
+    :param event:
+    :param source: the message with str.format placeholders
+    :return: frozenset of the placeholder names used by the message
+    :raises TemplateError: when the message can not be parsed or uses unknown placeholders
+    """
+    allowed = get_allowed_fields(event)
+
+    fields = set()
+    try:
+        for _, field_name, format_spec, _ in _formatter.parse(source):
+            if field_name is None:
+                continue
+            name = _field_root.match(field_name).group(0)
+            if not name or name.isdigit():
+                raise TemplateError("positional placeholders are not supported, use one of: %s" % ", ".join(allowed))
+            if name not in allowed:
+                raise TemplateError("unknown placeholder {%s}, use one of: %s" % (name, ", ".join(allowed)))
+            if format_spec and "{" in format_spec:
+                raise TemplateError("nested placeholders are not supported")
+            fields.add(name)
+    except ValueError as e:
+        if isinstance(e, TemplateError):
+            raise
+        raise TemplateError(str(e))
+
+    return frozenset(fields)
+
+
+def compile_templates(events, defaults, logger=None):
+    """
+    Compile the messages of all events, an invalid message falls back to the default message of the event
+    :param events: the events settings
+    :param defaults: the default events settings
+    :param logger:
+    :return: dict of event -> MessageTemplate
+    """
+    templates = {}
+    for event, default in defaults.items():
+        message = (events.get(event) or {}).get("message", default.get("message"))
+        try:
+            templates[event] = MessageTemplate(event, message)
+        except TemplateError as e:
+            if logger is not None:
+                logger.error("Message of event %s is invalid (%s), using the default message" % (event, str(e)))
+            templates[event] = MessageTemplate(event, default.get("message"))
+    return templates
@@ -0,0 +1,138 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+
+# upper bounds in seconds, roughly logarithmic from 10us to 60s
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram(object):
+    """
+    Fixed size histogram. Observing is a bisect and two additions without a lock, under heavy contention a sample may
+    get lost, which is fine for statistics and keeps the comm thread from waiting.
+    """
+    __slots__ = ("name", "help", "counts", "sum", "count", "max")
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        # the last bucket collects everything above the largest bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within the bucket it falls into
+        :param q: between 0 and 1
+        :return:
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else max(self.max, lower)
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            avg=self.sum / self.count if self.count else None,
+            max=self.max,
+            p50=self.quantile(0.5),
+            p95=self.quantile(0.95),
+            p99=self.quantile(0.99),
+        )
+
+    def to_prometheus(self, lines):
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s histogram" % self.name)
+        cumulative = 0
+        counts = list(self.counts)
+        for bound, count in zip(BUCKETS, counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, repr(bound), cumulative))
+        cumulative += counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, cumulative))
+        lines.append("%s_sum %r" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, cumulative))
+
+
+class Metrics(object):
+    """
+    Latency histograms of the hot paths plus notification counters per event and outcome
+    """
+
+    def __init__(self):
+        self.event_to_send = Histogram("gotify_event_to_send_seconds",
+                                       "Time from the event to the delivery of the notification")
+        self.express = Histogram("gotify_express_event_to_send_seconds",
+                                 "Time from the event to the delivery of the critical notifications")
+        self.http_rtt = Histogram("gotify_http_round_trip_seconds", "Round trip time of the requests to gotify")
+        self.snapshot_fetch = Histogram("gotify_snapshot_fetch_seconds", "Time to fetch a webcam snapshot")
+        self.snapshot_encode = Histogram("gotify_snapshot_encode_seconds", "Time to transform and encode a snapshot")
+        self.gcode_hook = Histogram("gotify_gcode_hook_seconds", "Time spent in the gcode sent hook, sampled")
+        self.on_event = Histogram("gotify_on_event_seconds", "Time spent handling subscribed events")
+        self.timer_tick = Histogram("gotify_timer_tick_seconds", "Time spent in the background timers")
+        self.histograms = (self.event_to_send, self.express, self.http_rtt, self.snapshot_fetch, self.snapshot_encode,
+                           self.gcode_hook, self.on_event, self.timer_tick)
+        # (event, outcome) -> count
+        self.notifications = {}
+
+    def count(self, event, outcome):
+        key = (event or "test", outcome)
+        self.notifications[key] = self.notifications.get(key, 0) + 1
+
+    def to_dict(self):
+        notifications = {}
+        for (event, outcome), count in list(self.notifications.items()):
+            notifications.setdefault(event, {})[outcome] = count
+        return dict(
+            latency=dict((histogram.name, histogram.to_dict()) for histogram in self.histograms),
+            notifications=notifications,
+        )
+
+    def to_prometheus(self, gauges=None):
+        """
+        :param gauges: additional dict of name -> (help, value)
+        :return: the metrics in the prometheus text exposition format
+        """
+        lines = []
+        for histogram in self.histograms:
+            histogram.to_prometheus(lines)
+
+        lines.append("# HELP gotify_notifications_total Notifications by event and outcome")
+        lines.append("# TYPE gotify_notifications_total counter")
+        for (event, outcome), count in sorted(self.notifications.items()):
+            lines.append('gotify_notifications_total{event="%s",outcome="%s"} %d' % (event, outcome, count))
+
+        for name, (help_text, value) in sorted((gauges or {}).items()):
+            if value is None:
+                continue
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %r" % (name, value))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,330 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import glob
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from .sender import Notification
+
+JOURNAL = "outbox.journal"
+# journals of the previous run, renamed on startup and replayed in the background
+REPLAY_PATTERN = "outbox.journal.replay-*"
+
+
+class Outbox(object):
+    """
+    Append only journal of the notifications which have not been delivered yet, so they survive gotify outages and
+    OctoPrint restarts. Every line is a JSON record, either
+
+    - {"op": "add", "id": ..., "time": ..., "event": ..., "priority": ..., "image": ..., "thumbnail": ...,
+      "job": ..., "attempt": ..., "targets": [...], "payload": {...}}
+    - {"op": "done", "id": ..., "target": ...}, the notification was delivered to that target, or given up entirely
+      without a target
+
+    Appending only writes to a buffered file, the background thread fsyncs in batches, replays failed notifications in
+    order once the server is reachable again and compacts the journal when it is mostly made of settled records.
+    """
+
+    def __init__(self, folder, max_bytes=1024 * 1024, max_age=12 * 60 * 60, retry_interval=60, sync_interval=1.0,
+                 on_tick=None, logger=None):
+        self._folder = folder
+        # receives the duration of every background tick
+        self._on_tick = on_tick
+        self._path = os.path.join(folder, JOURNAL)
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        self._file = None
+        self._dirty = False
+        # id -> (record, size in bytes), in journal order
+        self._pending = collections.OrderedDict()
+        self._pending_bytes = 0
+        # id -> targets the notification could not be delivered to, waiting for a replay
+        self._failed = {}
+        self._settled = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.sync_interval = sync_interval
+
+        self.replayed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def start(self, deliver, enqueue):
+        """
+        Start journaling, the journal of the previous run is loaded and replayed in the background. Notifications
+        added before are written to the new journal
+        :param deliver: callable delivering a Notification right away, used to probe a target
+        :param enqueue: callable queuing a Notification for its targets, all current targets of the event when the
+        record has none
+        :return:
+        """
+        if not os.path.isdir(self._folder):
+            os.makedirs(self._folder)
+        if os.path.exists(self._path):
+            os.rename(self._path, "%s.replay-%d" % (self._path, int(time.time() * 1000)))
+        with self._lock:
+            self._file = io.open(self._path, "a", encoding="utf-8")
+            for record, _ in self._pending.values():
+                self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+                self._dirty = True
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(deliver, enqueue), name="GotifyOutbox")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def add(self, notification):
+        """
+        Journal a notification before it is queued, cheap enough for the comm thread
+        :param notification:
+        :return: id of the journal record
+        """
+        record = dict(op="add", id=uuid.uuid4().hex, time=time.time(), event=notification.event,
+                      priority=notification.priority, image=notification.image, thumbnail=notification.thumbnail,
+                      job=notification.job, attempt=notification.attempt, targets=list(notification.targets or ()),
+                      payload=notification.payload)
+        with self._lock:
+            self._append(record)
+        return record["id"]
+
+    def settle(self, record_id, target, delivered):
+        """
+        Mark a journaled notification as delivered to a target, or as failed so it is replayed to that target later
+        :param record_id:
+        :param target: name of the target
+        :param delivered:
+        :return:
+        """
+        if record_id is None:
+            return
+        with self._lock:
+            if record_id not in self._pending:
+                return
+            if delivered:
+                self._done(record_id, target)
+            else:
+                self._failed.setdefault(record_id, set()).add(target)
+
+    def discard(self, record_id, target=None):
+        """
+        Forget a notification which was dropped on purpose, e.g. by the queue overflow policy
+        :param record_id:
+        :param target: name of the target which dropped it, None for all
+        :return:
+        """
+        if record_id is None:
+            return
+        with self._lock:
+            if record_id in self._pending:
+                self._done(record_id, target)
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        if self._file is not None:
+            self._file.write(line)
+            self._dirty = True
+        if record["op"] == "add":
+            self._pending[record["id"]] = (record, len(line))
+            self._pending_bytes += len(line)
+            while self._pending_bytes > self.max_bytes and len(self._pending) > 1:
+                oldest = next(iter(self._pending))
+                self.evicted += 1
+                self._logger.warning("Outbox is full, dropping the oldest undelivered notification")
+                self._done(oldest)
+
+    def _done(self, record_id, target=None):
+        record, size = self._pending[record_id]
+        if self._file is not None:
+            self._file.write(json.dumps(dict(op="done", id=record_id, target=target), separators=(",", ":")) + "\n")
+            self._dirty = True
+
+        if target is not None and target in record["targets"]:
+            record["targets"].remove(target)
+            failed = self._failed.get(record_id)
+            if failed is not None:
+                failed.discard(target)
+            if record["targets"]:
+                return
+
+        del self._pending[record_id]
+        self._pending_bytes -= size
+        self._failed.pop(record_id, None)
+        self._settled += 1
+
+    def _sync(self):
+        if self._dirty and self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _compact(self):
+        """
+        Rewrite the journal with the pending records only, called with the lock held
+        :return:
+        """
+        tmp_path = self._path + ".tmp"
+        with io.open(tmp_path, "w", encoding="utf-8") as f:
+            for record, _ in self._pending.values():
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self._path)
+        self._file = io.open(self._path, "a", encoding="utf-8")
+        self._dirty = False
+        self._settled = 0
+
+    def _load_previous(self):
+        """
+        Re-journal the undelivered notifications of the previous run(s) and mark them for replay
+        :return:
+        """
+        pending = collections.OrderedDict()
+        paths = sorted(glob.glob(os.path.join(self._folder, REPLAY_PATTERN)))
+        for path in paths:
+            try:
+                with io.open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # torn write at the end of the journal
+                            continue
+                        if record.get("op") == "add":
+                            record.setdefault("targets", [])
+                            pending[record["id"]] = record
+                        elif record.get("op") == "done" and record.get("id") in pending:
+                            targets = pending[record["id"]]["targets"]
+                            if record.get("target") in targets:
+                                targets.remove(record["target"])
+                            if record.get("target") is None or not targets:
+                                del pending[record["id"]]
+            except (IOError, OSError) as e:
+                self._logger.warning("Could not read outbox journal %s: %s" % (path, str(e)))
+
+        now = time.time()
+        with self._lock:
+            for record in sorted(pending.values(), key=lambda r: r.get("time", 0)):
+                if now - record.get("time", 0) > self.max_age:
+                    self.expired += 1
+                    continue
+                self._append(record)
+                self._failed[record["id"]] = set(record["targets"] or [None])
+            self._sync()
+
+        for path in paths:
+            os.remove(path)
+
+        if pending:
+            self._logger.info("Loaded %d undelivered notification(s) from the outbox" % len(pending))
+
+    def _replay(self, deliver, enqueue):
+        """
+        Per target, probe with the oldest failed notification and when it gets through queue the others in order
+        :return:
+        """
+        now = time.time()
+        by_target = collections.OrderedDict()
+        with self._lock:
+            for record_id, (record, _) in list(self._pending.items()):
+                targets = self._failed.pop(record_id, None)
+                if not targets:
+                    continue
+                if now - record.get("time", 0) > self.max_age:
+                    self.expired += 1
+                    self._done(record_id)
+                    continue
+                record["attempt"] = record.get("attempt", 1) + 1
+                for target in targets:
+                    by_target.setdefault(target, []).append(record)
+
+        for target, records in by_target.items():
+            # deliver settles the journal record of the probe itself
+            notifications = [self._to_notification(record, target) for record in records]
+            if not deliver(notifications[0]):
+                # still unreachable, try again later
+                for notification in notifications[1:]:
+                    self.settle(notification.outbox_id, target, False)
+                continue
+
+            self.replayed += len(notifications)
+            for notification in notifications[1:]:
+                enqueue(notification)
+
+    @staticmethod
+    def _to_notification(record, target):
+        # replayed without the image, a snapshot taken now would not show what happened back then
+        notification = Notification(record.get("event"), record.get("payload") or {}, record.get("priority") or 0)
+        notification.outbox_id = record["id"]
+        notification.job = record.get("job")
+        notification.attempt = record.get("attempt", 1)
+        notification.targets = (target,) if target is not None else None
+        return notification
+
+    def _run(self, deliver, enqueue):
+        try:
+            self._load_previous()
+        except Exception:
+            self._logger.exception("Error while loading the outbox journal")
+
+        next_replay = time.monotonic()
+        while not self._stop.wait(self.sync_interval):
+            start = time.monotonic()
+            try:
+                with self._lock:
+                    fd = None
+                    if self._dirty and self._file is not None:
+                        self._file.flush()
+                        fd = self._file.fileno()
+                        self._dirty = False
+                # fsync outside of the lock, appending from the comm thread must never wait for the disk
+                if fd is not None:
+                    os.fsync(fd)
+
+                with self._lock:
+                    if self._settled > 100 and self._settled > 2 * len(self._pending):
+                        self._compact()
+            except (IOError, OSError, ValueError) as e:
+                self._logger.warning("Could not write the outbox journal: %s" % str(e))
+
+            if self._failed and time.monotonic() >= next_replay:
+                next_replay = time.monotonic() + self.retry_interval
+                try:
+                    self._replay(deliver, enqueue)
+                except Exception:
+                    self._logger.exception("Error while replaying the outbox")
+
+            if self._on_tick is not None:
+                self._on_tick(time.monotonic() - start)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                pending=len(self._pending),
+                pending_bytes=self._pending_bytes,
+                failed=len(self._failed),
+                replayed=self.replayed,
+                expired=self.expired,
+                evicted=self.evicted,
+            )
@@ -0,0 +1,325 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import logging
+import threading
+import time
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_LOWEST_PRIORITY = "drop_lowest_priority"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_LOWEST_PRIORITY, OVERFLOW_COALESCE)
+# share of the queue size from which notifications below the shed priority are dropped right away
+SHED_AT = 0.5
+
+
+class Notification(object):
+    """
+    A single message on its way to the gotify server
+    """
+    __slots__ = ("event", "payload", "priority", "image", "thumbnail", "created", "targets", "outbox_id", "job",
+                 "attempt")
+
+    def __init__(self, event, payload, priority=0, image=False, thumbnail=None):
+        self.event = event
+        self.payload = payload
+        self.priority = priority
+        # attach a webcam snapshot, fetched by the sender thread
+        self.image = image
+        # gcode file whose slicer thumbnail is attached when there is no webcam snapshot
+        self.thumbnail = thumbnail
+        self.created = time.monotonic()
+        # names of the targets to deliver to, None for all
+        self.targets = None
+        # journal record while the notification is undelivered
+        self.outbox_id = None
+        # id of the print job the notification was sent during, for the history
+        self.job = None
+        # delivery attempt, counted up when the outbox replays the notification
+        self.attempt = 1
+
+    def copy(self):
+        """
+        :return: a notification of its own for another target, coalescing in one queue must not change the others
+        """
+        notification = Notification(self.event, self.payload, self.priority, self.image, self.thumbnail)
+        notification.created = self.created
+        notification.targets = self.targets
+        notification.outbox_id = self.outbox_id
+        notification.job = self.job
+        notification.attempt = self.attempt
+        return notification
+
+
+class NotificationSender(object):
+    """
+    Bounded queue drained by a single worker thread, so that hooks running on the comm or event thread never have to
+    wait for the gotify server. Every target has one, so its backlog is where a slow server makes it build up. When
+    the queue is full the configured overflow policy decides what is thrown away:
+
+    - drop_oldest: the oldest queued notification is dropped
+    - drop_lowest_priority: the queued notification with the lowest priority (oldest first) is dropped, or the new one
+      if it has an even lower priority
+    - coalesce: a queued notification of the same event takes over the new message, otherwise the oldest is dropped
+
+    Before it comes to that, notifications below the shed priority are dropped as soon as the queue is half full, so
+    the room left goes to the more important ones. The worker takes the notification of the highest priority first,
+    in order within a priority.
+    """
+
+    def __init__(self, deliver, size=32, overflow=OVERFLOW_DROP_OLDEST, shed_priority=0, on_drop=None,
+                 on_stopped=None, name="GotifySender", logger=None):
+        """
+        :param deliver: callable receiving a Notification, returns True when it was delivered
+        :param on_drop: callable receiving every Notification which is dropped without delivery
+        :param on_stopped: callable called once after stop, when the queue is drained, on the worker thread or right
+        away when there is none
+        :param size: maximum number of queued notifications
+        :param overflow: one of OVERFLOW_POLICIES
+        :param shed_priority: notifications below this priority are shed under pressure, 0 sheds nothing
+        :param name: name of the worker thread
+        :param logger:
+        """
+        self._deliver = deliver
+        self._name = name
+        self._on_drop = on_drop
+        self._on_stopped = on_stopped
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._queue = collections.deque()
+        # newest queued notification per event, only used to coalesce
+        self._latest = {}
+        self._thread = None
+        self._running = False
+
+        self.size = 1
+        self.overflow = OVERFLOW_DROP_OLDEST
+        self.shed_priority = 0
+        self.configure(size, overflow, shed_priority)
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.shed = 0
+        self.coalesced = 0
+
+    def configure(self, size, overflow, shed_priority=0):
+        """
+        Apply new queue settings, an already queued backlog is kept
+        :param size:
+        :param overflow:
+        :param shed_priority:
+        :return:
+        """
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            size = 32
+        if overflow not in OVERFLOW_POLICIES:
+            self._logger.warning("Unknown overflow policy %r, falling back to %s", overflow, OVERFLOW_DROP_OLDEST)
+            overflow = OVERFLOW_DROP_OLDEST
+
+        with self._lock:
+            self.size = max(1, size)
+            self.overflow = overflow
+            self.shed_priority = shed_priority or 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def alive(self):
+        """
+        :return: True while the worker thread is delivering
+        """
+        return self._thread is not None
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def start(self):
+        """
+        Accept notifications, the worker thread is started with the first one
+        :return:
+        """
+        with self._lock:
+            self._running = True
+
+    def _start_thread(self):
+        # called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self._name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, drain=True, timeout=None, wait=True):
+        """
+        Stop the worker thread
+        :param drain: deliver the queued notifications before stopping
+        :param timeout: maximum seconds to wait for the worker
+        :param wait: wait for the worker, otherwise it drains the queue in the background. Also waits for a worker
+        which was stopped before without waiting
+        :return: True when the worker has stopped
+        """
+        with self._condition:
+            stopping = self._running
+            if stopping:
+                self._running = False
+                if not drain:
+                    self.dropped += len(self._queue)
+                    for notification in self._queue:
+                        self._dropped(notification)
+                    self._queue.clear()
+                    self._latest.clear()
+                self._condition.notify()
+            thread = self._thread
+
+        if thread is None:
+            if stopping:
+                self._stopped()
+            return True
+        if not wait:
+            return not thread.is_alive()
+        thread.join(timeout)
+        if thread.is_alive():
+            self._logger.warning("%s did not finish within %ss, %d notification(s) left behind",
+                                 self._name, timeout, len(self._queue))
+            return False
+        return True
+
+    def enqueue(self, notification):
+        """
+        Queue a notification, never blocks on the network
+        :param notification:
+        :return: False when the notification itself was dropped
+        """
+        with self._condition:
+            if not self._running:
+                self.dropped += 1
+                self._logger.debug("Sender is not running, dropping %s notification", notification.event)
+                self._dropped(notification)
+                return False
+
+            self.enqueued += 1
+            if notification.priority < self.shed_priority and len(self._queue) >= self.size * SHED_AT:
+                self.shed += 1
+                self.dropped += 1
+                self._logger.debug("Sender is behind, shedding %s notification", notification.event)
+                self._dropped(notification)
+                return False
+
+            if len(self._queue) >= self.size:
+                queued = self._latest.get(notification.event) if self.overflow == OVERFLOW_COALESCE else None
+                if queued is not None:
+                    # take over the slot of the queued notification, the newest message wins
+                    queued.payload = notification.payload
+                    queued.priority = notification.priority
+                    queued.image = notification.image
+                    queued.thumbnail = notification.thumbnail
+                    queued.targets = notification.targets
+                    # the queued notification now stands for the new one, the replaced message is gone
+                    queued.outbox_id, notification.outbox_id = notification.outbox_id, queued.outbox_id
+                    self._dropped(notification)
+                    self.coalesced += 1
+                    return True
+                if not self._make_room(notification):
+                    return False
+
+            self._queue.append(notification)
+            self._latest[notification.event] = notification
+            self._start_thread()
+            self._condition.notify()
+            return True
+
+    def _make_room(self, notification):
+        """
+        Called with the lock held when the queue is full
+        :param notification: the notification which is about to be queued
+        :return: False when the new notification should be dropped instead
+        """
+        if self.overflow == OVERFLOW_DROP_LOWEST_PRIORITY:
+            # bounded by the queue size
+            lowest = min(self._queue, key=lambda n: n.priority)
+            if notification.priority < lowest.priority:
+                self.dropped += 1
+                self._dropped(notification)
+                return False
+            self._remove(lowest)
+            self._dropped(lowest)
+        else:
+            oldest = self._queue[0]
+            self._remove(oldest)
+            self._dropped(oldest)
+
+        self.dropped += 1
+        return True
+
+    def _remove(self, notification):
+        if self._queue[0] is notification:
+            self._queue.popleft()
+        else:
+            self._queue.remove(notification)
+        if self._latest.get(notification.event) is notification:
+            del self._latest[notification.event]
+
+    def _dropped(self, notification):
+        if self._on_drop is None:
+            return
+        try:
+            self._on_drop(notification)
+        except Exception:
+            self._logger.exception("Error while dropping %s notification", notification.event)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._queue:
+                    self._thread = None
+                    break
+                # the first one of the highest priority, bounded by the queue size
+                notification = max(self._queue, key=lambda n: n.priority) if len(self._queue) > 1 else self._queue[0]
+                self._remove(notification)
+
+            try:
+                delivered = self._deliver(notification)
+            except Exception:
+                self._logger.exception("Error while delivering %s notification", notification.event)
+                delivered = False
+
+            if delivered:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+        self._stopped()
+
+    def _stopped(self):
+        if self._on_stopped is None:
+            return
+        try:
+            self._on_stopped()
+        except Exception:
+            self._logger.exception("Error while stopping %s", self._name)
+
+    def get_stats(self):
+        with self._lock:
+            depth = len(self._queue)
+        return dict(
+            depth=depth,
+            size=self.size,
+            overflow=self.overflow,
+            enqueued=self.enqueued,
+            sent=self.sent,
+            failed=self.failed,
+            dropped=self.dropped,
+            shed=self.shed,
+            coalesced=self.coalesced,
+            drop_rate=float(self.dropped) / self.enqueued if self.enqueued else 0.0,
+        )
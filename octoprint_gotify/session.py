@@ -0,0 +1,80 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+
+# server side errors which are worth another try, gotify did not store the message
+RETRY_STATUS = (500, 502, 503, 504)
+RETRY_METHODS = frozenset(["GET", "POST"])
+
+_retry_class = None
+
+
+def get_retry_class():
+    """
+    The Retry subclass is created on first use, so importing the plugin does not import requests and urllib3
+    :return: JitteredRetry
+    """
+    global _retry_class
+    if _retry_class is None:
+        from urllib3.util.retry import Retry
+
+        class JitteredRetry(Retry):
+            """
+            Exponential backoff with full jitter, so that a farm of printers does not hammer a recovering server in
+            lockstep
+            """
+
+            def get_backoff_time(self):
+                backoff = super(JitteredRetry, self).get_backoff_time()
+                if backoff <= 0:
+                    return 0
+                return random.uniform(0, backoff)
+
+        _retry_class = JitteredRetry
+    return _retry_class
+
+
+def create_retry(retries, backoff_factor):
+    """
+    Retry connection errors and 5xx responses. Read errors are not retried because the server might already have
+    stored the message.
+    :param retries:
+    :param backoff_factor:
+    :return:
+    """
+    kwargs = dict(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False,
+    )
+    retry_class = get_retry_class()
+    try:
+        return retry_class(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return retry_class(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def create_session(pool_size=4, retries=3, backoff_factor=0.5):
+    """
+    Create a keep-alive session with its own connection pool, shared by all gotify and webcam requests
+    :param pool_size: number of connections kept open per host
+    :param retries:
+    :param backoff_factor:
+    :return:
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=create_retry(retries, backoff_factor))
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
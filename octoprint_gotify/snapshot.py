@@ -0,0 +1,476 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import TimeoutError
+from io import BytesIO
+
+# the encoder gives up lowering the quality below this and shrinks the image instead
+MIN_QUALITY = 40
+QUALITY_STEP = 15
+SHRINK_FACTOR = 0.75
+
+# start of frame markers, they carry the size of the image
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - frozenset([0xC4, 0xC8, 0xCC])
+
+_image = None
+
+
+def load_pil():
+    """
+    Import Pillow on first use, most snapshots pass through without it
+    :return: the PIL.Image module
+    """
+    global _image
+    if _image is None:
+        from PIL import Image
+        _image = Image
+    return _image
+
+
+def jpeg_size(data):
+    """
+    Read the size of a JPEG image from its header, without decoding it
+    :param data:
+    :return: (width, height) or None when data is not a JPEG image
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in SOF_MARKERS:
+            return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # markers without a length
+            i += 2
+            continue
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+class SnapshotProcessor(object):
+    """
+    Turns a webcam frame into a JPEG which is oriented like the webcam stream in OctoPrint and fits the configured
+    resolution and byte budget. The list of transpose operations is built once from the settings. Frames which
+    already fit and need no transpose are passed through without loading Pillow.
+    """
+
+    def __init__(self, flip_h=False, flip_v=False, rotate90=False, max_width=1280, max_height=720,
+                 max_bytes=256 * 1024, quality=80):
+        self.key = (flip_h, flip_v, rotate90, max_width, max_height, max_bytes, quality)
+
+        # names of the transpose operations, Pillow >= 9.1 moved them into the Image.Transpose enum
+        operations = []
+        if flip_h and flip_v:
+            operations.append("ROTATE_180")
+        elif flip_h:
+            operations.append("FLIP_LEFT_RIGHT")
+        elif flip_v:
+            operations.append("FLIP_TOP_BOTTOM")
+        if rotate90:
+            # OctoPrint rotates the stream 90 degrees counter clockwise
+            operations.append("ROTATE_90")
+        self.operations = operations
+
+        # the limits apply to the final image, scaling happens before rotating
+        self.source_size = (max_height, max_width) if rotate90 else (max_width, max_height)
+        self.max_bytes = max_bytes
+        self.quality = quality
+
+    def fits(self, data):
+        """
+        :param data: the encoded frame as received from the webcam
+        :return: True when the frame can be sent as it is
+        """
+        if self.operations or len(data) > self.max_bytes:
+            return False
+        size = jpeg_size(data)
+        return size is not None and size[0] <= self.source_size[0] and size[1] <= self.source_size[1]
+
+    def process(self, data):
+        """
+        :param data: the encoded frame as received from the webcam
+        :return: JPEG bytes
+        """
+        if self.fits(data):
+            # nothing to do, skip decoding and encoding altogether
+            return data
+
+        width, height = self.source_size
+        Image = load_pil()
+        image = Image.open(BytesIO(data))
+        if image.format == "JPEG":
+            # let the JPEG decoder scale down by a power of two while decoding, a lot cheaper than a full decode
+            image.draft("RGB", (width, height))
+        if image.width > width or image.height > height:
+            image.thumbnail((width, height), reducing_gap=2.0)
+
+        transpose = getattr(Image, "Transpose", Image)
+        for operation in self.operations:
+            image = image.transpose(getattr(transpose, operation))
+
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        return self.encode(image)
+
+    def encode(self, image):
+        """
+        Encode as JPEG, lowering the quality and then the resolution until it fits the byte budget
+        :param image:
+        :return:
+        """
+        quality = self.quality
+        while True:
+            output = BytesIO()
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+            if output.tell() <= self.max_bytes or (quality <= MIN_QUALITY and min(image.size) <= 16):
+                return output.getvalue()
+
+            if quality > MIN_QUALITY:
+                quality = max(MIN_QUALITY, quality - QUALITY_STEP)
+            else:
+                image = image.resize((max(1, int(image.width * SHRINK_FACTOR)),
+                                      max(1, int(image.height * SHRINK_FACTOR))), load_pil().BILINEAR)
+
+
+# processors of the pool worker by settings
+_processors = {}
+
+# the pool worker loads this file by its path under this name, importing it from the package would import the plugin
+# and OctoPrint with it. The module only depends on the standard library and Pillow
+WORKER_MODULE = "_octoprint_gotify_snapshot"
+
+_LOAD_MODULE = """
+import importlib.util
+import sys
+
+spec = importlib.util.spec_from_file_location(name, path)
+module = importlib.util.module_from_spec(spec)
+sys.modules[name] = module
+spec.loader.exec_module(module)
+"""
+
+# the initializer of the pool worker, run with exec
+_BOOTSTRAP_WORKER = _LOAD_MODULE + "module._init_worker()\n"
+
+
+def load_worker_module():
+    """
+    Jobs are pickled by reference, so the plugin submits the functions of the copy of this file the worker loads
+    :return: this file as the module WORKER_MODULE
+    """
+    module = sys.modules.get(WORKER_MODULE)
+    if module is None:
+        exec(_LOAD_MODULE, dict(name=WORKER_MODULE, path=os.path.abspath(__file__)))
+        module = sys.modules[WORKER_MODULE]
+    return module
+
+
+def _init_worker():
+    # the worker yields to OctoPrint, the comm thread is more important than a snapshot
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+def warm_up():
+    """
+    The first job of a new pool worker, so the first frame does not wait for Pillow to load
+    :return: the pid of the worker
+    """
+    try:
+        load_pil()
+    except ImportError:
+        pass
+    return os.getpid()
+
+
+def process_frame(key, data):
+    """
+    Process a frame in the pool worker
+    :param key: the key of the SnapshotProcessor
+    :param data:
+    :return: JPEG bytes
+    """
+    processor = _processors.get(key)
+    if processor is None:
+        processor = _processors[key] = SnapshotProcessor(*key)
+    return processor.process(data)
+
+
+class SnapshotPool(object):
+    """
+    Decodes, transforms and encodes frames in a separate worker process, so the CPU heavy Pillow work does not compete
+    with the serial comm thread of OctoPrint for the GIL. Frames and results are handed over as bytes. Every job has a
+    budget for the size of the frame and for the processing time, starting the worker is not part of it. A worker
+    which runs over the budget is terminated and a new one started. When the worker can not be started or dies, frames
+    are processed in the calling thread.
+    """
+
+    def __init__(self, timeout=10.0, max_frame_bytes=8 * 1024 * 1024, start_timeout=60.0, logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._executor = None
+        # the warm up job of the worker, done once the worker is ready
+        self._ready = None
+
+        self.timeout = timeout
+        self.max_frame_bytes = max_frame_bytes
+        self.start_timeout = start_timeout
+
+        self.jobs = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+        self.starts = 0
+        self.start_time = None
+
+    def process(self, processor, data):
+        """
+        :param processor: the SnapshotProcessor for the current settings
+        :param data: the encoded frame as received from the webcam
+        :return: JPEG bytes, None when the job took too long
+        """
+        if processor.fits(data):
+            return data
+        if len(data) > self.max_frame_bytes:
+            raise ValueError("the frame has %d bytes, more than the %d allowed" % (len(data), self.max_frame_bytes))
+
+        executor, ready = self._get_executor()
+        if executor is not None:
+            from concurrent.futures.process import BrokenProcessPool
+
+            try:
+                # a worker which is still starting does not eat into the budget of the job
+                ready.result(self.start_timeout)
+            except (TimeoutError, BrokenProcessPool):
+                self._logger.warning("The snapshot worker did not start, processing this snapshot in the plugin")
+                self._reset(executor)
+            else:
+                try:
+                    future = executor.submit(load_worker_module().process_frame, processor.key, data)
+                    self.jobs += 1
+                    return future.result(self.timeout)
+                except TimeoutError:
+                    self.timeouts += 1
+                    self._logger.info("Processing the snapshot took longer than %ss, restarting the worker"
+                                      % self.timeout)
+                    self._reset(executor)
+                    self.start()
+                    return None
+                except BrokenProcessPool:
+                    self._logger.warning("The snapshot worker died, processing this snapshot in the plugin")
+                    self._reset(executor)
+
+        self.fallbacks += 1
+        return processor.process(data)
+
+    def start(self):
+        """
+        Start the worker in the background, ahead of the first frame
+        :return:
+        """
+        self._get_executor()
+
+    def _get_executor(self):
+        """
+        :return: (executor, future of the warm up job), (None, None) when the worker can not be started
+        """
+        with self._lock:
+            if self._executor is None:
+                # multiprocessing is only imported when the pool is used
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                try:
+                    # spawn, forking a process with running threads is not safe
+                    executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                                   initializer=exec,
+                                                   initargs=(_BOOTSTRAP_WORKER,
+                                                             dict(name=WORKER_MODULE, path=os.path.abspath(__file__))))
+                    start = time.monotonic()
+                    ready = executor.submit(load_worker_module().warm_up)
+                except (OSError, ValueError, NotImplementedError) as e:
+                    self._logger.warning("Could not start the snapshot worker: %s" % str(e))
+                    return None, None
+
+                def started(future):
+                    if not future.cancelled() and future.exception() is None:
+                        self.start_time = time.monotonic() - start
+
+                ready.add_done_callback(started)
+                self._executor, self._ready = executor, ready
+                self.starts += 1
+            return self._executor, self._ready
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = self._ready = None
+        self._terminate(executor)
+
+    @staticmethod
+    def _terminate(executor):
+        """
+        Shutting the executor down does not stop a job which is already running, the worker has to be terminated
+        :param executor:
+        :return:
+        """
+        terminate_workers = getattr(executor, "terminate_workers", None)
+        if terminate_workers is not None:
+            # python >= 3.14
+            terminate_workers()
+            return
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            try:
+                process.terminate()
+            except (AttributeError, OSError, ValueError):
+                pass
+        executor.shutdown(wait=False)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor, self._ready = self._executor, None, None
+        if executor is not None:
+            self._terminate(executor)
+
+    def get_stats(self):
+        return dict(jobs=self.jobs, timeouts=self.timeouts, fallbacks=self.fallbacks, starts=self.starts,
+                    start_time=self.start_time)
+
+
+def to_data_uri(data, mime_type="image/jpeg"):
+    return "data:%s;base64,%s" % (mime_type, base64.b64encode(data).decode("ascii"))
+
+
+class _Flight(object):
+    __slots__ = ("done", "frame")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.frame = None
+
+
+class SnapshotCache(object):
+    """
+    Keeps the last snapshot for a few seconds so that a burst of notifications shares one frame. Callers arriving
+    while a fetch is running wait for that fetch instead of starting their own.
+    """
+
+    def __init__(self, fetch, ttl=5.0, wait_timeout=30.0, logger=None):
+        """
+        :param fetch: callable returning the processed snapshot or None
+        :param ttl: seconds a snapshot is served from the cache
+        :param wait_timeout: maximum seconds to wait for a fetch started by someone else
+        :param logger:
+        """
+        self._fetch = fetch
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._frame = None
+        self._frame_time = 0
+        self._flight = None
+
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.prefetches = 0
+        self.errors = 0
+        self.fetch_time_total = 0.0
+        self.fetch_time_max = 0.0
+
+    def _is_fresh(self):
+        return self._frame is not None and time.monotonic() - self._frame_time < self.ttl
+
+    def get(self):
+        """
+        :return: the cached snapshot, or a freshly fetched one
+        """
+        with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return self._frame
+
+            waiting = self._flight
+            if waiting is None:
+                self.misses += 1
+                flight = self._flight = _Flight()
+            else:
+                self.shared += 1
+
+        if waiting is not None:
+            waiting.done.wait(self.wait_timeout)
+            return waiting.frame
+
+        return self._load(flight)
+
+    def prefetch(self):
+        """
+        Warm the cache in the background, does nothing when a fresh frame or a fetch is already there
+        :return:
+        """
+        with self._lock:
+            if self._is_fresh() or self._flight is not None:
+                return
+            self.prefetches += 1
+            flight = self._flight = _Flight()
+
+        thread = threading.Thread(target=self._load, args=(flight,), name="GotifySnapshotPrefetch")
+        thread.daemon = True
+        thread.start()
+
+    def invalidate(self):
+        with self._lock:
+            self._frame = None
+
+    def _load(self, flight):
+        start = time.monotonic()
+        try:
+            frame = self._fetch()
+        except Exception:
+            self._logger.exception("Error while fetching snapshot")
+            frame = None
+        duration = time.monotonic() - start
+
+        with self._lock:
+            self.fetch_time_total += duration
+            self.fetch_time_max = max(self.fetch_time_max, duration)
+            if frame is None:
+                self.errors += 1
+            else:
+                self._frame = frame
+                self._frame_time = time.monotonic()
+            self._flight = None
+
+        flight.frame = frame
+        flight.done.set()
+        return frame
+
+    def get_stats(self):
+        fetches = self.misses + self.prefetches
+        return dict(
+            ttl=self.ttl,
+            hits=self.hits,
+            misses=self.misses,
+            shared=self.shared,
+            prefetches=self.prefetches,
+            errors=self.errors,
+            fetch_time_avg=self.fetch_time_total / fetches if fetches else 0.0,
+            fetch_time_max=self.fetch_time_max,
+        )
@@ -8,6 +8,88 @@ $(function() {
         self.testResult = ko.observable(false);
         self.testSuccessful = ko.observable(false);
         self.testMessage = ko.observable();
+        self.testJob = undefined;
+
+        self.diagnoseActive = ko.observable(false);
+        self.diagnoseJob = undefined;
+        self.diagnoseSteps = ko.observableArray([]);
+
+        self.historyActive = ko.observable(false);
+        self.historyRows = ko.observableArray([]);
+        self.historyPage = ko.observable(1);
+        self.historyPages = ko.observable(1);
+        self.historyOutcome = ko.observable("");
+        self.historyEvent = ko.observable("");
+        self.historyError = ko.observable("");
+
+        self.startJob = function(payload, done) {
+            $.ajax({
+                url: API_BASEURL + "plugin/gotify",
+                type: "POST",
+                dataType: "json",
+                data: JSON.stringify(payload),
+                contentType: "application/json; charset=UTF-8",
+                success: function(response) {
+                    done(response.job);
+                    // in case the plugin message gets lost, e.g. while the socket reconnects
+                    setTimeout(function() { self.pollJob(response.job); }, 30000);
+                },
+                error: function() {
+                    self.onJobDone({job: done(undefined), kind: payload.command, success: false, error: "Request failed"});
+                }
+            });
+        };
+
+        self.pollJob = function(job) {
+            if (job !== self.testJob && job !== self.diagnoseJob) {
+                return;
+            }
+            $.ajax({
+                url: API_BASEURL + "plugin/gotify?job=" + job,
+                type: "GET",
+                dataType: "json",
+                success: function(response) {
+                    if (response.state == "done") {
+                        self.onJobDone(response);
+                    } else {
+                        setTimeout(function() { self.pollJob(job); }, 5000);
+                    }
+                }
+            });
+        };
+
+        self.onJobDone = function(data) {
+            if (data.kind == "test" && data.job === self.testJob) {
+                self.testJob = undefined;
+                self.testActive(false);
+                self.testResult(true);
+                self.testSuccessful(data.success);
+
+                var errors = [];
+                if (data.error) {
+                    errors.push(data.error);
+                }
+                _.each(data.targets || {}, function(result, name) {
+                    if (!result.success) {
+                        errors.push(name + ": " + (result.error || "failed"));
+                    }
+                });
+                self.testMessage(errors.join(", "));
+            } else if (data.kind == "diagnose" && data.job === self.diagnoseJob) {
+                self.diagnoseJob = undefined;
+                self.diagnoseActive(false);
+                self.diagnoseSteps(_.map(data.steps || [{step: "request", ok: false, error: data.error}], function(step) {
+                    var text = step.step;
+                    if (step.duration !== undefined) {
+                        text += ": " + Math.round(step.duration * 1000) + " ms";
+                    }
+                    if (!step.ok) {
+                        text += " - " + step.error;
+                    }
+                    return {text: text, ok: step.ok};
+                }));
+            }
+        };
 
         self.testNotification  = function() {
             self.testActive(true);
@@ -15,43 +97,82 @@ $(function() {
             self.testSuccessful(false);
             self.testMessage("");
 
-            var app_token = $('#app_token').val();
-            var userkey = $('#userkey').val();
-            var device = $('#device').val();
-            var image = $('#image').is(':checked');
-
             var payload = {
                 command: "test",
-                app_token: app_token,
-                device: device,
-                image: image,
+                image: $('#image').is(':checked'),
             };
+            self.startJob(payload, function(job) {
+                self.testJob = job;
+                return job;
+            });
+        };
+
+        self.diagnoseConnection = function() {
+            self.diagnoseActive(true);
+            self.diagnoseSteps([]);
+            self.startJob({command: "diagnose"}, function(job) {
+                self.diagnoseJob = job;
+                return job;
+            });
+        };
 
+        self.loadHistory = function(page) {
+            var query = {history: page, per_page: 25};
+            if (self.historyOutcome()) {
+                query.outcome = self.historyOutcome();
+            }
+            if (self.historyEvent()) {
+                query.event = self.historyEvent();
+            }
+
+            self.historyActive(true);
+            self.historyError("");
             $.ajax({
-                url: API_BASEURL + "plugin/gotify",
-                type: "POST",
+                url: API_BASEURL + "plugin/gotify?" + $.param(query),
+                type: "GET",
                 dataType: "json",
-                data: JSON.stringify(payload),
-                contentType: "application/json; charset=UTF-8",
                 success: function(response) {
-                    self.testResult(true);
-                    self.testSuccessful(response.success);
-                    if (!response.success && response.hasOwnProperty("msg")) {
-                        self.testMessage(response.msg);
-                    } else {
-                        self.testMessage(undefined);
+                    self.historyRows(response.rows);
+                    self.historyPage(response.page);
+                    self.historyPages(Math.max(1, Math.ceil(response.total / response.per_page)));
+                    if (!response.total) {
+                        self.historyError("Nothing recorded yet");
                     }
                 },
+                error: function(xhr) {
+                    self.historyRows([]);
+                    self.historyError(xhr.responseText || "Request failed");
+                },
                 complete: function() {
-                    self.testActive(false);
+                    self.historyActive(false);
                 }
             });
         };
 
+        self.formatHistoryTime = function(time) {
+            return new Date(time * 1000).toLocaleString();
+        };
+
         self.onBeforeBinding = function() {
             self.settings = self.settingsViewModel.settings;
         };
 
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin != "gotify") {
+                return;
+            }
+
+            if (data.type == "job") {
+                self.onJobDone(data);
+            } else if (data.type == "message_error") {
+                new PNotify({
+                    title: "Gotify",
+                    text: "The message of " + data.event + " was not saved: " + data.error,
+                    type: "error"
+                });
+            }
+        };
+
         self.has_own_token = function() {
             return self.settings.plugins.gotify.token() != '' && self.settings.plugins.gotify.token() != self.settings.plugins.gotify.default_token();
         };
@@ -0,0 +1,193 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import re
+import threading
+import time
+
+BUFFER_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+# frames older than this are not served, the stream probably stalled
+MAX_FRAME_AGE = 2.0
+
+_boundary = re.compile(r"boundary=\"?([^\";]+)\"?", re.I)
+_content_length = re.compile(br"content-length:\s*(\d+)", re.I)
+
+
+def get_reader(raw):
+    """
+    :param raw: the urllib3 response
+    :return: readinto function of the underlying http.client response, it receives straight into the buffer without
+    the intermediate bytes object of urllib3 and returns what is available instead of waiting for the buffer to fill
+    """
+    fp = getattr(raw, "_fp", None)
+    if fp is not None and hasattr(fp, "readinto"):
+        return fp.readinto
+    return raw.readinto
+
+
+class MjpegGrabber(object):
+    """
+    Keeps one connection to the MJPEG stream of the webcam open and remembers the latest frame, so notifications get
+    their image without waiting for the snapshot endpoint to produce one.
+
+    The multipart stream is parsed in place: data is read into a preallocated buffer and frames are located with
+    offsets. A complete frame is published by switching to the second buffer, only the few bytes already read past
+    the frame are copied over. The frame itself is only copied when somebody asks for it. The connection is closed
+    after a while without requests and opened again on the next request.
+    """
+
+    def __init__(self, url, session, idle_timeout=300.0, timeout=(5, 10), logger=None):
+        """
+        :param url: url of the MJPEG stream
+        :param session: requests session to connect with
+        :param idle_timeout: seconds without a request after which the connection is closed
+        :param timeout: connect and read timeout
+        :param logger:
+        """
+        self.url = url
+        self.session = session
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._buffers = [bytearray(BUFFER_SIZE), bytearray(BUFFER_SIZE)]
+        # (index of the buffer, start, end) of the latest frame
+        self._latest = None
+        self._latest_time = 0
+        self._last_request = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.connects = 0
+        self.frames = 0
+        self.served = 0
+        self.errors = 0
+
+    def get(self):
+        """
+        :return: the latest frame as JPEG bytes, or None when there is no recent one yet. In that case the stream is
+        (re)connected in the background for the next request.
+        """
+        now = time.monotonic()
+        self._last_request = now
+        self.start()
+        with self._lock:
+            if self._latest is None or now - self._latest_time > MAX_FRAME_AGE:
+                return None
+            index, start, end = self._latest
+            self.served += 1
+            return bytes(memoryview(self._buffers[index])[start:end])
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._last_request = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="GotifyMjpegGrabber")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            self._stream()
+        except Exception as e:
+            self.errors += 1
+            self._logger.info("Lost the webcam stream %s: %s" % (self.url, str(e)))
+        finally:
+            with self._lock:
+                self._latest = None
+
+    def _stream(self):
+        with self.session.get(self.url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            match = _boundary.search(r.headers.get("Content-Type", ""))
+            if match is None:
+                raise ValueError("not a multipart stream: %s" % r.headers.get("Content-Type"))
+            boundary = match.group(1).encode("latin-1")
+            delimiter = b"\r\n" + (boundary if boundary.startswith(b"--") else b"--" + boundary)
+            self.connects += 1
+            self._logger.debug("Connected to the webcam stream %s", self.url)
+            readinto = get_reader(r.raw)
+
+            index = 0
+            buffer = self._buffers[index]
+            view = memoryview(buffer)
+            filled = 0
+            pos = 0
+            # length of the frame whose headers were read, -1 when the part has no content-length
+            length = None
+
+            while not self._stop.is_set():
+                if time.monotonic() - self._last_request > self.idle_timeout:
+                    self._logger.debug("Nobody asked for a frame in a while, closing the webcam stream")
+                    return
+
+                if filled == len(buffer):
+                    if pos > 0:
+                        # make room by moving the incomplete part to the front
+                        view[:filled - pos] = bytes(view[pos:filled])
+                        filled -= pos
+                        pos = 0
+                    else:
+                        # a single frame does not fit, grow both buffers
+                        view.release()
+                        with self._lock:
+                            self._latest = None
+                            for i in range(2):
+                                self._buffers[i] = self._buffers[i] + bytearray(len(buffer))
+                            buffer = self._buffers[index]
+                        view = memoryview(buffer)
+
+                read = readinto(view[filled:min(len(buffer), filled + READ_SIZE)])
+                if not read:
+                    return
+                filled += read
+
+                while True:
+                    if length is None:
+                        headers_end = buffer.find(b"\r\n\r\n", pos, filled)
+                        if headers_end < 0:
+                            break
+                        match = _content_length.search(buffer, pos, headers_end)
+                        length = int(match.group(1)) if match is not None else -1
+                        pos = headers_end + 4
+
+                    if length >= 0:
+                        if filled - pos < length:
+                            break
+                        end = pos + length
+                    else:
+                        end = buffer.find(delimiter, pos, filled)
+                        if end < 0:
+                            break
+
+                    # publish the frame and continue in the other buffer
+                    other = 1 - index
+                    with self._lock:
+                        self._latest = (index, pos, end)
+                        self._latest_time = time.monotonic()
+                        self.frames += 1
+                        view.release()
+                        index = other
+                        buffer = self._buffers[index]
+                        view = memoryview(buffer)
+                        remainder = filled - end
+                        view[:remainder] = memoryview(self._buffers[1 - index])[end:filled]
+                    filled = remainder
+                    pos = 0
+                    length = None
+
+    def get_stats(self):
+        return dict(
+            url=self.url,
+            connected=self._thread is not None and self._thread.is_alive(),
+            connects=self.connects,
+            frames=self.frames,
+            served=self.served,
+            errors=self.errors,
+        )
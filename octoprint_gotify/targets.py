@@ -0,0 +1,217 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .sender import OVERFLOW_DROP_OLDEST, NotificationSender
+
+DEFAULT_TARGET = "default"
+
+
+class Target(object):
+    """
+    A gotify server and application token notifications are delivered to. Every target has its own connection pool and
+    its own bounded queue with a worker, so a slow target never holds up the others. The backlog builds up in the
+    queue of the slow target, so that is where the overflow policy and the shedding of low priority notifications
+    apply.
+
+    With an express session, critical notifications skip the queue: they are posted by a second worker over their own
+    connection, which is kept warm so there is no connect or TLS handshake when it matters.
+    """
+
+    def __init__(self, name, url, token, session, deliver, events=None, priorities=None, queue_size=32,
+                 overflow=OVERFLOW_DROP_OLDEST, shed_priority=0, on_drop=None, express_session=None, logger=None):
+        """
+        :param name:
+        :param url: base url of the gotify server
+        :param token: application token
+        :param session: requests session used only by this target
+        :param deliver: callable receiving the target and a Notification, called on the worker of the target, returns
+        True when it was delivered
+        :param events: names of the events delivered to this target, None for all
+        :param priorities: dict of event -> priority overriding the priority of the event
+        :param queue_size: notifications waiting for the worker before the overflow policy kicks in
+        :param overflow: one of OVERFLOW_POLICIES
+        :param shed_priority: notifications below this priority are shed when the queue is half full
+        :param on_drop: callable receiving the target and every Notification it dropped without delivery
+        :param express_session: requests session used only for the critical notifications, None to send them with
+        the others
+        :param logger:
+        """
+        self.name = name
+        self.url = url.rstrip("/")
+        self.token = token
+        self.session = session
+        self.events = frozenset(events) if events else None
+        self.priorities = dict(priorities or {})
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # notified whenever an express delivery finished
+        self._idle = threading.Condition(self._lock)
+        self.queue = NotificationSender(lambda notification: deliver(self, notification), size=queue_size,
+                                        overflow=overflow, shed_priority=shed_priority,
+                                        on_drop=(lambda notification: on_drop(self, notification)) if on_drop else None,
+                                        on_stopped=self.session.close, name="GotifyTarget-%s" % name, logger=self._logger)
+        self.express_session = express_session
+        self._express_executor = None
+        if express_session is not None:
+            self._express_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="GotifyExpress-%s" % name)
+        # monotonic time the express connection was last used
+        self.express_used = 0.0
+
+        self.express_pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.express = 0
+        self.warmed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    @property
+    def pending(self):
+        return self.queue.depth
+
+    @property
+    def closed(self):
+        """
+        :return: True when the target was closed and its workers are done
+        """
+        return not self.queue.running and not self.queue.alive and not self.express_pending
+
+    def accepts(self, event):
+        return self.events is None or event is None or event in self.events
+
+    def get_priority(self, event, priority):
+        try:
+            return int(self.priorities.get(event, priority) or 0)
+        except (TypeError, ValueError):
+            return priority
+
+    def configure(self, queue_size, overflow, shed_priority=0):
+        self.queue.configure(queue_size, overflow, shed_priority)
+
+    def start(self):
+        self.queue.start()
+
+    def submit(self, notification):
+        """
+        Queue a notification for the worker of this target
+        :return: False when the notification was dropped right away
+        """
+        return self.queue.enqueue(notification)
+
+    def submit_express(self, fn, *args):
+        """
+        Run a delivery on the express worker, there is no limit because critical notifications are rare
+        :return: False when the target has no express worker
+        """
+        if self._express_executor is None:
+            return False
+        with self._lock:
+            self.express += 1
+            self.express_pending += 1
+        self._express_executor.submit(self._run_express, fn, args)
+        return True
+
+    def _run_express(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            self._logger.exception("Error while delivering to gotify target %s", self.name)
+        finally:
+            with self._lock:
+                self.express_pending -= 1
+                self._idle.notify_all()
+
+    def warm(self, timeout, idle=0):
+        """
+        Open the express connection, or keep it open, with a cheap request
+        :param timeout:
+        :param idle: only when the connection was not used for this many seconds
+        :return:
+        """
+        if self.express_session is None or time.monotonic() - self.express_used < idle:
+            return
+        self.express_used = time.monotonic()
+        try:
+            self.express_session.get("%s/version" % self.url, timeout=timeout).close()
+            self.warmed += 1
+        except Exception as e:
+            self._logger.debug("Could not warm up the express connection to %s: %s", self.name, e)
+
+    def post(self, payload, timeout, express=False):
+        """
+        :param payload:
+        :param timeout:
+        :param express: use the express connection
+        :return: the response
+        """
+        session = self.session
+        if express and self.express_session is not None:
+            session = self.express_session
+            self.express_used = time.monotonic()
+        start = time.monotonic()
+        try:
+            return session.post("%s/message" % self.url, params=dict(token=self.token), json=payload,
+                                timeout=timeout)
+        finally:
+            latency = time.monotonic() - start
+            self.latency_last = latency
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def record(self, delivered):
+        if delivered:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def close(self, wait=False, timeout=None):
+        """
+        Stop taking notifications, the queued ones are still delivered. Every worker closes its session when it is
+        done, can be called again to wait for them
+        :param wait: wait until the workers are done, otherwise they finish in the background
+        :param timeout: maximum seconds to wait for them
+        :return: False when deliveries were left unfinished
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        finished = self.queue.stop(drain=True, timeout=timeout, wait=wait)
+        if self._express_executor is not None:
+            # runs after the express deliveries still pending
+            self._express_executor.submit(self.express_session.close)
+            self._express_executor.shutdown(wait=False)
+            self._express_executor = None
+        if not wait:
+            return finished
+
+        remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+        with self._idle:
+            finished = self._idle.wait_for(lambda: not self.express_pending, remaining) and finished
+        if not finished:
+            self._logger.warning("Gotify target %s did not finish within %ss, %d delivery(s) left behind",
+                                 self.name, timeout, self.pending + self.express_pending)
+
+        self.session.close()
+        if self.express_session is not None:
+            self.express_session.close()
+        return finished
+
+    def get_stats(self):
+        attempts = self.sent + self.failed
+        return dict(
+            url=self.url,
+            pending=self.pending,
+            queue=self.queue.get_stats(),
+            sent=self.sent,
+            failed=self.failed,
+            express=self.express,
+            warmed=self.warmed,
+            success_rate=float(self.sent) / attempts if attempts else None,
+            latency_avg=self.latency_total / attempts if attempts else 0.0,
+            latency_max=self.latency_max,
+            latency_last=self.latency_last,
+        )
@@ -0,0 +1,174 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+
+# at most this many messages are quoted in a coalesced notification
+MAX_MERGED_MESSAGES = 5
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` messages per minute, with bursts of up to `rate` messages
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate):
+        self.rate = rate / 60.0
+        self.capacity = max(1.0, float(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class _Window(object):
+    __slots__ = ("first", "messages", "count", "timer")
+
+    def __init__(self, first):
+        self.first = first
+        self.messages = [first.payload.get("message")]
+        self.count = 1
+        self.timer = None
+
+
+class Throttle(object):
+    """
+    Per event rate limiting and coalescing in front of the sender.
+
+    With a coalescing window, the first notification of an event is held back for that many seconds and everything
+    arriving in the meantime is merged into it. Notifications over the rate limit are suppressed, the next
+    notification of the event which gets through mentions how many were suppressed.
+    """
+
+    def __init__(self, emit, on_suppress=None, logger=None):
+        """
+        :param emit: callable receiving the Notification which passed the throttle
+        :param on_suppress: callable receiving every Notification which is merged into another or suppressed, and
+        whether it was merged
+        :param logger:
+        """
+        self._emit = emit
+        self._on_suppress = on_suppress
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._buckets = {}
+        self._windows = {}
+        self._suppressed = {}
+
+        self.passed = 0
+        self.coalesced = 0
+        self.limited = 0
+
+    def configure(self, limits):
+        """
+        :param limits: dict of event -> (rate limit per minute, coalescing window in seconds), 0 disables either
+        :return:
+        """
+        limits = dict((event, limit) for event, limit in limits.items() if limit[0] > 0 or limit[1] > 0)
+        with self._lock:
+            self._limits = limits
+            self._buckets = dict((event, TokenBucket(rate)) for event, (rate, _) in limits.items() if rate > 0)
+
+    def submit(self, notification):
+        limit = self._limits.get(notification.event)
+        if limit is None:
+            self.passed += 1
+            self._emit(notification)
+            return
+
+        with self._lock:
+            if limit[1] > 0:
+                window = self._windows.get(notification.event)
+                if window is not None:
+                    window.messages.append(notification.payload.get("message"))
+                    window.count += 1
+                    window.first.priority = max(window.first.priority, notification.priority)
+                    window.first.image = window.first.image or notification.image
+                    self.coalesced += 1
+                    if self._on_suppress is not None:
+                        self._on_suppress(notification, True)
+                    return
+
+                window = self._windows[notification.event] = _Window(notification)
+                window.timer = threading.Timer(limit[1], self._flush, args=(notification.event,))
+                window.timer.daemon = True
+                window.timer.start()
+                return
+
+            if not self._allow(notification):
+                return
+
+        self.passed += 1
+        self._emit(notification)
+
+    def _allow(self, notification, count=1):
+        """
+        Called with the lock held
+        """
+        bucket = self._buckets.get(notification.event)
+        if bucket is None or bucket.consume():
+            suppressed = self._suppressed.pop(notification.event, 0)
+            if suppressed:
+                notification.payload["message"] = u"%s\n(%d more suppressed)" % (notification.payload.get("message"),
+                                                                                  suppressed)
+            return True
+
+        self._suppressed[notification.event] = self._suppressed.get(notification.event, 0) + count
+        self.limited += count
+        self._logger.debug("Rate limit reached, suppressing %s notification", notification.event)
+        if self._on_suppress is not None:
+            self._on_suppress(notification, False)
+        return False
+
+    def _flush(self, event):
+        with self._lock:
+            window = self._windows.pop(event, None)
+            if window is None:
+                return
+
+            notification = window.first
+            if window.count > 1:
+                messages = window.messages[-MAX_MERGED_MESSAGES:]
+                if window.count > len(messages):
+                    messages.insert(0, u"…")
+                notification.payload["message"] = u"%d x %s:\n%s" % (window.count, event, u"\n".join(messages))
+
+            if not self._allow(notification, window.count):
+                return
+
+        self.passed += 1
+        self._emit(notification)
+
+    def flush_all(self):
+        """
+        Emit all coalescing windows right away, e.g. before shutting down
+        :return:
+        """
+        with self._lock:
+            windows = list(self._windows.values())
+        for window in windows:
+            window.timer.cancel()
+            self._flush(window.first.event)
+
+    def get_stats(self):
+        with self._lock:
+            suppressed = dict(self._suppressed)
+            pending = len(self._windows)
+        return dict(
+            passed=self.passed,
+            coalesced=self.coalesced,
+            limited=self.limited,
+            pending=pending,
+            suppressed=suppressed,
+        )
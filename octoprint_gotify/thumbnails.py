@@ -0,0 +1,164 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import binascii
+import collections
+import io
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# the header of some slicers is large, but never this large
+MAX_HEADER_BYTES = 4 * 1024 * 1024
+
+# "; thumbnail begin 300x300 12345", "; thumbnail_JPG begin ...", "; thumbnail_QOI begin ..."
+_begin = re.compile(r"^;\s*thumbnail(?:_(PNG|JPG|QOI))?\s+begin\s+(\d+)x(\d+)")
+_end = re.compile(r"^;\s*thumbnail(?:_(?:PNG|JPG|QOI))?\s+end")
+
+MIME_TYPES = {"PNG": "image/png", "JPG": "image/jpeg"}
+
+
+def read_thumbnails(f, max_bytes=MAX_HEADER_BYTES):
+    """
+    Collect the base64 thumbnail blocks from the comment header of a gcode file, reading stops at the first line which
+    is neither a comment nor empty
+    :param f: file opened in binary mode
+    :param max_bytes:
+    :return: list of (format, width, height, base64 data)
+    """
+    thumbnails = []
+    current = None
+    read = 0
+    for raw in f:
+        read += len(raw)
+        if read > max_bytes:
+            break
+        line = raw.decode("ascii", "replace").strip()
+        if not line:
+            continue
+        if not line.startswith(";"):
+            break
+
+        if current is None:
+            match = _begin.match(line)
+            if match is not None:
+                current = (match.group(1) or "PNG", int(match.group(2)), int(match.group(3)), [])
+        elif _end.match(line):
+            thumbnails.append(current[:3] + ("".join(current[3]),))
+            current = None
+        else:
+            current[3].append(line.lstrip("; "))
+    return thumbnails
+
+
+def choose(thumbnails, max_width=None, max_height=None):
+    """
+    :return: the largest thumbnail which fits the size limits, or the smallest one when none of them fits
+    """
+    if not thumbnails:
+        return None
+
+    def fits(thumbnail):
+        return (not max_width or thumbnail[1] <= max_width) and (not max_height or thumbnail[2] <= max_height)
+
+    fitting = [thumbnail for thumbnail in thumbnails if fits(thumbnail)]
+    if fitting:
+        return max(fitting, key=lambda thumbnail: thumbnail[1] * thumbnail[2])
+    return min(thumbnails, key=lambda thumbnail: thumbnail[1] * thumbnail[2])
+
+
+def decode(thumbnail):
+    """
+    :param thumbnail: (format, width, height, base64 data)
+    :return: (mime type, image bytes), QOI is converted to PNG
+    """
+    data = binascii.a2b_base64(thumbnail[3])
+    if thumbnail[0] in MIME_TYPES:
+        return MIME_TYPES[thumbnail[0]], data
+
+    # only needed for QOI, Pillow reads it since 9.5
+    from PIL import Image
+    output = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(output, format="PNG")
+    return "image/png", output.getvalue()
+
+
+class ThumbnailCache(object):
+    """
+    Thumbnails embedded by the slicer, used as notification image when there is no webcam. They are extracted when a
+    file is uploaded and kept in a least recently used cache limited by the size of the images.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024, max_width=None, max_height=None, logger=None):
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # (path, mtime) -> (mime type, bytes) or None when the file has no thumbnail
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="GotifyThumbnails")
+
+        self.max_bytes = max_bytes
+        self.max_width = max_width
+        self.max_height = max_height
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """
+        :param path: path of the gcode file on disk
+        :return: (mime type, image bytes) or None
+        """
+        try:
+            key = (path, os.stat(path).st_mtime)
+        except OSError:
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        return self._extract(key)
+
+    def extract(self, path):
+        """
+        Extract the thumbnail of a file into the cache in the background, e.g. right after it was uploaded
+        :param path:
+        :return:
+        """
+        self._executor.submit(self.get, path)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _extract(self, key):
+        try:
+            with io.open(key[0], "rb") as f:
+                thumbnail = choose(read_thumbnails(f), self.max_width, self.max_height)
+            image = decode(thumbnail) if thumbnail is not None else None
+        except Exception as e:
+            self._logger.info("Could not read the thumbnail of %s: %s" % (key[0], str(e)))
+            image = None
+
+        with self._lock:
+            # other versions of the file are outdated
+            for old in [old for old in self._entries if old[0] == key[0]]:
+                self._forget(old)
+            self._entries[key] = image
+            self._bytes += len(image[1]) if image else 0
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._forget(next(iter(self._entries)))
+        return image
+
+    def _forget(self, key):
+        image = self._entries.pop(key)
+        self._bytes -= len(image[1]) if image else 0
+
+    def get_stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), bytes=self._bytes, hits=self.hits, misses=self.misses)
@@ -0,0 +1,190 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+
+SPARK_CHARS = u"▁▂▃▄▅▆▇█"
+# weight of the newest sample in the moving average
+ALPHA = 0.2
+# samples before the moving average is trusted, the first lines of a print are slow anyway
+WARMUP_SAMPLES = 5
+# the slow alert is armed again once the rate is this much above the floor
+REARM_FACTOR = 1.2
+
+STALL = "stall"
+SLOW = "slow"
+
+
+def sparkline(values, width=24):
+    """
+    :param values: non negative numbers
+    :param width: maximum number of characters, neighbouring values are averaged to fit
+    :return: the values as bars scaled to the largest one, empty for no values
+    """
+    if not values:
+        return u""
+    step = -(-len(values) // width)
+    if step > 1:
+        values = [sum(values[i:i + step]) / len(values[i:i + step]) for i in range(0, len(values), step)]
+    top = max(values)
+    if top <= 0:
+        return SPARK_CHARS[0] * len(values)
+    last = len(SPARK_CHARS) - 1
+    return u"".join(SPARK_CHARS[min(last, int(value / top * last + 0.5))] for value in values)
+
+
+class ThroughputMonitor(object):
+    """
+    Watches how fast gcode lines are streamed to the printer during a print.
+
+    The gcode hook only counts lines, which it does anyway. A thread running only while printing looks at the counter
+    every few seconds: the lines per second go into a moving average and a fixed number of samples for the sparkline.
+    When the sparkline samples are full, neighbours are merged, so any print length fits into the same memory. A gap
+    without lines longer than the stall limit, or a moving average below the floor, raises an alert, unless the
+    printer holds the stream on purpose (paused, M600, waiting for a heater).
+    """
+
+    def __init__(self, count, is_holding, on_alert, interval=2.0, min_rate=0, stall=30, width=24, logger=None):
+        """
+        :param count: callable returning the number of lines sent so far
+        :param is_holding: callable, True while the printer does not take lines on purpose
+        :param on_alert: callable receiving the kind of alert (STALL or SLOW), the lines per second and the gap in
+        seconds, called on the monitor thread
+        :param interval: seconds between two looks at the counter
+        :param min_rate: lines per second below which the stream counts as slow, 0 is off
+        :param stall: seconds without a line which count as a stall, 0 is off
+        :param width: characters of the sparkline
+        :param logger:
+        """
+        self._count = count
+        self._is_holding = is_holding
+        self._on_alert = on_alert
+        self._logger = logger or logging.getLogger(__name__)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.interval = interval
+        self.min_rate = min_rate
+        self.stall = stall
+        self.width = width
+
+        self.stalls = 0
+        self.slowdowns = 0
+        self._reset()
+
+    def _reset(self):
+        self.rate = None
+        self.max_gap = 0.0
+        self._lines = self._count()
+        self._last_tick = self._last_line = time.monotonic()
+        self._total_lines = 0
+        self._total_time = 0.0
+        self._samples = []
+        self._bucket_width = 1
+        self._bucket_sum = 0.0
+        self._bucket_count = 0
+        self._stalled = False
+        self._slow = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Start watching a new print
+        """
+        self.stop()
+        self._reset()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="GotifyWatchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.interval)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick(time.monotonic())
+            except Exception:
+                self._logger.exception("Error in the gcode throughput watchdog")
+
+    def tick(self, now):
+        lines = self._count()
+        delta = lines - self._lines
+        elapsed = now - self._last_tick
+        self._lines = lines
+        self._last_tick = now
+        if elapsed <= 0:
+            return
+
+        if self._is_holding():
+            # the gap starts once the printer takes lines again
+            self._last_line = now
+            self._stalled = False
+            return
+
+        if delta:
+            self._last_line = now
+            self._stalled = False
+        else:
+            gap = now - self._last_line
+            self.max_gap = max(self.max_gap, gap)
+            if self.stall and gap >= self.stall and not self._stalled:
+                self._stalled = True
+                self.stalls += 1
+                self._on_alert(STALL, self.rate or 0.0, gap)
+
+        rate = delta / elapsed
+        self._total_lines += delta
+        self._total_time += elapsed
+        self._add_sample(rate)
+        if not delta:
+            # a gap is handled as stall, the moving average only tells about a stream which is still flowing
+            return
+
+        self.rate = rate if self.rate is None else self.rate + ALPHA * (rate - self.rate)
+        if self.min_rate and self._samples_seen() >= WARMUP_SAMPLES:
+            if self.rate < self.min_rate and not self._slow:
+                self._slow = True
+                self.slowdowns += 1
+                self._on_alert(SLOW, self.rate, now - self._last_line)
+            elif self.rate > self.min_rate * REARM_FACTOR:
+                self._slow = False
+
+    def _samples_seen(self):
+        return len(self._samples) * self._bucket_width + self._bucket_count
+
+    def _add_sample(self, rate):
+        self._bucket_sum += rate
+        self._bucket_count += 1
+        if self._bucket_count < self._bucket_width:
+            return
+        self._samples.append(self._bucket_sum / self._bucket_count)
+        self._bucket_sum = 0.0
+        self._bucket_count = 0
+        if len(self._samples) >= 2 * self.width:
+            samples = self._samples
+            self._samples = [(samples[i] + samples[i + 1]) / 2 for i in range(0, len(samples) - 1, 2)]
+            self._bucket_width *= 2
+
+    def summary(self):
+        """
+        :return: average lines per second while the printer took lines, the sparkline and the longest gap
+        """
+        return dict(
+            rate=self._total_lines / self._total_time if self._total_time else None,
+            sparkline=sparkline(list(self._samples), self.width),
+            max_gap=self.max_gap,
+        )
+
+    def get_stats(self):
+        return dict(running=self.running, rate=self.rate, max_gap=self.max_gap, stalls=self.stalls,
+                    slowdowns=self.slowdowns)